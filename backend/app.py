@@ -1,18 +1,83 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for
+from flask import (
+    Flask,
+    render_template,
+    request,
+    jsonify,
+    redirect,
+    url_for,
+    make_response,
+    stream_with_context,
+    g,
+)
 from flask_cors import CORS
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, func, event
+from sqlalchemy import (
+    create_engine,
+    Column,
+    Integer,
+    Float,
+    Date,
+    String,
+    Text,
+    ForeignKey,
+    Index,
+    func,
+    event,
+    and_,
+    or_,
+    exists,
+    inspect,
+    bindparam,
+    delete,
+    insert,
+    literal_column,
+    select,
+    text,
+    tuple_,
+    update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine, make_url
 from sqlalchemy.orm import (
+    backref,
     sessionmaker,
     declarative_base,
     relationship,
-    joinedload,
+    selectinload,
+    validates,
 )
-from collections import Counter
+from sqlalchemy.schema import CreateIndex
+from collections import Counter, OrderedDict, deque, namedtuple
+from datetime import date, datetime, timedelta
+from urllib.parse import unquote
+import base64
+import bisect
+import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import mimetypes
 import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+import uuid
 
 from werkzeug.utils import secure_filename  #今後使う可能性もあるので残しておく
-import cloudinary
-import cloudinary.uploader
+import numpy as np
+from PIL import Image, ImageOps, features
+
+try:
+    import brotli
+except ImportError:  #未インストールなら gzip 版だけ作る
+    brotli = None
 
 
 #============================================
@@ -38,6 +103,118 @@ def allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+#============================================
+#静的ファイル（内容ハッシュ付き URL + 事前圧縮）
+#============================================
+#起動時に static/ の css・js・img を読み、内容ハッシュ入りの名前（js/index.3f2a9c1b.js）と
+#gzip / brotli 版を作っておく。url_for("static") はハッシュ付きの名前を返すので、
+#ブラウザや CDN は 1 年間 immutable でキャッシュしてよい（中身が変われば URL が変わる）。
+#uploads/ はユーザー画像なので対象外（従来どおり send_static_file で返す）
+STATIC_MANIFEST_DIRS = ("css", "js", "img")
+STATIC_HASH_LENGTH = 12
+STATIC_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+STATIC_COMPRESSIBLE_TYPES = ("application/javascript", "application/json", "image/svg+xml")
+STATIC_ENCODINGS = ("br", "gzip")  #優先順
+
+
+def _static_files(static_folder):
+    """マニフェスト対象のファイルを (static からの相対パス, フルパス) で列挙"""
+    for sub in STATIC_MANIFEST_DIRS:
+        for dirpath, _, filenames in os.walk(os.path.join(static_folder, sub)):
+            for filename in sorted(filenames):
+                full_path = os.path.join(dirpath, filename)
+                yield os.path.relpath(full_path, static_folder).replace(os.sep, "/"), full_path
+
+
+def build_static_manifest(static_folder):
+    """{"by_name": {元の名前: 資産}, "by_hashed": {ハッシュ付きの名前: 資産}} を作る"""
+    by_name, by_hashed, signature = {}, {}, []
+    for name, full_path in _static_files(static_folder):
+        with open(full_path, "rb") as f:
+            raw = f.read()
+        signature.append((name, os.path.getmtime(full_path)))
+
+        digest = hashlib.sha256(raw).hexdigest()[:STATIC_HASH_LENGTH]
+        stem, ext = os.path.splitext(name)
+        mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+        bodies = {"identity": raw}
+        if mimetype.startswith("text/") or mimetype in STATIC_COMPRESSIBLE_TYPES:
+            bodies["gzip"] = gzip.compress(raw, compresslevel=9, mtime=0)
+            if brotli is not None:
+                bodies["br"] = brotli.compress(raw, quality=11)
+            #小さすぎて縮まなかったものは配らない
+            bodies = {
+                encoding: body for encoding, body in bodies.items()
+                if encoding == "identity" or len(body) < len(raw)
+            }
+
+        asset = {
+            "hashed": f"{stem}.{digest}{ext}",
+            "digest": digest,
+            "mimetype": mimetype,
+            "bodies": bodies,
+        }
+        by_name[name] = asset
+        by_hashed[asset["hashed"]] = asset
+    return {"by_name": by_name, "by_hashed": by_hashed, "signature": signature}
+
+
+_static_manifest = None   #最初の static_manifest() で作る（import 時には圧縮しない）
+
+
+def static_manifest():
+    """
+    現在のマニフェスト。最初に使うときに作り、本番はそれをそのまま使う。
+    debug 実行中だけファイルの更新を検知して作り直す（JS を編集してすぐ確認できるように）。
+    """
+    global _static_manifest
+    if _static_manifest is None:
+        _static_manifest = build_static_manifest(app.static_folder)
+    elif app.debug:
+        signature = [
+            (name, os.path.getmtime(full_path))
+            for name, full_path in _static_files(app.static_folder)
+        ]
+        if signature != _static_manifest["signature"]:
+            _static_manifest = build_static_manifest(app.static_folder)
+    return _static_manifest
+
+
+@app.url_defaults
+def static_asset_url(endpoint, values):
+    """url_for("static", filename=...) をハッシュ付きの名前に書き換える"""
+    if endpoint == "static":
+        asset = static_manifest()["by_name"].get(values.get("filename"))
+        if asset:
+            values["filename"] = asset["hashed"]
+
+
+def serve_static(filename):
+    """ハッシュ付きの名前なら事前圧縮済みの本体を返し、それ以外は通常の静的配信"""
+    asset = static_manifest()["by_hashed"].get(filename)
+    if asset is None:
+        return app.send_static_file(filename)
+
+    encoding = next(
+        (e for e in STATIC_ENCODINGS if e in asset["bodies"] and request.accept_encodings[e]),
+        "identity",
+    )
+    response = app.response_class(asset["bodies"][encoding], mimetype=asset["mimetype"])
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    response.set_etag(f"{asset['digest']}-{encoding}")
+    response.cache_control.public = True
+    response.cache_control.max_age = STATIC_IMMUTABLE_MAX_AGE
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+
+#Flask 標準の static エンドポイント（/static/<path:filename>）の中身だけ差し替える
+app.view_functions["static"] = serve_static
+
+
 #============================================
 #DB 設定
 #============================================
@@ -49,21 +226,153 @@ if db_url.startswith("postgres://"):
     db_url = db_url.replace("postgres://", "postgresql://", 1)
 
 DATABASE_URL = db_url
+app.config.setdefault("DATABASE_URL", DATABASE_URL)
+#最初に DB を使うときに create_all + マイグレーションを流すか（python app.py migrate で別に流すなら False）
+app.config.setdefault("AUTO_MIGRATE", os.environ.get("AUTO_MIGRATE", "1") == "1")
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+#---- 方言ごとのエンジン設定（DB_PROFILE=tuned / default）----
+#SQLite: 接続ごとに流す PRAGMA。WAL + synchronous=NORMAL で複数 gunicorn ワーカーの読み書きを詰まらせない
+SQLITE_PRAGMAS = {
+    "foreign_keys": "ON",
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": _env_int("SQLITE_BUSY_TIMEOUT_MS", 5000),
+    "mmap_size": _env_int("SQLITE_MMAP_SIZE", 256 * 1024 * 1024),
+    "cache_size": -_env_int("SQLITE_CACHE_KB", 64 * 1024),   #負数は KiB 指定
+    "temp_store": "MEMORY",
+}
+
+#PostgreSQL: コネクションプールとサーバー側タイムアウト
+POSTGRES_ENGINE_OPTIONS = {
+    "pool_size": _env_int("DB_POOL_SIZE", 5),
+    "max_overflow": _env_int("DB_MAX_OVERFLOW", 10),
+    "pool_timeout": _env_int("DB_POOL_TIMEOUT", 30),
+    "pool_recycle": _env_int("DB_POOL_RECYCLE", 1800),
+    "pool_pre_ping": True,
+}
+POSTGRES_SESSION_SETTINGS = {
+    "statement_timeout": _env_int("DB_STATEMENT_TIMEOUT_MS", 15000),
+    "idle_in_transaction_session_timeout": _env_int("DB_IDLE_TX_TIMEOUT_MS", 60000),
+}
+#psycopg (v3) ドライバのときだけ効く：同じ文を何回実行したらサーバー側 prepare するか
+POSTGRES_PREPARE_THRESHOLD = _env_int("DB_PREPARE_THRESHOLD", 5)
 
-engine = create_engine(DATABASE_URL, echo=not IS_PRODUCTION)
-Session = sessionmaker(bind=engine)
+
+def make_engine(url, profile=None, echo=None):
+    """
+    DATABASE_URL の方言に合わせてチューニングしたエンジンを作る。
+    profile="default" なら素の create_engine（ベンチマークの比較用）。
+    SQL ログは SQL_ECHO=1 のときだけ出す。
+    """
+    profile = profile or os.environ.get("DB_PROFILE", "tuned")
+    echo = os.environ.get("SQL_ECHO") == "1" if echo is None else echo
+    dialect = make_url(url).get_backend_name()
+    driver = make_url(url).get_driver_name()
+
+    if profile == "default":
+        new_engine = create_engine(url, echo=echo)
+        if dialect == "sqlite":
+            event.listen(new_engine, "connect", _sqlite_connect_hook({"foreign_keys": "ON"}))
+        return new_engine
+
+    if dialect == "sqlite":
+        new_engine = create_engine(
+            url,
+            echo=echo,
+            #sqlite3 側のロック待ちも busy_timeout に合わせる
+            connect_args={"timeout": SQLITE_PRAGMAS["busy_timeout"] / 1000},
+        )
+        event.listen(new_engine, "connect", _sqlite_connect_hook(SQLITE_PRAGMAS))
+        return new_engine
+
+    if dialect == "postgresql":
+        options = " ".join(f"-c {k}={v}" for k, v in POSTGRES_SESSION_SETTINGS.items())
+        connect_args = {"options": options, "application_name": "mawarizukan"}
+        if driver == "psycopg":
+            connect_args["prepare_threshold"] = POSTGRES_PREPARE_THRESHOLD
+        return create_engine(url, echo=echo, connect_args=connect_args, **POSTGRES_ENGINE_OPTIONS)
+
+    return create_engine(url, echo=echo)
+
+
+def _sqlite_connect_hook(pragmas):
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+    return set_sqlite_pragmas
+
+
+#---- エンジンは import 時ではなく最初に使うときに作る ----
+#gunicorn の preload_app でマスターが作ったエンジン（接続プール）は、
+#フォーク後の子プロセスで _reset_after_fork が捨てる（接続をプロセス間で共有しない）
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """このプロセスのエンジン。最初の呼び出しで作り、AUTO_MIGRATE ならスキーマも用意する"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                new_engine = make_engine(app.config["DATABASE_URL"])
+                if app.config["AUTO_MIGRATE"]:
+                    prepare_database(new_engine)
+                _engine = new_engine
+    return _engine
+
+
+def dispose_engine(close=True):
+    """エンジンを捨てる（次の get_engine() で作り直す）。close=False ならフォーク元の接続に触らない"""
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose(close=close)
+        _engine = None
+
+
+class LazySessionmaker(sessionmaker):
+    """Session() の時点で get_engine() を bind する sessionmaker"""
+
+    def __call__(self, **local_kw):
+        local_kw.setdefault("bind", get_engine())
+        return super().__call__(**local_kw)
+
+
+Session = LazySessionmaker()
 Base = declarative_base()
 
 
 #============================================
-#Cloudinary 設定（本番のみ）
+#Cloudinary 設定（本番のみ・最初に使うときに import + 設定）
 #============================================
-if IS_PRODUCTION:
-    cloudinary.config(
-        cloud_name=os.environ.get("CLOUDINARY_CLOUD_NAME"),
-        api_key=os.environ.get("CLOUDINARY_API_KEY"),
-        api_secret=os.environ.get("CLOUDINARY_API_SECRET")
-    )
+_cloudinary = None
+
+
+def cloudinary_api():
+    """cloudinary（api / uploader / utils 読み込み済み）を返す。import が重いので使うときまで遅らせる"""
+    global _cloudinary
+    if _cloudinary is None:
+        import cloudinary
+        import cloudinary.api
+        import cloudinary.uploader
+        import cloudinary.utils
+
+        if IS_PRODUCTION:
+            cloudinary.config(
+                cloud_name=os.environ.get("CLOUDINARY_CLOUD_NAME"),
+                api_key=os.environ.get("CLOUDINARY_API_KEY"),
+                api_secret=os.environ.get("CLOUDINARY_API_SECRET")
+            )
+        _cloudinary = cloudinary
+    return _cloudinary
 
 
 
@@ -72,31 +381,68 @@ if IS_PRODUCTION:
 #============================================
 class Person(Base):
     __tablename__ = "people"
+    __table_args__ = (
+        Index("ix_people_types", "mbti", "blood_type", "love_type"),
+        Index("ix_people_blood_type", "blood_type"),
+        Index("ix_people_love_type", "love_type"),
+        Index("ix_people_reading", "reading"),
+        Index("ix_people_birth_date", "birth_date"),
+        Index("ix_people_birth_md", "birth_md"),
+        Index("ix_people_image_path", "image_path"),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
     reading = Column(String)
-    birth = Column(String)
+    birth = Column(String)          #入力どおりの表示用（読めた日付は YYYY-MM-DD / MM-DD にそろえる）
+    birth_date = Column(Date)       #年まで分かる誕生日（年齢・誕生日順の並び替え用）
+    birth_md = Column(Integer)      #月 * 100 + 日（年が分からなくても入る。近い誕生日の検索用）
     blood_type = Column(String)
     mbti = Column(String)
     love_type = Column(String)
     phrase = Column(String)
     image_path = Column(String)
+    image_status = Column(String)  #画像ジョブの状態: pending / ready / failed（画像なしは None）
+
+    @validates("birth")
+    def _normalize_birth(self, key, value):
+        #birth を入れると birth_date / birth_md も同時に決まる（ORM 経由の書き込みすべて）
+        value, self.birth_date, self.birth_md = parse_birth(value)
+        return value
 
     #多対多のリレーション定義
+    #person_tags / relationships の行は外部キーの ON DELETE CASCADE で消えるので、
+    #削除時に ORM がリンクを読み込んで消したり NULL にしたりしない（passive_deletes）
     tags = relationship(
         "GroupTag",
         secondary="person_tags",
         back_populates="people",
         overlaps="person_tags,tag_links",
+        passive_deletes=True,
     )
     person_tags = relationship(
         "PersonTag",
         back_populates="person",
         overlaps="tags,people",
+        passive_deletes=True,
     )
 
 
+#並び替えキー（NULL を埋めた式）と、それと同じ式の (式, id) 複合インデックス。
+#ORDER BY / カーソル条件の式がインデックスの式と一致しないとインデックスが使われず全件ソートになるので、
+#埋める値はバインド変数ではなくリテラルで書き、ページングでも必ずこの式を使う
+PERSON_SORT_READING = func.coalesce(Person.reading, literal_column("''"))
+PERSON_SORT_NAME = func.coalesce(Person.name, literal_column("''"))
+PERSON_SORT_BIRTH = func.coalesce(Person.birth_date, literal_column("'9999-12-31'"))   #不明は最後
+PERSON_SORT_AGE = func.coalesce(Person.birth_date, literal_column("'0001-01-01'"))     #降順で不明は最後
+PERSON_SORT_BIRTHDAY = func.coalesce(Person.birth_md, literal_column("9999"))
+Index("ix_people_sort_reading", PERSON_SORT_READING, Person.id)
+Index("ix_people_sort_name", PERSON_SORT_NAME, Person.id)
+Index("ix_people_sort_birth", PERSON_SORT_BIRTH, Person.id)
+Index("ix_people_sort_age", PERSON_SORT_AGE, Person.id)
+Index("ix_people_sort_birthday", PERSON_SORT_BIRTHDAY, Person.id)
+
+
 class GroupTag(Base):
     __tablename__ = "group_tags"
 
@@ -108,16 +454,22 @@ class GroupTag(Base):
         secondary="person_tags",
         back_populates="tags",
         overlaps="person_tags,tag_links",
+        passive_deletes=True,
     )
     tag_links = relationship(
         "PersonTag",
         back_populates="tag",
         overlaps="people,tags",
+        passive_deletes=True,
     )
 
 
 class PersonTag(Base):
     __tablename__ = "person_tags"
+    __table_args__ = (
+        Index("uq_person_tags_person_tag", "person_id", "tag_id", unique=True),
+        Index("ix_person_tags_tag_person", "tag_id", "person_id"),
+    )
 
     id = Column(Integer, primary_key=True)
     person_id = Column(Integer, ForeignKey("people.id", ondelete="CASCADE"))
@@ -139,6 +491,11 @@ class PersonTag(Base):
 
 class Relationship(Base):
     __tablename__ = "relationships"
+    __table_args__ = (
+        #add_relation で (小さい id, 大きい id) に正規化して保存している
+        Index("uq_relationships_pair", "source_id", "target_id", unique=True),
+        Index("ix_relationships_target", "target_id"),
+    )
 
     id = Column(Integer, primary_key=True)
     source_id = Column(Integer, ForeignKey("people.id", ondelete="CASCADE"))
@@ -146,16 +503,345 @@ class Relationship(Base):
     relation_type = Column(String)
     strength = Column(Integer)
 
-    source = relationship("Person", foreign_keys=[source_id], backref="relations_from")
-    target = relationship("Person", foreign_keys=[target_id], backref="relations_to")
+    source = relationship(
+        "Person", foreign_keys=[source_id], backref=backref("relations_from", passive_deletes=True)
+    )
+    target = relationship(
+        "Person", foreign_keys=[target_id], backref=backref("relations_to", passive_deletes=True)
+    )
+
+
+class StatCounter(Base):
+    """統計ダッシュボード用の集計カウンター（登録・編集・削除と同じトランザクションで更新）"""
+    __tablename__ = "stat_counters"
+
+    category = Column(String, primary_key=True)  #"mbti" / "love" / "blood"
+    value = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
 
 
+class ImageJob(Base):
+    """画像アップロード・削除のバックグラウンドジョブ"""
+    __tablename__ = "image_jobs"
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)                        #"upload" / "delete" / "gc" / "layout"
+    idempotency_key = Column(String, unique=True, nullable=False)
+    payload = Column(Text, nullable=False)                       #JSON
+    status = Column(String, nullable=False, index=True)          #pending / running / done / failed
+    attempts = Column(Integer, nullable=False, default=0)
+    run_at = Column(Float, nullable=False)                       #この時刻（epoch 秒）以降に実行
+    locked_at = Column(Float)
+    created_at = Column(Float, nullable=False)
+    last_error = Column(String)
+
+
+class NodePosition(Base):
+    """関係性グラフの各ノードの座標（サーバー側で計算したレイアウトのキャッシュ）"""
+    __tablename__ = "node_positions"
+
+    person_id = Column(Integer, ForeignKey("people.id", ondelete="CASCADE"), primary_key=True)
+    x = Column(Float, nullable=False)
+    y = Column(Float, nullable=False)
+
+
+class GraphLayoutState(Base):
+    """レイアウトの版数（id=1 の 1 行だけ）"""
+    __tablename__ = "graph_layout_state"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(Float)
+
+
+class DataVersion(Base):
+    """データの版数（書き込みのたびに +1。ETag / Last-Modified の元になる）"""
+    __tablename__ = "data_versions"
+
+    scope = Column(String, primary_key=True)  #"global" / "people" / "tags" / "relations" / "layout" / "person:<id>"
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(Float, nullable=False)
+
+
+class ChangeLogEntry(Base):
+    """変更フィード（/api/changes）用の変更履歴。seq の順に読めば書き込みの順になる"""
+    __tablename__ = "change_log"
+    __table_args__ = (
+        Index("ix_change_log_created_at", "created_at"),
+        {"sqlite_autoincrement": True},   #消した seq を使い回さない
+    )
+
+    seq = Column(Integer, primary_key=True)
+    entity = Column(String, nullable=False)      #"person" / "tag" / "relation" / "layout"
+    entity_id = Column(Integer, nullable=False)
+    op = Column(String, nullable=False)          #"upsert" / "delete"
+    created_at = Column(Float, nullable=False)
+
+
+
+
+
+
+
+
+#============================================
+#スキーママイグレーション（バージョン管理）
+#============================================
+#create_all は既存テーブルにカラム・インデックスを足さないので、
+#稼働中の DB への変更はここに番号付きで追加していく（適用済みは schema_migrations に記録）
+MIGRATION_LOCK_ID = 0x6D6177   #PostgreSQL の advisory lock 用
+
+
+def create_model_index(conn, table_name, index_name):
+    """モデルに宣言したインデックスを（なければ）作る"""
+    index = next(
+        i for i in Base.metadata.tables[table_name].indexes if i.name == index_name
+    )
+    #式インデックスはリフレクションで見えず checkfirst が効かないので IF NOT EXISTS で作る
+    conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+def _migration_add_image_status(conn):
+    columns = {c["name"] for c in inspect(conn).get_columns("people")}
+    if "image_status" not in columns:
+        conn.execute(text("ALTER TABLE people ADD COLUMN image_status VARCHAR"))
+
+
+def _migration_unique_links(conn):
+    #person_tags の重複リンクを消してから一意インデックスを張る
+    conn.execute(text(
+        "DELETE FROM person_tags WHERE id NOT IN "
+        "(SELECT MIN(id) FROM person_tags GROUP BY person_id, tag_id)"
+    ))
+    create_model_index(conn, "person_tags", "uq_person_tags_person_tag")
+
+    #relationships は add_relation と同じく (小さい id, 大きい id) に正規化してから一意にする
+    conn.execute(text("DELETE FROM relationships WHERE source_id = target_id"))
+    conn.execute(text(
+        "DELETE FROM relationships WHERE source_id > target_id AND EXISTS ("
+        "SELECT 1 FROM relationships r2 "
+        "WHERE r2.source_id = relationships.target_id AND r2.target_id = relationships.source_id)"
+    ))
+    conn.execute(text(
+        "UPDATE relationships SET source_id = target_id, target_id = source_id "
+        "WHERE source_id > target_id"
+    ))
+    conn.execute(text(
+        "DELETE FROM relationships WHERE id NOT IN "
+        "(SELECT MIN(id) FROM relationships GROUP BY source_id, target_id)"
+    ))
+    create_model_index(conn, "relationships", "uq_relationships_pair")
+
+
+def _migration_lookup_indexes(conn):
+    create_model_index(conn, "person_tags", "ix_person_tags_tag_person")
+    create_model_index(conn, "relationships", "ix_relationships_target")
+    create_model_index(conn, "people", "ix_people_types")
+    create_model_index(conn, "people", "ix_people_blood_type")
+    create_model_index(conn, "people", "ix_people_love_type")
+    create_model_index(conn, "people", "ix_people_reading")
+
+
+def _migration_birth_dates(conn):
+    #文字列の birth を読んで birth_date / birth_md を埋める（読めた日付は表記もそろえる）
+    columns = {c["name"] for c in inspect(conn).get_columns("people")}
+    if "birth_date" not in columns:
+        conn.execute(text("ALTER TABLE people ADD COLUMN birth_date DATE"))
+    if "birth_md" not in columns:
+        conn.execute(text("ALTER TABLE people ADD COLUMN birth_md INTEGER"))
+
+    people = Person.__table__
+    stmt = (
+        update(people)
+        .where(people.c.id == bindparam("person_id"))
+        .values(birth=bindparam("birth"), birth_date=bindparam("birth_date"), birth_md=bindparam("birth_md"))
+    )
+    rows = conn.execute(
+        select(people.c.id, people.c.birth).where(people.c.birth.isnot(None), people.c.birth != "")
+    ).all()
+    for start in range(0, len(rows), 1000):
+        conn.execute(stmt, [
+            dict(birth_columns(birth), person_id=person_id)
+            for person_id, birth in rows[start:start + 1000]
+        ])
+    create_model_index(conn, "people", "ix_people_birth_date")
+    create_model_index(conn, "people", "ix_people_birth_md")
+
+
+def _migration_image_path_index(conn):
+    #画像の参照確認（削除・GC・ジョブ完了時の状態更新）を image_path で引く
+    create_model_index(conn, "people", "ix_people_image_path")
+
+
+def _migration_sort_indexes(conn):
+    #/api/people・/filter のキーセットページング用（ORDER BY と同じ式の複合インデックス）
+    for name in ("reading", "name", "birth", "age", "birthday"):
+        create_model_index(conn, "people", f"ix_people_sort_{name}")
+
+
+#(バージョン, 名前, 適用関数)。一度リリースしたものは書き換えず、末尾に追加する
+MIGRATIONS = [
+    (1, "add people.image_status", _migration_add_image_status),
+    (2, "unique person_tags / relationships pairs", _migration_unique_links),
+    (3, "lookup indexes for filter / stats / relations", _migration_lookup_indexes),
+    (4, "typed people.birth_date / birth_md", _migration_birth_dates),
+    (5, "people.image_path index", _migration_image_path_index),
+    (6, "keyset sort indexes", _migration_sort_indexes),
+]
+
+
+def applied_migrations(conn):
+    return {
+        row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))
+    }
+
+
+def run_migrations(target_engine=None):
+    """未適用のマイグレーションを番号順に 1 つずつトランザクションで適用し、適用した番号を返す"""
+    target_engine = target_engine or get_engine()
+    with target_engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at FLOAT NOT NULL)"
+        ))
+
+    applied = []
+    for version, name, migrate in MIGRATIONS:
+        with target_engine.begin() as conn:
+            #複数ワーカーが同時に起動しても 1 つずつ適用されるようにする
+            if conn.dialect.name == "postgresql":
+                conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+            if version in applied_migrations(conn):
+                continue
+            migrate(conn)
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, name, applied_at) VALUES (:v, :n, :t)"),
+                {"v": version, "n": name, "t": time.time()},
+            )
+            applied.append(version)
+            print(f"[INFO] migration {version} applied: {name}")
+    return applied
 
 
+def prepare_database(target_engine):
+    """テーブル作成（新しい DB 用）と未適用マイグレーションの適用。get_engine() から 1 回だけ呼ばれる"""
+    #既存テーブルの変更は上のマイグレーションで行う
+    Base.metadata.create_all(target_engine)
+    run_migrations(target_engine)
 
 
-#テーブル作成
-Base.metadata.create_all(engine)
+#============================================
+#クエリプランの確認（ホットなクエリがインデックスを使っているか）
+#============================================
+def hot_query_statements():
+    """(名前, SELECT 文, インデックスで引かれるべきテーブル) の一覧"""
+    return [
+        (
+            "filter: mbti + tags (EXISTS)",
+            select(Person.id).where(Person.mbti == "INTJ", tag_filter_clause([1, 2], "any")),
+            ["people", "person_tags"],
+        ),
+        (
+            "filter: blood_type",
+            select(Person.id).where(Person.blood_type == "A"),
+            ["people"],
+        ),
+        (
+            "stats_members: love_type",
+            stats_members_statement("love", "LCRO"),
+            ["people"],
+        ),
+        (
+            "stats_members: tag",
+            stats_members_statement("tag", "tag"),
+            ["people", "person_tags", "group_tags"],
+        ),
+        (
+            "relations: edges of a person",
+            select(Relationship.id).where(
+                or_(Relationship.source_id == 1, Relationship.target_id == 1)
+            ),
+            ["relationships"],
+        ),
+        (
+            "add_relation: pair lookup",
+            select(Relationship.id).where(
+                Relationship.source_id == 1, Relationship.target_id == 2
+            ),
+            ["relationships"],
+        ),
+        (
+            "edit: tag lookup",
+            select(PersonTag.tag_id).where(PersonTag.person_id == 1),
+            ["person_tags"],
+        ),
+        (
+            "images: referenced image_path",
+            select(Person.image_path).where(Person.image_path.in_(["/static/uploads/a.webp"])),
+            ["people"],
+        ),
+    ] + [
+        #キーセットページングの 2 ページ目以降（インデックスの範囲検索だけで、並べ替えをしないこと）
+        (
+            f"people page: sort={sort}",
+            select(Person.id).where(*keyset_after(sort, last_value, 1)).order_by(*keyset_order(sort)).limit(100),
+            ["people"],
+        )
+        for sort, last_value in (
+            ("reading", "あ"), ("name", "a"), ("birth", "1990-01-01"),
+            ("age", "1990-01-01"), ("birthday", 401),
+        )
+    ]
+
+
+def _plan_scanned_tables(conn, sql):
+    """実行計画を取り、(計画テキスト, 全件走査されたテーブル, 参照されたテーブル) を返す"""
+    if conn.dialect.name == "sqlite":
+        rows = conn.execute(text(f"EXPLAIN QUERY PLAN {sql}")).all()
+        details = [row[-1] for row in rows]
+        scanned, touched = set(), set()
+        for detail in details:
+            m = re.match(r"(SCAN|SEARCH) (?:TABLE )?(\w+)", detail)
+            if m:
+                touched.add(m.group(2))
+                if m.group(1) == "SCAN":
+                    scanned.add(m.group(2))
+        return "\n".join(details), scanned, touched
+
+    #PostgreSQL: 小さいテーブルだと seq scan を選ぶので、使える索引があるかを見るため無効化する
+    conn.execute(text("SET LOCAL enable_seqscan = off"))
+    plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql}")).scalar()
+    scanned, touched = set(), set()
+
+    def walk(node):
+        relation = node.get("Relation Name")
+        if relation:
+            touched.add(relation)
+            if node["Node Type"] == "Seq Scan":
+                scanned.add(relation)
+        for child in node.get("Plans", []):
+            walk(child)
+
+    walk(plan[0]["Plan"])
+    return json.dumps(plan, indent=1), scanned, touched
+
+
+def check_query_plans(target_engine=None):
+    """
+    ホットなクエリの実行計画を調べ、(名前, OK か, 計画テキスト) のリストを返す。
+    期待したテーブルが全件走査されていたら NG。ORDER BY をインデックスで済ませず並べ替えていても NG
+    """
+    target_engine = target_engine or get_engine()
+    results = []
+    with target_engine.connect() as conn:
+        for name, stmt, expected_tables in hot_query_statements():
+            sql = str(stmt.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True}))
+            with conn.begin():
+                plan_text, scanned, touched = _plan_scanned_tables(conn, sql)
+            sorts = "TEMP B-TREE FOR ORDER BY" in plan_text or '"Node Type": "Sort"' in plan_text
+            ok = all(t in touched and t not in scanned for t in expected_tables) and not sorts
+            results.append((name, ok, plan_text))
+    return results
 
 
 #============================================
@@ -197,58 +883,606 @@ RELATION_TYPE_LABELS.update({
 #============================================================
 #画像アップロード（Cloudinary or ローカル自動切り替え）
 #============================================================
-def upload_image(file_storage):
-    """本番は Cloudinary、ローカルは /static/uploads に保存"""
+#派生画像のサイズ（正方形にトリミング、px）。表示は 110px 前後の円なので 2x 程度に抑える
+IMAGE_SIZES = {
+    "node": 96,     #関係性グラフのノード・相性診断のアイコン
+    "card": 240,    #図鑑カード
+    "modal": 480,   #詳細モーダル・編集画面
+}
+#image_path にはこのサイズの URL を保存し、他サイズは名前から導く
+IMAGE_MASTER_SIZE = "modal"
+IMAGE_FORMAT = "webp" if features.check("webp") else "jpeg"
+IMAGE_EXT = {"webp": "webp", "jpeg": "jpg"}[IMAGE_FORMAT]
+IMAGE_QUALITY = 82
+IMAGE_SAVE_OPTIONS = {"webp": {"method": 4}, "jpeg": {"optimize": True, "progressive": True}}[IMAGE_FORMAT]
+IMAGE_HASH_LENGTH = 16
+CLOUDINARY_FOLDER = "mawarizukan"
+
+#1 回の API 呼び出しで消す最大件数（Cloudinary の delete_resources の上限）
+IMAGE_DELETE_BATCH = 100
+
+#派生画像の URL（ローカル / Cloudinary 共通）: .../<hash>_<size>.<ext>
+IMAGE_VARIANT_RE = re.compile(
+    r"^(?P<base>.*/(?P<hash>[0-9a-f]{%d}))_(?P<size>%s)\.(?P<ext>webp|jpg)$"
+    % (IMAGE_HASH_LENGTH, "|".join(IMAGE_SIZES))
+)
+#ストレージ上の派生画像のファイル名: <hash>_<size>.<ext>（GC が消してよいのはこの名前のものだけ）
+IMAGE_FILE_RE = re.compile(
+    r"^(?P<hash>[0-9a-f]{%d})_(?P<size>%s)\.(?P<ext>webp|jpg)$"
+    % (IMAGE_HASH_LENGTH, "|".join(IMAGE_SIZES))
+)
 
-    if not file_storage:
-        return None
 
-    #-----------------------
-    #本番（Render）→ Cloudinary
-    #-----------------------
-    if IS_PRODUCTION:
+def render_image_variants(raw):
+    """
+    アップロード画像を 1 回だけデコードし、EXIF の向きを反映・メタデータを落とした
+    各サイズの派生画像を {サイズ名: エンコード済み bytes} で返す
+    """
+    with Image.open(io.BytesIO(raw)) as img:
+        img = ImageOps.exif_transpose(img)
+        img = img.convert("RGBA" if IMAGE_FORMAT == "webp" and "A" in img.getbands() else "RGB")
+
+        variants = {}
+        #大きい順に縮小して、次のサイズは直前の結果から作る
+        source = img
+        for size_name, px in sorted(IMAGE_SIZES.items(), key=lambda item: -item[1]):
+            source = ImageOps.fit(source, (px, px), Image.Resampling.LANCZOS)
+            buf = io.BytesIO()
+            #exif / icc を渡さないので保存時にメタデータは残らない
+            source.save(buf, IMAGE_FORMAT, quality=IMAGE_QUALITY, **IMAGE_SAVE_OPTIONS)
+            variants[size_name] = buf.getvalue()
+        return variants
+
+
+def image_variant_name(content_hash, size_name):
+    return f"{content_hash}_{size_name}.{IMAGE_EXT}"
+
+
+def cloudinary_public_id(content_hash, size_name):
+    return f"{CLOUDINARY_FOLDER}/{content_hash}_{size_name}"
+
+
+#============================================================
+#画像ストレージ（Cloudinary / ローカル）
+#============================================================
+class LocalImageStorage:
+    """
+    static/uploads に保存するストレージ。
+    latency / failure_rate を指定すると遅い・不安定な CDN の代わりとして負荷試験に使える。
+    """
+
+    def __init__(self, folder, url_prefix="/static/uploads", latency=0.0, failure_rate=0.0):
+        self.folder = folder
+        self.url_prefix = url_prefix
+        self.latency = latency
+        self.failure_rate = failure_rate
+
+    def _simulate(self):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise OSError("simulated storage failure")
+
+    def url(self, name):
+        return f"{self.url_prefix}/{name}"
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.folder, name))
+
+    def put(self, name, data):
+        self._simulate()
+        os.makedirs(self.folder, exist_ok=True)
+        #途中で落ちても壊れたファイルが残らないよう一時ファイル経由で置き換える
+        path = os.path.join(self.folder, name)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def delete_many(self, names):
+        for start in range(0, len(names), IMAGE_DELETE_BATCH):
+            self._simulate()
+            for name in names[start:start + IMAGE_DELETE_BATCH]:
+                try:
+                    os.remove(os.path.join(self.folder, name))
+                except FileNotFoundError:
+                    pass
+
+    def delete_legacy(self, image_urls):
+        #パイプライン導入前のローカル画像は従来どおり残す
+        pass
+
+    def list_page(self, cursor, limit):
+        """
+        派生画像を名前順に cursor（前ページ最後の名前）の次から limit 件、
+        ([(名前, 更新時刻), ...], 次の cursor または None) で返す
+        """
         try:
-            result = cloudinary.uploader.upload(file_storage)
-            return result["secure_url"]
-        except Exception as e:
-            print("[Cloudinary ERROR]", e)
-            #必要なら fallback を入れてもいい（ローカル保存など）
-            return None
+            entries = [
+                entry for entry in os.scandir(self.folder)
+                if IMAGE_FILE_RE.match(entry.name) and (cursor is None or entry.name > cursor)
+            ]
+        except FileNotFoundError:
+            return [], None
+        page = heapq.nsmallest(limit, entries, key=lambda entry: entry.name)
+        files = [(entry.name, entry.stat().st_mtime) for entry in page]
+        return files, (files[-1][0] if len(entries) > limit else None)
+
+
+class CloudinaryImageStorage:
+    """Cloudinary に保存するストレージ（public_id = フォルダ/ファイル名の拡張子なし）"""
+
+    @staticmethod
+    def _public_id(name):
+        return f"{CLOUDINARY_FOLDER}/{name.rsplit('.', 1)[0]}"
+
+    def url(self, name):
+        return cloudinary_api().utils.cloudinary_url(
+            self._public_id(name), format=name.rsplit(".", 1)[1], secure=True
+        )[0]
+
+    def exists(self, name):
+        #存在確認は API 呼び出しになるので、重複はジョブの冪等キーで防ぐ
+        return False
+
+    def put(self, name, data):
+        #overwrite=False なので同じ public_id が既にあればアップロードされない
+        cloudinary_api().uploader.upload(
+            data, public_id=self._public_id(name), overwrite=False, resource_type="image"
+        )
+
+    @staticmethod
+    def _destroy_many(public_ids):
+        #1 件ずつ destroy せず、delete_resources で IMAGE_DELETE_BATCH 件ずつまとめて消す
+        for start in range(0, len(public_ids), IMAGE_DELETE_BATCH):
+            batch = public_ids[start:start + IMAGE_DELETE_BATCH]
+            cloudinary_api().api.delete_resources(batch, resource_type="image", type="upload")
+            print(f"[INFO] Cloudinary images deleted: {len(batch)}")
+
+    def delete_many(self, names):
+        self._destroy_many([self._public_id(name) for name in names])
+
+    def delete_legacy(self, image_urls):
+        self._destroy_many([
+            public_id for public_id in map(cloudinary_public_id_from_url, image_urls) if public_id
+        ])
+
+    def list_page(self, cursor, limit):
+        """CLOUDINARY_FOLDER 内の派生画像を 1 ページ分（cursor は Cloudinary の next_cursor）"""
+        options = {"next_cursor": cursor} if cursor else {}
+        result = cloudinary_api().api.resources(
+            type="upload", resource_type="image", prefix=f"{CLOUDINARY_FOLDER}/", max_results=limit, **options
+        )
+        files = []
+        for resource in result.get("resources", []):
+            name = f"{resource['public_id'].rsplit('/', 1)[-1]}.{resource['format']}"
+            if IMAGE_FILE_RE.match(name):
+                created = datetime.fromisoformat(resource["created_at"].replace("Z", "+00:00"))
+                files.append((name, created.timestamp()))
+        return files, result.get("next_cursor")
+
+
+def make_image_storage():
+    """IMAGE_STORAGE（cloudinary / local）に応じたストレージを返す"""
+    kind = os.environ.get("IMAGE_STORAGE", "cloudinary" if IS_PRODUCTION else "local")
+    if kind == "cloudinary":
+        return CloudinaryImageStorage()
+    return LocalImageStorage(
+        UPLOAD_FOLDER,
+        latency=float(os.environ.get("IMAGE_STORAGE_LATENCY", "0")),
+        failure_rate=float(os.environ.get("IMAGE_STORAGE_FAILURE_RATE", "0")),
+    )
 
-    #-----------------------
-    #ローカル環境 → static/uploads へ保存
-    #-----------------------
-    filename = secure_filename(file_storage.filename)
-    save_dir = "static/uploads"
-    os.makedirs(save_dir, exist_ok=True)
 
-    save_path = os.path.join(save_dir, filename)
-    file_storage.save(save_path)
+image_storage = make_image_storage()
 
-    return f"/static/uploads/{filename}"
 
-def delete_cloudinary_image_by_url(image_url):
+def upload_image(file_storage, session):
     """
-    Cloudinary の画像 URL から public_id を抽出して削除する関数。
-    本番のときだけ動く。ローカル画像は何もしない。
+    アップロード画像の派生画像を作り、保存ジョブを session に積む（commit は呼び出し側）。
+    派生画像は内容ハッシュ名なので、同じ画像の再アップロードは使い回す。
+    戻り値は (IMAGE_MASTER_SIZE の URL, 画像ステータス)。不正な画像なら (None, None)
     """
-    if not image_url:
-        return
 
-    #ローカル保存の場合は処理不要
-    if not IS_PRODUCTION:
-        return
+    if not file_storage or not file_storage.filename:
+        return None, None
+
+    raw = file_storage.read()
+    if not raw:
+        return None, None
+    content_hash = hashlib.sha256(raw).hexdigest()[:IMAGE_HASH_LENGTH]
+    master_url = image_storage.url(image_variant_name(content_hash, IMAGE_MASTER_SIZE))
+
+    #同じ内容が保存済み・保存待ちならデコードもしない
+    if image_storage.exists(image_variant_name(content_hash, IMAGE_MASTER_SIZE)):
+        return master_url, IMAGE_STATUS_READY
+    existing = session.query(ImageJob).filter_by(idempotency_key=f"upload:{content_hash}").first()
+    if existing and existing.status in (JOB_PENDING, JOB_RUNNING):
+        return master_url, IMAGE_STATUS_PENDING
+    if existing and existing.status == JOB_DONE:
+        return master_url, IMAGE_STATUS_READY
 
     try:
-        #URL例:
-        #https://res.cloudinary.com/xxx/image/upload/v1234567890/abcdef.png
-        public_id = image_url.split("/")[-1].split(".")[0]
+        variants = render_image_variants(raw)
+    except (OSError, Image.DecompressionBombError) as e:
+        print("[Image ERROR]", e)
+        return None, None
+
+    enqueue_image_job(
+        session,
+        JOB_UPLOAD,
+        f"upload:{content_hash}",
+        {
+            "url": master_url,
+            "files": {
+                image_variant_name(content_hash, size_name): base64.b64encode(data).decode("ascii")
+                for size_name, data in variants.items()
+            },
+        },
+    )
+    return master_url, IMAGE_STATUS_PENDING
+
+
+def delete_image(session, image_url):
+    """画像の削除ジョブを session に積む（commit は呼び出し側）"""
+    if image_url:
+        delete_images(session, [image_url])
+
+
+def delete_images(session, image_urls):
+    """
+    複数の画像の削除ジョブを session に積む（commit は呼び出し側）。
+    ジョブ 1 件 = ストレージへの削除 1 回分（IMAGE_DELETE_BATCH 件）になるよう URL を分ける
+    """
+    image_urls = sorted(set(filter(None, image_urls)))
+    per_job = max(IMAGE_DELETE_BATCH // len(IMAGE_SIZES), 1)
+    for start in range(0, len(image_urls), per_job):
+        batch = image_urls[start:start + per_job]
+        if len(batch) == 1:
+            key = f"delete:{batch[0]}"
+        else:
+            key = "delete:" + hashlib.sha256("\n".join(batch).encode("utf-8")).hexdigest()
+        enqueue_image_job(session, JOB_DELETE, key, {"urls": batch})
+
+
+def unreferenced_images(session, image_urls):
+    """image_urls のうち、どの人物の image_path にも使われていないもの（flush 済みの状態で判定）"""
+    image_urls = set(filter(None, image_urls))
+    if not image_urls:
+        return set()
+    in_use = session.scalars(
+        select(Person.image_path).where(Person.image_path.in_(image_urls)).distinct()
+    )
+    return image_urls - set(in_use)
+
+
+def image_variants(image_path):
+    """
+    image_path から各サイズの URL を返す。
+    パイプライン導入前の画像（派生なし）は全サイズ同じ URL にする。
+    """
+    if not image_path:
+        return {size_name: None for size_name in IMAGE_SIZES}
+
+    m = IMAGE_VARIANT_RE.match(image_path)
+    if not m:
+        return {size_name: image_path for size_name in IMAGE_SIZES}
+
+    return {
+        size_name: f"{m.group('base')}_{size_name}.{m.group('ext')}"
+        for size_name in IMAGE_SIZES
+    }
+
+
+def shown_image_path(image_path, image_status):
+    """保存が終わるまで（失敗時も）は画像なし扱いにしてプレースホルダーを出す"""
+    if image_status in (IMAGE_STATUS_PENDING, IMAGE_STATUS_FAILED):
+        return None
+    return image_path
+
+
+#Cloudinary の配信 URL: .../image/upload/[変換/...][v<版>/]<public_id>.<拡張子>
+CLOUDINARY_URL_RE = re.compile(r"^https?://res\.cloudinary\.com/[^/]+/image/upload/(?P<path>[^?#]+)")
+CLOUDINARY_VERSION_RE = re.compile(r"^v\d+$")
+CLOUDINARY_TRANSFORMATION_RE = re.compile(r"^[a-z]{1,3}_[^/]*$")
 
-        cloudinary.uploader.destroy(public_id)
-        print(f"[INFO] Cloudinary image deleted: {public_id}")
 
+def cloudinary_public_id_from_url(image_url):
+    """
+    Cloudinary の画像 URL から public_id（フォルダ込み・拡張子なし）を取り出す（派生画像導入前の URL 用）。
+    Cloudinary の URL でなければ None
+    """
+    m = CLOUDINARY_URL_RE.match(image_url or "")
+    if not m:
+        return None
+
+    #例: https://res.cloudinary.com/xxx/image/upload/c_fill,w_200/v1234567890/folder/abcdef.png
+    segments = [unquote(segment) for segment in m.group("path").split("/")]
+    versions = [i for i, segment in enumerate(segments) if CLOUDINARY_VERSION_RE.match(segment)]
+    if versions:
+        segments = segments[versions[0] + 1:]
+    else:
+        while len(segments) > 1 and CLOUDINARY_TRANSFORMATION_RE.match(segments[0]):
+            segments = segments[1:]
+    segments[-1] = segments[-1].rsplit(".", 1)[0]
+    return "/".join(segments) or None
+
+
+#============================================================
+#画像ジョブキュー（DB 永続・バックグラウンドスレッドで実行）
+#============================================================
+JOB_UPLOAD = "upload"
+JOB_DELETE = "delete"
+JOB_GC = "gc"
+JOB_LAYOUT = "layout"   #関係性グラフのレイアウト計算（画像ではないが同じキュー・ワーカーで流す）
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+IMAGE_STATUS_PENDING = "pending"
+IMAGE_STATUS_READY = "ready"
+IMAGE_STATUS_FAILED = "failed"
+
+IMAGE_JOB_WORKERS = int(os.environ.get("IMAGE_JOB_WORKERS", "2"))
+IMAGE_JOB_MAX_ATTEMPTS = int(os.environ.get("IMAGE_JOB_MAX_ATTEMPTS", "6"))
+IMAGE_JOB_BACKOFF = 2.0          #秒。attempts 回目の失敗後は BACKOFF * 2^(attempts-1) 待つ
+IMAGE_JOB_BACKOFF_MAX = 600.0
+IMAGE_JOB_POLL_INTERVAL = 2.0
+IMAGE_JOB_LOCK_TIMEOUT = 300.0   #running のまま止まったジョブを取り直すまでの秒数
+
+#孤立画像の GC（ストレージを 1 ページずつ列挙して、どの人物にも使われていない派生画像を消す）
+IMAGE_GC_KEY = "gc:images"
+IMAGE_GC_PAGE_SIZE = _env_int("IMAGE_GC_PAGE_SIZE", 100)
+IMAGE_GC_MIN_AGE = _env_int("IMAGE_GC_MIN_AGE_SECONDS", 3600)   #これより新しいファイルは消さない
+
+_image_job_wakeup = threading.Event()
+_image_workers = []
+_image_workers_lock = threading.Lock()
+
+
+def enqueue_image_job(session, kind, idempotency_key, payload):
+    """
+    冪等キー付きでジョブを積む。同じキーのジョブがあれば作り直さず再実行待ちに戻す。
+    commit 後に notify_image_workers() を呼ぶと待たずに実行される。
+    """
+    job = session.query(ImageJob).filter_by(idempotency_key=idempotency_key).first()
+    now = time.time()
+    if job is None:
+        job = ImageJob(kind=kind, idempotency_key=idempotency_key, created_at=now)
+        session.add(job)
+    elif job.status in (JOB_PENDING, JOB_RUNNING):
+        return job
+
+    job.payload = json.dumps(payload)
+    job.status = JOB_PENDING
+    job.attempts = 0
+    job.run_at = now
+    job.locked_at = None
+    job.last_error = None
+    return job
+
+
+def notify_image_workers():
+    """新しいジョブがあることをワーカースレッドに知らせる"""
+    start_image_workers()
+    _image_job_wakeup.set()
+
+
+def claim_image_job(session):
+    """
+    実行可能なジョブを 1 件取って running にする。
+    status を条件にした UPDATE の件数で取り合いを判定するので、複数ワーカー・複数プロセスでも安全。
+    """
+    now = time.time()
+    candidates = (
+        session.query(ImageJob.id)
+        .filter(or_(
+            and_(ImageJob.status == JOB_PENDING, ImageJob.run_at <= now),
+            and_(ImageJob.status == JOB_RUNNING, ImageJob.locked_at < now - IMAGE_JOB_LOCK_TIMEOUT),
+        ))
+        .order_by(ImageJob.id)
+        .limit(5)
+        .all()
+    )
+    for (job_id,) in candidates:
+        claimed = (
+            session.query(ImageJob)
+            .filter(ImageJob.id == job_id, or_(
+                ImageJob.status == JOB_PENDING,
+                and_(ImageJob.status == JOB_RUNNING, ImageJob.locked_at < now - IMAGE_JOB_LOCK_TIMEOUT),
+            ))
+            .update(
+                {ImageJob.status: JOB_RUNNING, ImageJob.locked_at: now,
+                 ImageJob.attempts: ImageJob.attempts + 1},
+                synchronize_session=False,
+            )
+        )
+        session.commit()
+        if claimed:
+            return session.get(ImageJob, job_id)
+    return None
+
+
+def execute_image_job(session, job):
+    """ジョブ 1 件分のストレージ操作（失敗したら例外）"""
+    payload = json.loads(job.payload)
+
+    if job.kind == JOB_UPLOAD:
+        #マスターサイズを最後に置く（exists() はマスターの有無で保存済みを判定するため）
+        master_suffix = f"_{IMAGE_MASTER_SIZE}.{IMAGE_EXT}"
+        for name in sorted(payload["files"], key=lambda n: n.endswith(master_suffix)):
+            image_storage.put(name, base64.b64decode(payload["files"][name]))
+        session.query(Person).filter_by(image_path=payload["url"]).update(
+            {Person.image_status: IMAGE_STATUS_READY}, synchronize_session=False
+        )
+        bump_image_owner_versions(session, payload["url"])
+        #保存済みになったら画像本体は不要
+        payload["files"] = {name: None for name in payload["files"]}
+        job.payload = json.dumps(payload)
+
+    elif job.kind == JOB_DELETE:
+        #積んだあとで同じ画像がまた使われるようになっていたら残す（"url" は 1 件ずつ積んでいた頃のジョブ）
+        urls = sorted(unreferenced_images(session, payload.get("urls") or [payload["url"]]))
+        matches = [IMAGE_VARIANT_RE.match(url) for url in urls]
+        hashes = [m.group("hash") for m in matches if m]
+        image_storage.delete_many([
+            image_variant_name(content_hash, size_name)
+            for content_hash in hashes for size_name in IMAGE_SIZES
+        ])
+        image_storage.delete_legacy([url for url, m in zip(urls, matches) if not m])
+        forget_uploads(session, hashes)
+
+    elif job.kind == JOB_GC:
+        run_image_gc(session, job)
+
+    elif job.kind == JOB_LAYOUT:
+        #済んだレイアウトジョブの行はためない（積むたびに別のキーになるため）
+        session.query(ImageJob).filter(
+            ImageJob.kind == JOB_LAYOUT, ImageJob.status == JOB_DONE
+        ).delete(synchronize_session=False)
+        compute_layout(session, dirty_ids=payload["dirty"])
+
+
+def forget_uploads(session, content_hashes):
+    """同じ画像を再アップロードしたときに「保存済み」と誤判定しないよう、アップロードジョブを消す"""
+    if content_hashes:
+        session.query(ImageJob).filter(
+            ImageJob.idempotency_key.in_([f"upload:{h}" for h in content_hashes])
+        ).delete(synchronize_session=False)
+
+
+def start_image_gc(session):
+    """
+    孤立画像の GC ジョブを積む（commit は呼び出し側）。待ち・実行中のものがあればそれを返し、
+    失敗で止まったものは保存してある位置から続ける
+    """
+    job = session.query(ImageJob).filter_by(idempotency_key=IMAGE_GC_KEY).first()
+    if job and job.status == JOB_FAILED:
+        progress = json.loads(job.payload)
+    else:
+        progress = {"cursor": None, "scanned": 0, "deleted": 0, "started_at": time.time()}
+    return enqueue_image_job(session, JOB_GC, IMAGE_GC_KEY, progress)
+
+
+def run_image_gc(session, job):
+    """
+    ストレージの派生画像を IMAGE_GC_PAGE_SIZE 件ずつ列挙し、どの人物の image_path からも
+    参照されておらず、アップロード待ちでもないものをまとめて消す。
+    ページごとに進み具合（cursor）を commit するので、途中で落ちても再実行で続きから再開する
+    """
+    progress = json.loads(job.payload)
+    while True:
+        files, next_cursor = image_storage.list_page(progress["cursor"], IMAGE_GC_PAGE_SIZE)
+
+        #アップロード直後（人物の保存とジョブの完了の間）のファイルは対象外
+        cutoff = time.time() - IMAGE_GC_MIN_AGE
+        names_by_hash = {}
+        for name, modified_at in files:
+            if modified_at < cutoff:
+                names_by_hash.setdefault(IMAGE_FILE_RE.match(name).group("hash"), []).append(name)
+        master_urls = {
+            image_storage.url(image_variant_name(content_hash, IMAGE_MASTER_SIZE)): content_hash
+            for content_hash in names_by_hash
+        }
+        orphans = {master_urls[url] for url in unreferenced_images(session, master_urls)}
+        orphans -= {
+            key.split(":", 1)[1] for (key,) in session.query(ImageJob.idempotency_key).filter(
+                ImageJob.idempotency_key.in_([f"upload:{h}" for h in orphans]),
+                ImageJob.status.in_((JOB_PENDING, JOB_RUNNING)),
+            )
+        }
+
+        names = sorted(name for content_hash in orphans for name in names_by_hash[content_hash])
+        image_storage.delete_many(names)
+        forget_uploads(session, sorted(orphans))
+
+        progress["cursor"] = next_cursor
+        progress["scanned"] += len(files)
+        progress["deleted"] += len(names)
+        job.payload = json.dumps(progress)
+        #長く走っても他のワーカーに取り直されないよう、ページごとにロック時刻も更新する
+        job.locked_at = time.time()
+        session.commit()
+        if next_cursor is None:
+            print(f"[INFO] image GC finished: scanned={progress['scanned']} deleted={progress['deleted']}")
+            return
+
+
+def bump_image_owner_versions(session, image_url):
+    """画像の状態が変わった人物の版数を上げる（person_to_dict の images が変わるため）"""
+    person_ids = [person_id for (person_id,) in session.query(Person.id).filter_by(image_path=image_url)]
+    bump_data_versions(session, "people", *[f"person:{person_id}" for person_id in person_ids])
+    record_changes(session, "person", person_ids)
+
+
+def run_image_job(session, job):
+    """ジョブを実行し、結果に応じて done / 再試行待ち / failed にする"""
+    try:
+        execute_image_job(session, job)
+        job.status = JOB_DONE
+        job.last_error = None
     except Exception as e:
-        print("[ERROR] Failed to delete Cloudinary image:", e)
+        session.rollback()
+        job = session.get(ImageJob, job.id)
+        job.last_error = f"{type(e).__name__}: {e}"[:500]
+        print(f"[ImageJob ERROR] job={job.id} attempt={job.attempts}:", e)
+
+        if job.attempts >= IMAGE_JOB_MAX_ATTEMPTS:
+            job.status = JOB_FAILED
+            if job.kind == JOB_UPLOAD:
+                failed_url = json.loads(job.payload)["url"]
+                session.query(Person).filter_by(
+                    image_path=failed_url
+                ).update({Person.image_status: IMAGE_STATUS_FAILED}, synchronize_session=False)
+                bump_image_owner_versions(session, failed_url)
+        else:
+            #指数バックオフ + ゆらぎ（複数ワーカーが同時に再試行しないように）
+            delay = min(IMAGE_JOB_BACKOFF * 2 ** (job.attempts - 1), IMAGE_JOB_BACKOFF_MAX)
+            job.status = JOB_PENDING
+            job.run_at = time.time() + delay * random.uniform(0.8, 1.2)
+    job.locked_at = None
+    session.commit()
+
+
+def process_image_jobs(max_jobs=None):
+    """実行可能なジョブがなくなるまで（または max_jobs 件）処理して件数を返す"""
+    processed = 0
+    session = Session()
+    try:
+        while max_jobs is None or processed < max_jobs:
+            job = claim_image_job(session)
+            if job is None:
+                break
+            run_image_job(session, job)
+            processed += 1
+    finally:
+        session.close()
+    return processed
+
+
+def _image_worker_loop():
+    while True:
+        try:
+            if process_image_jobs() == 0:
+                _image_job_wakeup.wait(IMAGE_JOB_POLL_INTERVAL)
+                _image_job_wakeup.clear()
+        except Exception as e:
+            print("[ImageJob ERROR] worker loop:", e)
+            time.sleep(IMAGE_JOB_POLL_INTERVAL)
+
+
+def start_image_workers():
+    """このプロセスのワーカースレッドを（まだなら）起動する。IMAGE_JOB_WORKERS=0 で無効"""
+    if _image_workers or IMAGE_JOB_WORKERS <= 0:
+        return
+    with _image_workers_lock:
+        if _image_workers:
+            return
+        for i in range(IMAGE_JOB_WORKERS):
+            t = threading.Thread(target=_image_worker_loop, name=f"image-job-{i}", daemon=True)
+            t.start()
+            _image_workers.append(t)
 
 
 
@@ -263,6 +1497,35 @@ def get_tag_names_for_person(session, person_id: int):
     return [t.name for t in tags]
 
 
+def sync_person_tags(session, desired, current=None):
+    """
+    {person_id: 付けたいタグ id の集合} に合わせて、増えたリンクだけ INSERT・
+    外れたリンクだけ DELETE する（commit は呼び出し側）。
+    current を省略すると 1 クエリで今のリンクを読む。戻り値は (追加数, 削除数)
+    """
+    if current is None:
+        current = {person_id: set() for person_id in desired}
+        if desired:
+            for person_id, tag_id in session.query(PersonTag.person_id, PersonTag.tag_id).filter(
+                PersonTag.person_id.in_(list(desired))
+            ):
+                current[person_id].add(tag_id)
+
+    added, removed = [], []
+    for person_id, tag_ids in desired.items():
+        before = set(current.get(person_id, ()))
+        added.extend({"person_id": person_id, "tag_id": tag_id} for tag_id in set(tag_ids) - before)
+        removed.extend((person_id, tag_id) for tag_id in before - set(tag_ids))
+
+    if removed:
+        session.query(PersonTag).filter(
+            tuple_(PersonTag.person_id, PersonTag.tag_id).in_(removed)
+        ).delete(synchronize_session=False)
+    if added:
+        session.execute(insert(PersonTag), added)
+    return len(added), len(removed)
+
+
 def person_to_dict(person, tags=None):
     """Person モデルを API / テンプレート用の dict に変換"""
     if tags is None:
@@ -282,89 +1545,2263 @@ def person_to_dict(person, tags=None):
         "love_type": person.love_type,
         "phrase": person.phrase,
         "image_path": person.image_path,
+        "image_status": person.image_status,
+        "images": image_variants(shown_image_path(person.image_path, person.image_status)),
         "tags": tags,
     }
 
 
-#============================================
-#ページ系ルート
-#============================================
+#---- 誕生日（自由入力の文字列 → 日付・月日キー）----
+#「1990-04-01」「1990/4/1」「1990年4月1日」「19900401」「平成2年4月1日」「H2.4.1」のほか、
+#年なしの「4/1」「4月1日」も読む（年なしは birth_date を空にして birth_md だけ入れる）
+_BIRTH_ERAS = {
+    "明治": 1867, "大正": 1911, "昭和": 1925, "平成": 1988, "令和": 2018,
+    "m": 1867, "t": 1911, "s": 1925, "h": 1988, "r": 2018,
+}
+_BIRTH_FULL_RE = re.compile(r"^(\d{4})[-/.年](\d{1,2})[-/.月](\d{1,2})日?$")
+_BIRTH_COMPACT_RE = re.compile(r"^(\d{4})(\d{2})(\d{2})$")
+_BIRTH_ERA_RE = re.compile(r"^(明治|大正|昭和|平成|令和|[mtshr])(\d{1,2}|元)[年.](\d{1,2})[月.](\d{1,2})日?$")
+_BIRTH_MONTH_DAY_RE = re.compile(r"^(?:--)?(\d{1,2})[-/.月](\d{1,2})日?$")
+#「今日」を決めるタイムゾーン（サーバーが UTC でも日本の日付で誕生日を数える）
+APP_TIMEZONE = os.environ.get("APP_TIMEZONE", "Asia/Tokyo")
+UPCOMING_BIRTHDAYS_DEFAULT_DAYS = 30
+UPCOMING_BIRTHDAYS_MAX_DAYS = 366
 
-@event.listens_for(engine, "connect")
-def enable_sqlite_fk_constraints(dbapi_connection, connection_record):
-    cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA foreign_keys=ON")
-    cursor.close()
 
+def parse_birth(raw):
+    """
+    birth の文字列を (表示用の文字列, date または None, 月 * 100 + 日 または None) にする。
+    読めないものは元の文字列のまま残し、日付は None（手入力の古いデータを消さない）
+    """
+    raw = (raw or "").strip()
+    text_value = "".join(unicodedata.normalize("NFKC", raw).lower().split())
+    year = None
+    m = _BIRTH_FULL_RE.match(text_value) or _BIRTH_COMPACT_RE.match(text_value)
+    if m:
+        year, month, day = (int(g) for g in m.groups())
+    elif _BIRTH_ERA_RE.match(text_value):
+        era, era_year, month, day = _BIRTH_ERA_RE.match(text_value).groups()
+        year = _BIRTH_ERAS[era] + (1 if era_year == "元" else int(era_year))
+        month, day = int(month), int(day)
+    elif _BIRTH_MONTH_DAY_RE.match(text_value):
+        month, day = (int(g) for g in _BIRTH_MONTH_DAY_RE.match(text_value).groups())
+    else:
+        return raw, None, None
+
+    if year is not None and year < 1:
+        return raw, None, None
+    try:
+        #年なしの 2/29 も通すため、年が分からないときはうるう年で確かめる
+        parsed = date(2000 if year is None else year, month, day)
+    except ValueError:
+        return raw, None, None
+    if year is None:
+        return f"{month:02d}-{day:02d}", None, month * 100 + day
+    return parsed.isoformat(), parsed, month * 100 + day
 
-@app.route("/")
-def index():
-    """トップページ：図鑑表示"""
-    session = Session()
+
+def birth_columns(raw):
+    """ORM を通さない INSERT / UPDATE 用に birth / birth_date / birth_md の dict を作る"""
+    return dict(zip(("birth", "birth_date", "birth_md"), parse_birth(raw)))
+
+
+def local_today():
+    """APP_TIMEZONE での今日の日付（タイムゾーン情報が無い環境ではサーバーの日付）"""
     try:
-        #Person と tags を一緒に読み込む（N+1 回避）
-        people = session.query(Person).options(
-            joinedload(Person.tags)
-        ).all()
+        from zoneinfo import ZoneInfo
 
-        tags = session.query(GroupTag).all()
+        return datetime.now(ZoneInfo(APP_TIMEZONE)).date()
+    except Exception:
+        return date.today()
 
-        #Person → dict に変換
-        people_json = [
-            person_to_dict(p, tags=[t.name for t in p.tags])
-            for p in people
-        ]
 
-        return render_template(
-            "index.html",
-            title="図鑑",
-            people=people_json,
-            tags=tags,
-            MBTI_LABELS=MBTI_LABELS,
-            LOVE_LABELS=LOVE_LABELS,
-            active="index"
-        )
-    finally:
-        session.close()
+def next_birthday(birth_md, today):
+    """today 以降で最初の誕生日（うるう年以外の 2/29 生まれは 3/1 に祝う）"""
+    month, day = divmod(birth_md, 100)
+    for year in (today.year, today.year + 1):
+        try:
+            candidate = date(year, month, day)
+        except ValueError:
+            candidate = date(year, 3, 1)
+        if candidate >= today:
+            return candidate
+    return candidate
+
+
+#---- ページング設定 ----
+PAGE_DEFAULT_LIMIT = 100
+PAGE_MAX_LIMIT = 500
+INDEX_PAGE_SIZE = 60
+
+#ソートキー → ソート式（NULL / 空文字は比較できるよう埋めておく。同値は id で安定化）
+#birth: 生年月日の古い順（年上から）/ age: 若い順 / birthday: 年を無視した誕生日順（1 月 1 日から）
+#日付が分からない人はどれも最後
+#どれも (式, id) の複合インデックス（ix_people_sort_*）を順に辿るだけで済む
+PEOPLE_SORT_KEYS = {
+    "id": Person.id,
+    "reading": PERSON_SORT_READING,
+    "name": PERSON_SORT_NAME,
+    "birth": PERSON_SORT_BIRTH,
+    "age": PERSON_SORT_AGE,
+    "birthday": PERSON_SORT_BIRTHDAY,
+}
+#降順に並べるソートキー（同値の id も降順にして、インデックスを逆向きに辿れるようにする）
+PEOPLE_SORT_DESCENDING = {"age"}
 
 
-@app.route("/register", methods=["GET", "POST"])
-def register():
-    """登録画面（GET）＋ 登録処理（POST）"""
-    session = Session()
-    try:
-        tags = session.query(GroupTag).all()
+def parse_page_args(limit, sort="id"):
+    """limit / sort を検証して (limit, sort) を返す（不正値は ValueError）"""
+    limit = PAGE_DEFAULT_LIMIT if limit in (None, "") else int(limit)
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    if sort not in PEOPLE_SORT_KEYS:
+        raise ValueError(f"unknown sort: {sort}")
+    return min(limit, PAGE_MAX_LIMIT), sort
 
-        if request.method == "POST":
-            name = request.form["name"]
-            reading = request.form.get("reading", "")
-            birth = request.form.get("birth", "")
-            blood_type = request.form.get("blood_type", "")
-            mbti = request.form.get("mbti", "")
-            love_type = request.form.get("love_type", "")
-            phrase = request.form.get("phrase", "")
 
-            image_file = request.files.get("image")
-            image_url = upload_image(image_file)
+def encode_cursor(sort_value, person_id):
+    """(ソート値, id) を URL セーフな不透明カーソル文字列にする"""
+    if isinstance(sort_value, date):
+        sort_value = sort_value.isoformat()
+    raw = json.dumps([sort_value, person_id], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
 
-            person = Person(
-                name=name,
-                reading=reading,
+
+def decode_cursor(cursor):
+    """encode_cursor の逆変換（壊れたカーソルは ValueError）"""
+    try:
+        sort_value, person_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return sort_value, int(person_id)
+    except Exception as e:
+        raise ValueError("invalid cursor") from e
+
+
+def keyset_order(sort):
+    """ソートキーの ORDER BY（ix_people_sort_* と同じ並び）"""
+    sort_expr = PEOPLE_SORT_KEYS[sort]
+    if sort == "id":
+        return [Person.id]
+    if sort in PEOPLE_SORT_DESCENDING:
+        return [sort_expr.desc(), Person.id.desc()]
+    return [sort_expr, Person.id]
+
+
+def keyset_after(sort, last_value, last_id):
+    """
+    (last_value, last_id) より後ろの行の条件。先頭の「式 >= 値」（降順なら <=）で
+    インデックスの範囲検索にし、同じ値の中は id で続きを選ぶ
+    """
+    sort_expr = PEOPLE_SORT_KEYS[sort]
+    if sort == "id":
+        return [Person.id > last_id]
+    if sort in PEOPLE_SORT_DESCENDING:
+        return [sort_expr <= last_value, or_(sort_expr < last_value, Person.id < last_id)]
+    return [sort_expr >= last_value, or_(sort_expr > last_value, Person.id > last_id)]
+
+
+def paginate_people(query, sort="id", limit=PAGE_DEFAULT_LIMIT, cursor=None):
+    """
+    Person クエリに (ソート式, id) のキーセットページングをかける。
+    OFFSET を使わないので、何ページ目でもインデックスを辿るだけで済む。
+    query は session.query(Person) でも session.query(Person.id) でもよい。
+    戻り値: (Person または id のリスト, 次ページ用カーソル or None)
+    """
+    sort_expr = PEOPLE_SORT_KEYS[sort]
+    query = query.add_columns(sort_expr.label("sort_key"))
+
+    if cursor:
+        last_value, last_id = decode_cursor(cursor)
+        if isinstance(sort_expr.type, Date):
+            try:
+                last_value = date.fromisoformat(last_value)
+            except (TypeError, ValueError) as e:
+                raise ValueError("invalid cursor") from e
+        query = query.filter(*keyset_after(sort, last_value, last_id))
+
+    #1 件多く取って次ページの有無を判定
+    rows = query.order_by(*keyset_order(sort)).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last_person, last_key = rows[-1]
+        last_id = last_person if isinstance(last_person, int) else last_person.id
+        next_cursor = encode_cursor(last_key, last_id)
+
+    return [person for person, _ in rows], next_cursor
+
+
+def tag_filter_clause(tag_ids, mode="any"):
+    """タグ絞り込み条件（EXISTS）を返す。any: いずれか / all: すべて"""
+    if mode == "all":
+        return and_(*[
+            exists().where(PersonTag.person_id == Person.id, PersonTag.tag_id == tag_id)
+            for tag_id in set(tag_ids)
+        ])
+    return exists().where(
+        PersonTag.person_id == Person.id, PersonTag.tag_id.in_(tag_ids)
+    )
+
+
+#============================================
+#統計カウンター
+#============================================
+#カテゴリ名 → 集計対象カラム
+STAT_COLUMNS = {
+    "mbti": Person.mbti,
+    "love": Person.love_type,
+    "blood": Person.blood_type,
+}
+#カウンター初期化済みの目印（この行がなければ GROUP BY で作り直す）
+STAT_META_CATEGORY = "_meta"
+STAT_REBUILD_LOCK_ID = 0x6D6179   #PostgreSQL の advisory lock 用
+
+
+def upsert_insert(session, table):
+    """ON CONFLICT を書ける INSERT（SQLite / PostgreSQL の方言版）"""
+    dialect = postgresql if session.get_bind().dialect.name == "postgresql" else sqlite
+    return dialect.insert(table)
+
+
+def stat_values(person):
+    """Person からカウンター対象の {カテゴリ: 値} を取り出す"""
+    return {
+        "mbti": person.mbti,
+        "love": person.love_type,
+        "blood": person.blood_type,
+    }
+
+
+def stat_values_from_row(row):
+    """INSERT 用の dict（カラム名 → 値）から stat_values と同じ形を取り出す（ORM オブジェクトを作らない）"""
+    return {category: row.get(column.key) for category, column in STAT_COLUMNS.items()}
+
+
+def bump_stat_counters(session, old=None, new=None):
+    """
+    old → new の変化分だけカウンターを増減する（commit は呼び出し側）。
+    登録は old=None、削除は new=None。空文字・None は集計しない。
+    """
+    old = old or {}
+    new = new or {}
+    for category in STAT_COLUMNS:
+        before, after = old.get(category), new.get(category)
+        if before == after:
+            continue
+        if before:
+            _bump_stat(session, category, before, -1)
+        if after:
+            _bump_stat(session, category, after, 1)
+
+
+def bump_stat_counters_many(session, changes):
+    """
+    (old, new) の組をまとめて集計し、カテゴリ・値ごとに 1 回ずつだけ
+    カウンターを増減する（一括登録・更新用。commit は呼び出し側）。
+    """
+    deltas = Counter()
+    for old, new in changes:
+        old = old or {}
+        new = new or {}
+        for category in STAT_COLUMNS:
+            before, after = old.get(category), new.get(category)
+            if before == after:
+                continue
+            if before:
+                deltas[(category, before)] -= 1
+            if after:
+                deltas[(category, after)] += 1
+    for (category, value), delta in deltas.items():
+        if delta:
+            _bump_stat(session, category, value, delta)
+
+
+def _bump_stat(session, category, value, delta):
+    #INSERT ... ON CONFLICT DO UPDATE SET count = count + delta の 1 文で、
+    #他ワーカーと同じ値を同時に初めて数えても主キーがぶつからず、数もずれないようにする
+    stmt = upsert_insert(session, StatCounter).values(category=category, value=value, count=delta)
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[StatCounter.category, StatCounter.value],
+        set_={"count": StatCounter.count + stmt.excluded.count},
+    ))
+
+
+def rebuild_stat_counters(session, only_if_missing=False):
+    """
+    people テーブルから GROUP BY で集計し直してカウンターを置き換える（Core の DELETE + INSERT を 1 トランザクションで）。
+    only_if_missing なら、待っている間にほかのワーカーが作り終えていれば何もしない（初回の同時アクセス用）
+    """
+    if session.get_bind().dialect.name == "postgresql":
+        session.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": STAT_REBUILD_LOCK_ID})
+    if only_if_missing and session.scalar(
+        select(StatCounter.count).where(StatCounter.category == STAT_META_CATEGORY)
+    ):
+        session.commit()
+        return
+
+    rows = [{"category": STAT_META_CATEGORY, "value": "initialized", "count": 1}]
+    for category, column in STAT_COLUMNS.items():
+        rows += [
+            {"category": category, "value": value, "count": count}
+            for value, count in session.execute(
+                select(column, func.count(Person.id))
+                .where(column.isnot(None), column != "")
+                .group_by(column)
+            )
+        ]
+    session.execute(delete(StatCounter))
+    stmt = upsert_insert(session, StatCounter)
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[StatCounter.category, StatCounter.value],
+        set_={"count": stmt.excluded.count},
+    ), rows)
+    session.commit()
+
+
+def load_stat_counts(session):
+    """カウンターを {カテゴリ: {値: 件数}} で返す（未初期化なら先に作る）"""
+    #ORM の StatCounter を読み込まない（カウンターは Core の文でしか書かないので、古いインスタンスを残さない）
+    counter_rows = select(StatCounter.category, StatCounter.value, StatCounter.count)
+    rows = session.execute(counter_rows).all()
+    if not any(r.category == STAT_META_CATEGORY for r in rows):
+        rebuild_stat_counters(session, only_if_missing=True)
+        rows = session.execute(counter_rows).all()
+
+    counts = {category: {} for category in STAT_COLUMNS}
+    for r in rows:
+        if r.category in counts and r.count > 0:
+            counts[r.category][r.value] = r.count
+
+    #グループタグ分布（JOIN で集計）
+    tag_rows = (
+        session.query(GroupTag.name, func.count(PersonTag.id))
+        .join(PersonTag, GroupTag.id == PersonTag.tag_id)
+        .group_by(GroupTag.id, GroupTag.name)
+        .all()
+    )
+    counts["tags"] = {name: cnt for name, cnt in tag_rows}
+    return counts
+
+
+#============================================
+#名前・読み 検索インデックス（プロセス内）
+#============================================
+#カタカナ → ひらがな 変換表（ァ〜ヶ を 0x60 ずらす）
+_KATA_TO_HIRA = {code: code - 0x60 for code in range(ord("ァ"), ord("ヶ") + 1)}
+
+#この長さ以上のクエリは trigram、これより短い（1〜2 文字の）クエリは短い部分文字列の転置インデックスで引く
+SEARCH_NGRAM = 3
+#ファジー一致とみなす trigram 一致率
+SEARCH_FUZZY_THRESHOLD = 0.5
+#change_log がこれより多く進んでいたら差分ではなく作り直す
+SEARCH_MAX_DELTA = 2000
+#タイプアヘッドは change_log の確認をこのミリ秒に 1 回に間引く（このプロセスの書き込みはその場で反映済み）
+SEARCH_FRESH_MS = _env_int("SEARCH_FRESH_MS", 1000)
+#/filter で IN 句に展開する ID 数の上限（超えたら SQL の LIKE に任せる）
+SEARCH_FILTER_MAX_IDS = 5000
+
+
+def normalize_kana(text):
+    """全角/半角・大文字小文字・カタカナ/ひらがな・空白の違いを吸収した検索キーを返す"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return "".join(text.split()).translate(_KATA_TO_HIRA)
+
+
+def _ngrams(text):
+    return {text[i:i + SEARCH_NGRAM] for i in range(len(text) - SEARCH_NGRAM + 1)}
+
+
+def _short_grams(text):
+    """SEARCH_NGRAM より短い部分文字列すべて（1〜2 文字のクエリの完全な索引になる）"""
+    return {text[i:i + n] for n in range(1, SEARCH_NGRAM) for i in range(len(text) - n + 1)}
+
+
+class SearchIndex:
+    """
+    name / reading の正規化キーに対する前方一致（ソート済み配列 + bisect）と
+    trigram・短い部分文字列の転置インデックス。
+    このプロセスの登録・編集・削除はその場で差分更新し、
+    ほかのワーカーの書き込みは change_log を seq 順に読んで変わった人物だけ差し替える
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()   #DB からの反映は 1 スレッドずつ
+        self._docs = {}       #id → (name, reading, (正規化キー, ...))
+        self._sorted = []     #(正規化キー, id) のソート済みリスト
+        self._postings = {}   #trigram → {id, ...}
+        self._short = {}      #1〜2 文字の部分文字列 → {id, ...}
+        self._seq = None      #ここまでの change_log を反映済み（None は未構築）
+        self._checked_at = 0.0   #最後に change_log を確認した時刻（monotonic）
+
+    #---------- 更新 ----------
+    def rebuild(self, rows, seq=0):
+        """(id, name, reading) の列から作り直す（seq: 読む前に取った change_log の位置）"""
+        with self._lock:
+            self._docs = {}
+            self._sorted = []
+            self._postings = {}
+            self._short = {}
+            for person_id, name, reading in rows:
+                self._add(person_id, name, reading)
+            self._sorted.sort()
+            self._seq = seq
+
+    def upsert(self, person_id, name, reading):
+        with self._lock:
+            if self._seq is None:
+                return
+            self._remove(person_id)
+            self._add(person_id, name, reading, keep_sorted=True)
+
+    def remove(self, person_id):
+        with self._lock:
+            if self._seq is None:
+                return
+            self._remove(person_id)
+
+    def invalidate(self):
+        with self._lock:
+            self._seq = None
+
+    def _add(self, person_id, name, reading, keep_sorted=False):
+        keys = tuple(k for k in {normalize_kana(name), normalize_kana(reading)} if k)
+        self._docs[person_id] = (name, reading, keys)
+        for key in keys:
+            if keep_sorted:
+                bisect.insort(self._sorted, (key, person_id))
+            else:
+                self._sorted.append((key, person_id))
+            for gram in _ngrams(key):
+                self._postings.setdefault(gram, set()).add(person_id)
+            for gram in _short_grams(key):
+                self._short.setdefault(gram, set()).add(person_id)
+
+    def _remove(self, person_id):
+        doc = self._docs.pop(person_id, None)
+        if not doc:
+            return
+        for key in doc[2]:
+            i = bisect.bisect_left(self._sorted, (key, person_id))
+            if i < len(self._sorted) and self._sorted[i] == (key, person_id):
+                del self._sorted[i]
+            for postings, grams in ((self._postings, _ngrams(key)), (self._short, _short_grams(key))):
+                for gram in grams:
+                    ids = postings.get(gram)
+                    if ids:
+                        ids.discard(person_id)
+                        if not ids:
+                            del postings[gram]
+
+    def ensure_fresh(self, max_age=0):
+        """
+        change_log の新しい分を反映する（未構築・追いつけないときは作り直す）。
+        max_age 秒以内に確認済みなら DB に問い合わせない
+        """
+        if self._seq is not None and time.monotonic() - self._checked_at < max_age:
+            return
+        with self._refresh_lock:
+            self._refresh()
+            self._checked_at = time.monotonic()
+
+    def _refresh(self):
+        session = Session()
+        try:
+            seq = self._seq
+            if seq is not None:
+                rows = session.query(
+                    ChangeLogEntry.seq, ChangeLogEntry.entity, ChangeLogEntry.entity_id, ChangeLogEntry.op
+                ).filter(ChangeLogEntry.seq > seq).order_by(ChangeLogEntry.seq).limit(SEARCH_MAX_DELTA + 1).all()
+                if not rows:
+                    return
+                #先頭が飛んでいる = 間の履歴が掃除された
+                if len(rows) <= SEARCH_MAX_DELTA and rows[0].seq == seq + 1:
+                    self._apply_rows(session, rows)
+                    return
+
+            latest = latest_change_seq(session)   #データより先に読む（この後の変更は次回拾う）
+            people = session.query(Person.id, Person.name, Person.reading).all()
+        finally:
+            session.close()
+        self.rebuild(people, latest)
+
+    def _apply_rows(self, session, rows):
+        latest = {entity_id: op for _, entity, entity_id, op in rows if entity == "person"}
+        person_ids = [i for i, op in latest.items() if op == CHANGE_UPSERT]
+        people = session.query(Person.id, Person.name, Person.reading).filter(
+            Person.id.in_(person_ids)
+        ).all() if person_ids else []
+        with self._lock:
+            #記録のあとで消えた人物も削除として扱う
+            for person_id in latest:
+                self._remove(person_id)
+            for person_id, name, reading in people:
+                self._add(person_id, name, reading, keep_sorted=True)
+            self._seq = rows[-1].seq
+
+    #---------- 検索 ----------
+    def search(self, query, limit=10):
+        """
+        ランク付き検索。戻り値は (id, name, reading, score) のリスト。
+        score: 完全一致 4 / 前方一致 3 / 部分一致 2 / trigram 類似のみ 0〜1
+        """
+        q = normalize_kana(query)
+        if not q:
+            return []
+
+        with self._lock:
+            scores = {}
+
+            #前方一致（bisect で開始位置を探し、接頭辞が続く間だけ読む）
+            i = bisect.bisect_left(self._sorted, (q,))
+            prefix_budget = limit * 20
+            while i < len(self._sorted) and prefix_budget:
+                key, person_id = self._sorted[i]
+                if not key.startswith(q):
+                    break
+                score = 4.0 if key == q else 3.0
+                scores[person_id] = max(scores.get(person_id, 0.0), score)
+                i += 1
+                prefix_budget -= 1
+
+            #部分一致・ファジー一致（trigram の一致率）
+            grams = _ngrams(q)
+            if grams:
+                hits = Counter()
+                for gram in grams:
+                    hits.update(self._postings.get(gram, ()))
+                for person_id, hit in hits.items():
+                    if person_id in scores:
+                        continue
+                    similarity = hit / len(grams)
+                    if any(q in key for key in self._docs[person_id][2]):
+                        scores[person_id] = 2.0
+                    elif similarity >= SEARCH_FUZZY_THRESHOLD:
+                        scores[person_id] = similarity
+            elif len(scores) < limit:
+                #短いクエリの部分一致は短い部分文字列の索引がそのまま答え
+                for person_id in self._short.get(q, ()):
+                    scores.setdefault(person_id, 2.0)
+
+            ranked = heapq.nsmallest(
+                limit,
+                scores.items(),
+                key=lambda item: (-item[1], len(self._docs[item[0]][0] or ""), item[0]),
+            )
+            return [
+                (person_id, self._docs[person_id][0], self._docs[person_id][1], score)
+                for person_id, score in ranked
+            ]
+
+    def match_ids(self, query):
+        """name / reading のどちらかに部分一致する id の集合（/filter 用）"""
+        q = normalize_kana(query)
+        if not q:
+            return None
+
+        with self._lock:
+            grams = _ngrams(q)
+            if not grams:
+                return set(self._short.get(q, ()))
+            postings = sorted((self._postings.get(g, set()) for g in grams), key=len)
+            candidates = set.intersection(*postings)
+            return {
+                person_id for person_id in candidates
+                if any(q in key for key in self._docs[person_id][2])
+            }
+
+
+search_index = SearchIndex()
+
+
+#============================================
+#関係性グラフインデックス（プロセス内の隣接リスト）
+#============================================
+#別ワーカーでの更新を拾うため、この秒数ごとに DB から作り直す
+GRAPH_INDEX_TTL = int(os.environ.get("GRAPH_INDEX_TTL", "60"))
+#エゴネットワーク・部分グラフで返す最大ノード数
+GRAPH_MAX_NODES = 2000
+GRAPH_MAX_DEPTH = 4
+
+
+class RelationGraph:
+    """
+    relationships の無向隣接リスト。add_relation / delete_relation / delete_person で差分更新する。
+    辺のフィルタ（relation_type / 最小 strength）は探索時に述語で渡す。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._edges = {}      #relation id → (source, target, relation_type, strength)
+        self._adj = {}        #person id → {隣の person id: relation id}
+        self._built_at = None
+
+    #---------- 更新 ----------
+    def rebuild(self, rows):
+        """(id, source_id, target_id, relation_type, strength) の列から作り直す"""
+        with self._lock:
+            self._edges = {}
+            self._adj = {}
+            for relation_id, source, target, relation_type, strength in rows:
+                self._add(relation_id, source, target, relation_type, strength)
+            self._built_at = time.monotonic()
+
+    def upsert_edge(self, relation_id, source, target, relation_type, strength):
+        with self._lock:
+            if self._built_at is None:
+                return
+            self._remove(relation_id)
+            self._add(relation_id, source, target, relation_type, strength)
+
+    def remove_edge(self, relation_id):
+        with self._lock:
+            if self._built_at is None:
+                return
+            self._remove(relation_id)
+
+    def remove_node(self, person_id):
+        with self._lock:
+            if self._built_at is None:
+                return
+            for relation_id in list(self._adj.get(person_id, {}).values()):
+                self._remove(relation_id)
+            self._adj.pop(person_id, None)
+
+    def invalidate(self):
+        with self._lock:
+            self._built_at = None
+
+    def _add(self, relation_id, source, target, relation_type, strength):
+        self._edges[relation_id] = (source, target, relation_type, strength or 0)
+        self._adj.setdefault(source, {})[target] = relation_id
+        self._adj.setdefault(target, {})[source] = relation_id
+
+    def _remove(self, relation_id):
+        edge = self._edges.pop(relation_id, None)
+        if not edge:
+            return
+        source, target = edge[0], edge[1]
+        self._adj.get(source, {}).pop(target, None)
+        self._adj.get(target, {}).pop(source, None)
+
+    def ensure_fresh(self):
+        """未構築 or TTL 切れなら DB から読み直す"""
+        built_at = self._built_at
+        if built_at is not None and time.monotonic() - built_at < GRAPH_INDEX_TTL:
+            return
+        session = Session()
+        try:
+            rows = session.query(
+                Relationship.id, Relationship.source_id, Relationship.target_id,
+                Relationship.relation_type, Relationship.strength,
+            ).all()
+        finally:
+            session.close()
+        self.rebuild(rows)
+
+    #---------- 探索 ----------
+    @staticmethod
+    def edge_filter(relation_types=None, min_strength=None):
+        """relation_type の集合・最小 strength から辺の述語を作る（None は条件なし）"""
+        types = set(relation_types) if relation_types else None
+
+        def accept(edge):
+            if types is not None and edge[2] not in types:
+                return False
+            if min_strength is not None and edge[3] < min_strength:
+                return False
+            return True
+        return accept
+
+    def _neighbors(self, person_id, accept):
+        for neighbor, relation_id in self._adj.get(person_id, {}).items():
+            if accept(self._edges[relation_id]):
+                yield neighbor, relation_id
+
+    def ego(self, center, depth, accept, max_nodes=GRAPH_MAX_NODES):
+        """center から depth ホップ以内の (ノード集合, 辺 id 集合)。max_nodes で打ち切る"""
+        with self._lock:
+            nodes = {center}
+            frontier = [center]
+            for _ in range(depth):
+                next_frontier = []
+                for person_id in frontier:
+                    for neighbor, _ in self._neighbors(person_id, accept):
+                        if neighbor not in nodes and len(nodes) < max_nodes:
+                            nodes.add(neighbor)
+                            next_frontier.append(neighbor)
+                frontier = next_frontier
+            return nodes, self._induced_edges(nodes, accept)
+
+    def shortest_path(self, start, goal, accept):
+        """BFS によるホップ数最短経路（person id のリスト）。つながっていなければ None"""
+        with self._lock:
+            if start == goal:
+                return [start]
+            parents = {start: None}
+            queue = deque([start])
+            while queue:
+                person_id = queue.popleft()
+                for neighbor, _ in self._neighbors(person_id, accept):
+                    if neighbor in parents:
+                        continue
+                    parents[neighbor] = person_id
+                    if neighbor == goal:
+                        path = [goal]
+                        while parents[path[-1]] is not None:
+                            path.append(parents[path[-1]])
+                        return path[::-1]
+                    queue.append(neighbor)
+            return None
+
+    def path_edges(self, path):
+        with self._lock:
+            return {self._adj[a][b] for a, b in zip(path, path[1:])}
+
+    def components(self, accept):
+        """連結成分（辺を 1 本以上持つ人物のみ）を大きい順に返す"""
+        with self._lock:
+            seen = set()
+            result = []
+            for start in self._adj:
+                if start in seen or not any(True for _ in self._neighbors(start, accept)):
+                    continue
+                component = []
+                seen.add(start)
+                stack = [start]
+                while stack:
+                    person_id = stack.pop()
+                    component.append(person_id)
+                    for neighbor, _ in self._neighbors(person_id, accept):
+                        if neighbor not in seen:
+                            seen.add(neighbor)
+                            stack.append(neighbor)
+                result.append(sorted(component))
+            result.sort(key=lambda c: (-len(c), c[0]))
+            return result
+
+    def degrees(self, accept, limit):
+        """(person id, 次数, strength 合計) を次数の多い順に返す"""
+        with self._lock:
+            ranking = []
+            for person_id in self._adj:
+                degree = strength_sum = 0
+                for _, relation_id in self._neighbors(person_id, accept):
+                    degree += 1
+                    strength_sum += self._edges[relation_id][3]
+                if degree:
+                    ranking.append((person_id, degree, strength_sum))
+            return heapq.nsmallest(limit, ranking, key=lambda r: (-r[1], -r[2], r[0]))
+
+    def subgraph(self, accept, max_nodes=GRAPH_MAX_NODES):
+        """条件に合う辺だけの部分グラフ（ノード集合, 辺 id 集合）"""
+        with self._lock:
+            nodes = set()
+            edge_ids = set()
+            for relation_id, edge in self._edges.items():
+                if not accept(edge):
+                    continue
+                added = {edge[0], edge[1]} - nodes
+                if len(nodes) + len(added) > max_nodes:
+                    continue
+                nodes.update(added)
+                edge_ids.add(relation_id)
+            return nodes, edge_ids
+
+    def edge(self, relation_id):
+        return self._edges.get(relation_id)
+
+    def neighbors_of(self, person_id):
+        """フィルタなしの隣人 id 一覧"""
+        with self._lock:
+            return list(self._adj.get(person_id, {}))
+
+    def edge_list(self):
+        """(source, target, relation_type, strength) の一覧のコピー"""
+        with self._lock:
+            return list(self._edges.values())
+
+    def _induced_edges(self, nodes, accept):
+        return {
+            relation_id
+            for person_id in nodes
+            for neighbor, relation_id in self._neighbors(person_id, accept)
+            if neighbor in nodes
+        }
+
+
+relation_graph = RelationGraph()
+
+
+#============================================
+#関係性グラフのレイアウト（サーバー側で計算して DB にキャッシュ）
+#============================================
+LAYOUT_ITERATIONS = 150           #全体計算の反復回数
+LAYOUT_INCREMENTAL_ITERATIONS = 40
+#全体計算は 1 反復が n² なので、反復回数 × n² がこれを超える人数では反復を減らす
+#（1k 人で 150 回 ≒ 2 秒、10k 人だと 20 回に減らして 30 秒ほど。benchmarks/layout_bench.py で計測）
+LAYOUT_FULL_BUDGET = _env_int("LAYOUT_FULL_BUDGET", 2_000_000_000)
+LAYOUT_MIN_ITERATIONS = 10
+LAYOUT_NODE_SPACING = 120.0       #vis-network の座標単位でのノード間隔の目安
+LAYOUT_GRAVITY = 0.02             #孤立ノードが飛んでいかないよう中心へ引き戻す強さ
+LAYOUT_CHUNK = 512                #斥力計算を何行ずつまとめて行うか（メモリ n×CHUNK に抑える）
+LAYOUT_LOCK_ID = 0x6D617A         #PostgreSQL の advisory lock 用（別プロセスの計算と node_positions を取り合わない）
+_layout_lock = threading.Lock()
+
+
+def force_layout(pos, edges, weights, movable, iterations):
+    """
+    Fruchterman-Reingold 法を NumPy でベクトル化したもの。
+    pos: (n, 2) 初期座標（書き換える）, edges: (m, 2) インデックス, weights: (m,) 辺の強さ,
+    movable: (n,) 動かしてよいノード。動かせないノードは斥力・引力の相手としてだけ使う。
+    """
+    n = len(pos)
+    if n == 0 or not movable.any():
+        return pos
+
+    k = LAYOUT_NODE_SPACING
+    #最初は全体の広がりの 1/10 まで一度に動けるようにし、最後は 1% まで冷ます
+    temperature = max(k, np.sqrt(n) * k / 10.0) if movable.all() else k
+    cooling = 0.01 ** (1.0 / max(iterations, 1))
+    movable_idx = np.flatnonzero(movable)
+
+    for _ in range(iterations):
+        disp = np.zeros_like(pos)
+
+        #斥力（全ペア）: 向き (pi - pj) に k² / d²（大きさ k² / d）。
+        #Σ_j (pi - pj) w_ij = pi Σ_j w_ij - W @ P として行列積にまとめる
+        sq = (pos ** 2).sum(axis=1)
+        for start in range(0, len(movable_idx), LAYOUT_CHUNK):
+            rows = movable_idx[start:start + LAYOUT_CHUNK]
+            dist2 = sq[rows, None] + sq[None, :] - 2.0 * (pos[rows] @ pos.T)
+            np.maximum(dist2, 1e-2, out=dist2)
+            weight = (k * k) / dist2
+            weight[np.arange(len(rows)), rows] = 0.0   #自分自身とは反発しない
+            disp[rows] += pos[rows] * weight.sum(axis=1)[:, None] - weight @ pos
+
+        #引力（辺）: d² / k、強い関係ほど近づける
+        if len(edges):
+            src, dst = edges[:, 0], edges[:, 1]
+            delta = pos[src] - pos[dst]
+            dist = np.maximum(np.sqrt((delta ** 2).sum(axis=1)), 1e-2)
+            force = (delta * (dist * weights / k)[:, None])
+            np.add.at(disp, src, -force)
+            np.add.at(disp, dst, force)
+
+        disp -= pos * LAYOUT_GRAVITY
+        disp[~movable] = 0.0
+
+        length = np.maximum(np.sqrt((disp ** 2).sum(axis=1)), 1e-9)
+        pos += disp * (np.minimum(length, temperature) / length)[:, None]
+        temperature *= cooling
+
+    return pos
+
+
+def _layout_inputs(session, person_ids):
+    """
+    relationships から (id → 行番号, 辺インデックス, 重み, id → 隣人の集合) を作る。
+    ワーカーのプロセスの relation_graph は古いことがあるので、DB から直接読む
+    """
+    index = {person_id: i for i, person_id in enumerate(person_ids)}
+    pairs, weights, neighbors = [], [], {}
+    for source, target, strength in session.execute(
+        select(Relationship.source_id, Relationship.target_id, Relationship.strength)
+    ):
+        if source in index and target in index:
+            pairs.append((index[source], index[target]))
+            #strength 1〜5 → 引力 0.6〜1.4 倍
+            weights.append(0.4 + 0.2 * (strength or 1))
+            neighbors.setdefault(source, set()).add(target)
+            neighbors.setdefault(target, set()).add(source)
+    edges = np.array(pairs, dtype=np.intp).reshape(-1, 2)
+    return index, edges, np.array(weights, dtype=float), neighbors
+
+
+def _initial_position(person_id, placed, neighbors_of, rng):
+    """新しいノードは、配置済みの隣人の重心付近（隣人がいなければ外周）に置く"""
+    neighbors = [
+        placed[other]
+        for other in neighbors_of.get(person_id, ())
+        if other in placed
+    ]
+    if neighbors:
+        center = np.mean(neighbors, axis=0)
+        return center + rng.normal(scale=LAYOUT_NODE_SPACING / 2, size=2)
+    radius = LAYOUT_NODE_SPACING * (np.sqrt(len(placed) + 1) + 1)
+    angle = rng.uniform(0, 2 * np.pi)
+    return np.array([np.cos(angle), np.sin(angle)]) * radius
+
+
+def compute_layout(session, dirty_ids=None):
+    """
+    レイアウトを計算して node_positions に保存し、新しいレイアウト版数を返す。
+    dirty_ids=None なら全体を計算し直す。指定した場合は dirty_ids とその隣人、
+    座標のないノードだけを動かし、他は固定したまま数回だけ緩和する。
+    リクエストの中では呼ばず、レイアウトジョブ（enqueue_layout_job）か python app.py layout から呼ぶ
+    """
+    with _layout_lock:
+        if session.get_bind().dialect.name == "postgresql":
+            session.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": LAYOUT_LOCK_ID})
+        person_ids = [row[0] for row in session.query(Person.id).order_by(Person.id)]
+        placed = {
+            person_id: np.array([x, y])
+            for person_id, x, y in session.execute(select(NodePosition.person_id, NodePosition.x, NodePosition.y))
+        }
+        index, edges, weights, neighbors_of = _layout_inputs(session, person_ids)
+        rng = np.random.default_rng(len(person_ids))
+
+        pos = np.zeros((len(person_ids), 2))
+        movable = np.zeros(len(person_ids), dtype=bool)
+        full = dirty_ids is None or not placed
+        if not full:
+            moving = set(dirty_ids)
+            for person_id in dirty_ids:
+                moving.update(neighbors_of.get(person_id, ()))
+
+        spread = LAYOUT_NODE_SPACING * np.sqrt(len(person_ids) + 1) / 2
+        for person_id, i in index.items():
+            if full:
+                pos[i] = rng.normal(scale=spread, size=2)
+                movable[i] = True
+            elif person_id in placed:
+                pos[i] = placed[person_id]
+                movable[i] = person_id in moving
+            else:
+                pos[i] = _initial_position(person_id, placed, neighbors_of, rng)
+                movable[i] = True
+
+        iterations = LAYOUT_ITERATIONS if full else LAYOUT_INCREMENTAL_ITERATIONS
+        if full:
+            budget = LAYOUT_FULL_BUDGET // max(len(person_ids) ** 2, 1)
+            iterations = max(LAYOUT_MIN_ITERATIONS, min(iterations, budget))
+        pos = force_layout(pos, edges, weights, movable, iterations)
+
+        #動かしたノードだけ保存する
+        changed = [
+            {"person_id": person_id, "x": float(pos[i, 0]), "y": float(pos[i, 1])}
+            for person_id, i in index.items()
+            if movable[i]
+        ]
+        if full:
+            session.query(NodePosition).delete(synchronize_session=False)
+        else:
+            session.query(NodePosition).filter(
+                NodePosition.person_id.in_([c["person_id"] for c in changed])
+            ).delete(synchronize_session=False)
+        if changed:
+            session.execute(NodePosition.__table__.insert(), changed)
+
+        state = session.get(GraphLayoutState, 1)
+        if state is None:
+            state = GraphLayoutState(id=1, version=0)
+            session.add(state)
+        state.version += 1
+        state.updated_at = time.time()
+        bump_data_versions(session, "layout")
+        record_changes(session, "layout", [1])
+        session.commit()
+        return state.version
+
+
+def enqueue_layout_job(session, dirty_ids=None):
+    """
+    レイアウトの計算をジョブとして積む（commit は呼び出し側、commit 後に notify_image_workers()）。
+    dirty_ids=None なら全体の計算し直し。まだ始まっていないジョブがあれば、そこへ dirty_ids を足すだけにする
+    """
+    dirty = None if dirty_ids is None else sorted(set(dirty_ids))
+    job = session.query(ImageJob).filter_by(kind=JOB_LAYOUT, status=JOB_PENDING).order_by(ImageJob.id).first()
+    if job is not None:
+        queued = json.loads(job.payload)["dirty"]
+        merged = None if queued is None or dirty is None else sorted(set(queued) | set(dirty))
+        #status を条件にするので、同時にワーカーが取っていったら（0 件）新しいジョブにする
+        if session.query(ImageJob).filter(ImageJob.id == job.id, ImageJob.status == JOB_PENDING).update(
+            {ImageJob.payload: json.dumps({"dirty": merged})}, synchronize_session=False
+        ):
+            return job
+    #実行中のジョブが読み終えたあとの変更も拾えるよう、積むたびに別のキーにする
+    return enqueue_image_job(session, JOB_LAYOUT, f"layout:{uuid.uuid4().hex}", {"dirty": dirty})
+
+
+def load_layout(session, person_ids=None):
+    """
+    (版数, {person_id: (x, y)}) を返す（読み取り専用）。
+    未計算（版数 0）や座標のまだない人物はクライアントの物理演算に任せ、ここでは計算しない
+    """
+    state = session.get(GraphLayoutState, 1)
+    if state is None:
+        return 0, {}
+
+    query = session.query(NodePosition.person_id, NodePosition.x, NodePosition.y)
+    if person_ids is not None:
+        query = query.filter(NodePosition.person_id.in_(person_ids))
+    positions = {person_id: (x, y) for person_id, x, y in query}
+    return state.version, positions
+
+
+#============================================
+#データ版数と条件付き GET（ETag / Last-Modified）
+#============================================
+#書き込み系ルートは commit と同じトランザクションで関係するスコープの版数を上げる。
+#読み取り系ルートは版数だけを 1 クエリで読み、クライアントの If-None-Match と
+#一致すれば ORM に触らず 304 を返す。テンプレートや JS が変わったデプロイでは
+#ETag も変わるよう、ビルド ID（Render のコミット、なければ app.py の更新時刻）を混ぜる
+APP_BUILD_ID = os.environ.get("RENDER_GIT_COMMIT") or str(int(os.path.getmtime(__file__)))
+DATA_VERSION_BATCH = 500   #1 回の INSERT に入れる scope の数（バインド変数の上限対策）
+
+
+def bump_data_versions(session, *scopes):
+    """
+    scopes と "global" の版数を +1 する（commit は呼び出し側）。
+    INSERT ... ON CONFLICT DO UPDATE の 1 文なので、まだ行のない scope を複数ワーカーが同時に上げても主キーがぶつからない
+    """
+    now = time.time()
+    #並びをそろえて、PostgreSQL で行ロックを取る順番が書き込みごとに食い違わないようにする
+    scopes_all = sorted({"global", *scopes})
+    for start in range(0, len(scopes_all), DATA_VERSION_BATCH):
+        stmt = upsert_insert(session, DataVersion).values([
+            {"scope": scope, "version": 1, "updated_at": now}
+            for scope in scopes_all[start:start + DATA_VERSION_BATCH]
+        ])
+        session.execute(stmt.on_conflict_do_update(
+            index_elements=[DataVersion.scope],
+            set_={"version": DataVersion.version + 1, "updated_at": stmt.excluded.updated_at},
+        ))
+    #古い版のキャッシュは参照されなくなるが、場所を空けるために消しておく
+    person_cache.invalidate([
+        int(scope.split(":", 1)[1]) for scope in scopes if scope.startswith("person:")
+    ])
+
+
+def read_data_versions(scopes):
+    """{scope: (version, updated_at)} を返す（セッションを作らず 1 クエリで読む。未登録は (0, 0)）"""
+    with get_engine().connect() as conn:
+        rows = conn.execute(
+            select(DataVersion.scope, DataVersion.version, DataVersion.updated_at)
+            .where(DataVersion.scope.in_(scopes))
+        ).all()
+    versions = {scope: (0, 0) for scope in scopes}
+    versions.update((scope, (version, updated_at)) for scope, version, updated_at in rows)
+    return versions
+
+
+def conditional_response(*scope_templates):
+    """
+    読み取り系ルート用デコレーター。scope_templates はルート引数で展開する
+    （例: "person:{person_id}"）。ETag はスコープの版数・エンドポイント・
+    クエリ文字列・リクエスト本文（POST /filter 用）から作る強い ETag。
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            scopes = [template.format(**kwargs) for template in scope_templates]
+            versions = read_data_versions(scopes)
+            g.data_versions = versions  #ビュー側（人物キャッシュのキー）でも使い回す
+            key = json.dumps([
+                APP_BUILD_ID,
+                request.endpoint,
+                [versions[scope][0] for scope in scopes],
+                request.query_string.decode("latin-1"),
+                request.get_data(as_text=True),
+            ])
+            etag = hashlib.sha1(key.encode("utf-8")).hexdigest()
+            updated_at = max((v[1] for v in versions.values()), default=0)
+            last_modified = int(updated_at) or None
+
+            #If-None-Match があればそちらを優先（秒単位の Last-Modified より正確）
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            else:
+                since = request.if_modified_since
+                not_modified = bool(since and last_modified and last_modified <= since.timestamp())
+            if not_modified:
+                response = make_response("", 304)
+            else:
+                response = make_response(view(**kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            if last_modified:
+                response.last_modified = last_modified
+            #キャッシュしてよいが、使う前に毎回 ETag で確認させる
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+
+#============================================
+#人物 JSON キャッシュ（ワーカー間で共有）
+#============================================
+#person_to_dict の結果を JSON バイト列のまま保存する。キーは
+#(人物 id, person:<id> の版数, tags の版数, ビルド ID) なので、書き込みで版数が上がれば
+#古いエントリは二度と参照されない（bump_data_versions が念のため消しもする）。
+#既定の保存先は同じホストの全ワーカーで共有する SQLite ファイル（近似 LRU）
+PERSON_CACHE_BACKEND = os.environ.get("PERSON_CACHE", "sqlite")   #"sqlite" / "memory"
+PERSON_CACHE_MAX_ENTRIES = _env_int("PERSON_CACHE_MAX_ENTRIES", 20000)
+PERSON_CACHE_PATH = os.environ.get("PERSON_CACHE_PATH")   #未設定なら DB の URL から決める
+PERSON_CACHE_TOUCH_INTERVAL = 60.0   #最終利用時刻の更新はこの秒数に 1 回まで（読むたびに書かない）
+
+
+class MemoryPersonCacheStore:
+    """プロセス内の LRU（ワーカー 1 つで動かすとき・開発用）"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        with self._lock:
+            found = {}
+            for key in keys:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    found[key] = self._entries[key]
+            return found
+
+    def set_many(self, items):
+        with self._lock:
+            self._entries.update(items)
+            for key in items:
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, person_ids):
+        prefixes = tuple(f"{person_id}:" for person_id in person_ids)
+        if not prefixes:
+            return
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefixes)]:
+                del self._entries[key]
+
+
+class SqlitePersonCacheStore:
+    """同じホストのワーカー間で共有する SQLite ファイルの LRU（最終利用時刻の古い順に追い出す）"""
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS person_cache ("
+        "key TEXT PRIMARY KEY, value BLOB NOT NULL, used_at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS ix_person_cache_used_at ON person_cache (used_at)",
+    )
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+
+    def _conn(self):
+        #接続はスレッドごと・プロセスごと（fork 前の接続は子プロセスで使わない）
+        cached = getattr(self._local, "conn", None)
+        if cached and cached[0] == os.getpid():
+            return cached[1]
+        conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+        self._local.conn = (os.getpid(), conn)
+        return conn
+
+    def get_many(self, keys):
+        if not keys:
+            return {}
+        try:
+            conn = self._conn()
+            placeholders = ",".join("?" * len(keys))
+            rows = conn.execute(
+                f"SELECT key, value, used_at FROM person_cache WHERE key IN ({placeholders})", keys
+            ).fetchall()
+            now = time.time()
+            stale = [(now, key) for key, _, used_at in rows if used_at < now - PERSON_CACHE_TOUCH_INTERVAL]
+            if stale:
+                conn.executemany("UPDATE person_cache SET used_at = ? WHERE key = ?", stale)
+            return {key: bytes(value) for key, value, _ in rows}
+        except sqlite3.Error as e:
+            print("[PersonCache ERROR]", e)
+            return {}
+
+    def set_many(self, items):
+        if not items:
+            return
+        try:
+            conn = self._conn()
+            now = time.time()
+            conn.executemany(
+                "INSERT OR REPLACE INTO person_cache (key, value, used_at) VALUES (?, ?, ?)",
+                [(key, value, now) for key, value in items.items()],
+            )
+            #件数の確認は上限の 1/10 書き込むごとに 1 回
+            self._writes += len(items)
+            if self._writes >= max(self.max_entries // 10, 1):
+                self._writes = 0
+                (count,) = conn.execute("SELECT COUNT(*) FROM person_cache").fetchone()
+                if count > self.max_entries:
+                    conn.execute(
+                        "DELETE FROM person_cache WHERE key IN "
+                        "(SELECT key FROM person_cache ORDER BY used_at LIMIT ?)",
+                        (count - self.max_entries,),
+                    )
+        except sqlite3.Error as e:
+            print("[PersonCache ERROR]", e)
+
+    def invalidate(self, person_ids):
+        if not person_ids:
+            return
+        try:
+            #キーは "<id>:..." なので、主キーの範囲検索で id ごとに消せる（";" は ":" の次の文字）
+            self._conn().executemany(
+                "DELETE FROM person_cache WHERE key >= ? AND key < ?",
+                [(f"{person_id}:", f"{person_id};") for person_id in person_ids],
+            )
+        except sqlite3.Error as e:
+            print("[PersonCache ERROR]", e)
+
+
+def person_cache_path(database_url):
+    """SQLite キャッシュのファイル。DB ごとに別ファイル（同じホストで複数の DB を使っても混ざらないように）"""
+    return PERSON_CACHE_PATH or os.path.join(
+        tempfile.gettempdir(),
+        f"mawarizukan_person_cache_{hashlib.sha1(database_url.encode('utf-8')).hexdigest()[:12]}.sqlite3",
+    )
+
+
+def make_person_cache():
+    """PERSON_CACHE の設定に応じた保存先を返す（ファイルは最初に読み書きするときに開く）"""
+    if PERSON_CACHE_BACKEND == "memory":
+        return MemoryPersonCacheStore(PERSON_CACHE_MAX_ENTRIES)
+    return SqlitePersonCacheStore(person_cache_path(app.config["DATABASE_URL"]), PERSON_CACHE_MAX_ENTRIES)
+
+
+person_cache = make_person_cache()
+
+
+def person_cache_key(person_id, versions):
+    """キャッシュキー（版数が上がるとキーが変わる）"""
+    person_version = versions[f"person:{person_id}"][0]
+    tags_version = versions["tags"][0]
+    return f"{person_id}:{person_version}:{tags_version}:{APP_BUILD_ID}"
+
+
+def person_payloads(person_ids, versions=None):
+    """
+    人物 id のリスト → {id: person_to_dict の JSON バイト列}。
+    キャッシュにない分だけ ORM で読んで入れる。存在しない id は結果に含めない。
+    versions を渡すとその版数を使う（足りないスコープだけ読み足す）。
+    """
+    if not person_ids:
+        return {}
+    scopes = ["tags", *[f"person:{person_id}" for person_id in person_ids]]
+    versions = dict(versions or {})
+    if any(scope not in versions for scope in scopes):
+        versions.update(read_data_versions([scope for scope in scopes if scope not in versions]))
+
+    keys = {person_id: person_cache_key(person_id, versions) for person_id in person_ids}
+    cached = person_cache.get_many(list(keys.values()))
+    payloads = {person_id: cached[key] for person_id, key in keys.items() if key in cached}
+
+    missing = [person_id for person_id in person_ids if person_id not in payloads]
+    if missing:
+        session = Session()
+        try:
+            people = (
+                session.query(Person)
+                .options(selectinload(Person.tags))
+                .filter(Person.id.in_(missing))
+                .all()
+            )
+            fresh = {
+                p.id: json.dumps(person_to_dict(p), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+                for p in people
+            }
+        finally:
+            session.close()
+        person_cache.set_many({keys[person_id]: payload for person_id, payload in fresh.items()})
+        payloads.update(fresh)
+    return payloads
+
+
+def people_json_response(person_ids, next_cursor):
+    """{"people": [...], "next_cursor": ...} をキャッシュ済みのバイト列をつないで返す"""
+    payloads = person_payloads(person_ids)
+    body = b"".join([
+        b'{"people":[',
+        b",".join(payloads[person_id] for person_id in person_ids if person_id in payloads),
+        b'],"next_cursor":',
+        json.dumps(next_cursor).encode("utf-8"),
+        b"}",
+    ])
+    return app.response_class(body, mimetype="application/json")
+
+
+#============================================
+#変更フィード（クライアントが差分だけ取り込めるように）
+#============================================
+#書き込み系ルートは commit と同じトランザクションで change_log に (entity, id, upsert / delete) を積む。
+#クライアントは最後に見た seq を覚えておき、/api/changes?since=<seq> をポーリングして差分だけ受け取る
+#（CHANGE_STREAM_ENABLED=1 なら /api/changes/stream の Server-Sent Events でも届く）。古い履歴は compact_change_log が消すので、
+#消された範囲より前の seq を渡されたら reset: true を返し、全体を取り直してもらう。
+#PostgreSQL では seq の採番と commit の順がずれないよう、記録するトランザクションを
+#advisory lock で 1 つずつにする（SQLite は書き込みがもともと 1 つずつ）
+CHANGE_UPSERT = "upsert"
+CHANGE_DELETE = "delete"
+CHANGE_ENTITIES = ("person", "tag", "relation", "layout")
+CHANGE_LOG_LOCK_ID = 0x6D6178   #PostgreSQL の advisory lock 用
+CHANGE_LOG_RETENTION_SECONDS = _env_int("CHANGE_LOG_RETENTION_SECONDS", 7 * 24 * 3600)
+CHANGE_LOG_MAX_ENTRIES = _env_int("CHANGE_LOG_MAX_ENTRIES", 100000)
+CHANGE_LOG_COMPACT_EVERY = 200    #このプロセスで何回記録したら 1 回掃除するか
+CHANGE_FEED_PAGE_SIZE = 1000      #1 回の応答に含める履歴の最大件数（超えたら has_more）
+CHANGE_STREAM_POLL_INTERVAL = 1.0
+CHANGE_STREAM_HEARTBEAT = 15.0
+#SSE はつないでいる間 gthread のスレッドを 1 本ふさぐ（タブの数だけふさがるとサイトが応答しなくなる）ので既定では無効。
+#有効にするときも同時接続はプロセスごとに CHANGE_STREAM_MAX_CONNECTIONS 本までにし、
+#GUNICORN_THREADS をその分だけ増やしておく。一定時間で切って EventSource に再接続させる
+CHANGE_STREAM_ENABLED = _env_int("CHANGE_STREAM_ENABLED", 0)
+CHANGE_STREAM_MAX_CONNECTIONS = _env_int("CHANGE_STREAM_MAX_CONNECTIONS", 2)
+CHANGE_STREAM_MAX_SECONDS = _env_int("CHANGE_STREAM_MAX_SECONDS", 300)
+_change_stream_slots = threading.BoundedSemaphore(max(CHANGE_STREAM_MAX_CONNECTIONS, 1))
+
+_change_log_writes = 0
+
+
+def record_changes(session, entity, ids, op=CHANGE_UPSERT):
+    """entity の ids が変わった（op）ことを記録する（commit は呼び出し側）"""
+    global _change_log_writes
+    ids = sorted(set(ids))
+    if not ids:
+        return
+    if session.get_bind().dialect.name == "postgresql":
+        session.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": CHANGE_LOG_LOCK_ID})
+    now = time.time()
+    session.execute(insert(ChangeLogEntry), [
+        {"entity": entity, "entity_id": entity_id, "op": op, "created_at": now}
+        for entity_id in ids
+    ])
+
+    _change_log_writes += 1
+    if _change_log_writes % CHANGE_LOG_COMPACT_EVERY == 0:
+        compact_change_log(session)
+
+
+def compact_change_log(session):
+    """保持期間を過ぎた履歴と上限を超えた古い履歴を消す（最新の 1 件は seq の基準として残す）"""
+    newest = session.query(func.max(ChangeLogEntry.seq)).scalar()
+    if newest is None:
+        return 0
+    removed = session.query(ChangeLogEntry).filter(
+        ChangeLogEntry.seq < newest,
+        or_(
+            ChangeLogEntry.created_at < time.time() - CHANGE_LOG_RETENTION_SECONDS,
+            ChangeLogEntry.seq <= newest - CHANGE_LOG_MAX_ENTRIES,
+        ),
+    ).delete(synchronize_session=False)
+    return removed
+
+
+def latest_change_seq(session):
+    """今の最新 seq（履歴がなければ 0）。全体を返す API はこれを先に読んで一緒に返す"""
+    return session.query(func.max(ChangeLogEntry.seq)).scalar() or 0
+
+
+def change_feed(since):
+    """
+    since より後の変更をまとめた JSON（バイト列）、次に渡す seq、続きがあるかを返す。
+    同じものが何度も変わっていれば最後の状態だけ返し、upsert は今の中身を付けて返す
+    （人物は /api/people と同じ形のキャッシュ済みペイロード）。
+    """
+    session = Session()
+    try:
+        oldest, newest = session.query(
+            func.min(ChangeLogEntry.seq), func.max(ChangeLogEntry.seq)
+        ).one()
+        newest = newest or 0
+        #消された範囲をまたぐ / DB が作り直されたなら差分では追いつけない
+        if (oldest is not None and since < oldest - 1) or since > newest:
+            body = {"since": since, "last_seq": newest, "reset": True, "has_more": False}
+            return json.dumps(body).encode("utf-8"), newest, False
+
+        rows = session.query(
+            ChangeLogEntry.seq, ChangeLogEntry.entity, ChangeLogEntry.entity_id, ChangeLogEntry.op
+        ).filter(ChangeLogEntry.seq > since).order_by(ChangeLogEntry.seq).limit(CHANGE_FEED_PAGE_SIZE + 1).all()
+        has_more = len(rows) > CHANGE_FEED_PAGE_SIZE
+        rows = rows[:CHANGE_FEED_PAGE_SIZE]
+        last_seq = rows[-1].seq if rows else since
+
+        latest = {entity: {} for entity in CHANGE_ENTITIES}
+        for _, entity, entity_id, op in rows:
+            if entity in latest:
+                latest[entity][entity_id] = op
+
+        def upserted(entity):
+            return [i for i, op in latest[entity].items() if op == CHANGE_UPSERT]
+
+        relation_ids = upserted("relation")
+        relations = session.query(
+            Relationship.id, Relationship.source_id, Relationship.target_id,
+            Relationship.relation_type, Relationship.strength,
+        ).filter(Relationship.id.in_(relation_ids)).all() if relation_ids else []
+        tag_ids = upserted("tag")
+        tags = session.query(GroupTag.id, GroupTag.name).filter(GroupTag.id.in_(tag_ids)).all() if tag_ids else []
+        layout_state = session.get(GraphLayoutState, 1) if latest["layout"] else None
+    finally:
+        session.close()
+
+    person_ids = upserted("person")
+    payloads = person_payloads(person_ids)
+    #記録のあとで消えたものは削除として返す
+    body = {
+        "since": since,
+        "last_seq": last_seq,
+        "reset": False,
+        "has_more": has_more,
+        "deleted_people": sorted(
+            {i for i, op in latest["person"].items() if op == CHANGE_DELETE} | (set(person_ids) - payloads.keys())
+        ),
+        "relations": [
+            {"id": r.id, "source": r.source_id, "target": r.target_id, "type": r.relation_type, "strength": r.strength}
+            for r in relations
+        ],
+        "deleted_relations": sorted(
+            {i for i, op in latest["relation"].items() if op == CHANGE_DELETE}
+            | (set(relation_ids) - {r.id for r in relations})
+        ),
+        "tags": [{"id": tag_id, "name": name} for tag_id, name in tags],
+        "deleted_tags": sorted(
+            {i for i, op in latest["tag"].items() if op == CHANGE_DELETE} | (set(tag_ids) - {t.id for t in tags})
+        ),
+        "layout_version": layout_state.version if layout_state else None,
+    }
+    #人物はキャッシュ済みのバイト列をそのままつなぐ（people_json_response と同じ）
+    return b"".join([
+        b'{"people":[',
+        b",".join(payloads[person_id] for person_id in person_ids if person_id in payloads),
+        b"],",
+        json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode("utf-8")[1:],
+    ]), last_seq, has_more
+
+
+#============================================
+#ファセット索引（値ごとのビットセット・プロセス内）
+#============================================
+#MBTI・血液型・ラブタイプ・タグの値ごとに「その値を持つ人物」のビットセットを持ち、
+#絞り込みと「ほかの条件はそのままでこの値を選んだら何人か」の件数をビット演算で出す。
+#ビットセットは Python の int（ビット i = スロット i の人物）で、AND / OR / bit_count は C で回る。
+#人物 id はスロット番号に詰め直すので、id が飛んでいてもビット長は人数ぶんで済む。
+#ほかのワーカーの書き込みも含め、change_log を seq 順に読んで変わった人物だけ差し替える
+#（履歴が掃除されて追いつけない・差分が多すぎるときは全体を作り直す）
+FACET_FIELDS = ("mbti", "blood_type", "love_type")
+FACET_MAX_DELTA = 2000       #これより多く変わっていたら差分ではなく作り直す
+FACET_IDS_LIMIT = 1000       #/api/facets が返す id の最大数
+#int.bit_count は Python 3.10 から
+_popcount = getattr(int, "bit_count", None) or (lambda bits: bin(bits).count("1"))
+
+
+def _bitset_slots(bits):
+    """ビットセット → 立っているスロット番号の配列（昇順）"""
+    if not bits:
+        return np.zeros(0, dtype=np.intp)
+    raw = np.frombuffer(bits.to_bytes((bits.bit_length() + 7) // 8, "little"), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(raw, bitorder="little"))
+
+
+def _slots_bitset(slots):
+    """スロット番号の列 → ビットセット"""
+    slots = np.fromiter(slots, dtype=np.intp)
+    if not len(slots):
+        return 0
+    flags = np.zeros(int(slots.max()) + 1, dtype=np.uint8)
+    flags[slots] = 1
+    return int.from_bytes(np.packbits(flags, bitorder="little").tobytes(), "little")
+
+
+class FacetIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()   #DB からの反映は 1 スレッドずつ（古い差分で上書きしない）
+        self._seq = None       #ここまでの change_log を反映済み（None は未構築）
+        self._slot_of = {}     #person_id → スロット
+        self._ids = []         #スロット → person_id（削除済みは None）
+        self._id_array = None  #_ids の numpy 版（検索時に作り、更新で捨てる）
+        self._all = 0          #生きている人物のビットセット
+        self._bits = {}        #(field, 値) → ビットセット。タグは ("tag", tag_id)
+        self._keys = {}        #person_id → その人が立てている (field, 値) のタプル
+
+    #---------- 更新 ----------
+    def rebuild(self, seq, people, tag_links, tag_ids):
+        """people: id 昇順の (id, mbti, blood_type, love_type)、tag_links: (person_id, tag_id) から作り直す"""
+        tags_of = {}
+        for person_id, tag_id in tag_links:
+            tags_of.setdefault(person_id, []).append(tag_id)
+        with self._lock:
+            self._slot_of, self._ids, self._keys = {}, [], {}
+            slots = {}
+            for person_id, *values in people:
+                slot = len(self._ids)
+                self._slot_of[person_id] = slot
+                self._ids.append(person_id)
+                keys = self._person_keys(values, tags_of.get(person_id, ()))
+                self._keys[person_id] = keys
+                for key in keys:
+                    slots.setdefault(key, []).append(slot)
+            self._bits = {("tag", tag_id): 0 for tag_id in tag_ids}
+            self._bits.update((key, _slots_bitset(key_slots)) for key, key_slots in slots.items())
+            self._all = (1 << len(self._ids)) - 1
+            self._id_array = None
+            self._seq = seq
+
+    def apply(self, seq, people, tag_links, removed_people, tag_ids, removed_tags):
+        """change_log の差分を反映する（people / tag_links は変わった人物の今の値）"""
+        tags_of = {}
+        for person_id, tag_id in tag_links:
+            tags_of.setdefault(person_id, []).append(tag_id)
+        with self._lock:
+            for person_id in removed_people:
+                self._remove(person_id)
+                slot = self._slot_of.pop(person_id, None)
+                if slot is not None:
+                    self._ids[slot] = None
+            for person_id, *values in people:
+                self._remove(person_id)
+                slot = self._slot_of.get(person_id)
+                if slot is None:
+                    slot = self._slot_of[person_id] = len(self._ids)
+                    self._ids.append(person_id)
+                keys = self._person_keys(values, tags_of.get(person_id, ()))
+                self._keys[person_id] = keys
+                bit = 1 << slot
+                for key in keys:
+                    self._bits[key] = self._bits.get(key, 0) | bit
+                self._all |= bit
+            for tag_id in tag_ids:
+                self._bits.setdefault(("tag", tag_id), 0)
+            for tag_id in removed_tags:
+                self._bits.pop(("tag", tag_id), None)
+            self._id_array = None
+            self._seq = seq
+
+    @staticmethod
+    def _person_keys(values, tag_ids):
+        keys = [(field, value) for field, value in zip(FACET_FIELDS, values) if value]
+        keys += [("tag", tag_id) for tag_id in tag_ids]
+        return tuple(keys)
+
+    def _remove(self, person_id):
+        #ビットを落とすだけ。削除された人物のスロットは使い回さず空けておく（作り直したときに詰まる）
+        slot = self._slot_of.get(person_id)
+        if slot is None:
+            return
+        mask = ~(1 << slot)
+        for key in self._keys.pop(person_id, ()):
+            if key in self._bits:
+                self._bits[key] &= mask
+        self._all &= mask
+
+    def ensure_fresh(self):
+        """change_log の新しい分を反映する（未構築・追いつけないときは作り直す）"""
+        with self._refresh_lock:
+            self._refresh()
+
+    def _refresh(self):
+        session = Session()
+        try:
+            seq = self._seq
+            if seq is not None:
+                rows = session.query(
+                    ChangeLogEntry.seq, ChangeLogEntry.entity, ChangeLogEntry.entity_id, ChangeLogEntry.op
+                ).filter(ChangeLogEntry.seq > seq).order_by(ChangeLogEntry.seq).limit(FACET_MAX_DELTA + 1).all()
+                if not rows:
+                    return
+                #先頭が飛んでいる = 間の履歴が掃除された
+                if len(rows) <= FACET_MAX_DELTA and rows[0].seq == seq + 1:
+                    self._apply_rows(session, rows)
+                    return
+
+            latest = latest_change_seq(session)   #データより先に読む（この後の変更は次回拾う）
+            people = session.execute(
+                select(Person.id, *[getattr(Person, field) for field in FACET_FIELDS]).order_by(Person.id)
+            ).all()
+            tag_links = session.execute(select(PersonTag.person_id, PersonTag.tag_id)).all()
+            tag_ids = session.scalars(select(GroupTag.id)).all()
+        finally:
+            session.close()
+        self.rebuild(latest, people, tag_links, tag_ids)
+
+    def _apply_rows(self, session, rows):
+        latest = {}
+        for _, entity, entity_id, op in rows:
+            if entity in ("person", "tag"):
+                latest[entity, entity_id] = op
+        person_ids = [i for (entity, i), op in latest.items() if entity == "person" and op == CHANGE_UPSERT]
+        people = session.query(
+            Person.id, *[getattr(Person, field) for field in FACET_FIELDS]
+        ).filter(Person.id.in_(person_ids)).all() if person_ids else []
+        tag_links = session.query(PersonTag.person_id, PersonTag.tag_id).filter(
+            PersonTag.person_id.in_(person_ids)
+        ).all() if person_ids else []
+        #記録のあとで消えた人物も削除として扱う
+        removed_people = [
+            i for (entity, i), op in latest.items() if entity == "person" and op == CHANGE_DELETE
+        ] + sorted(set(person_ids) - {row[0] for row in people})
+        self.apply(
+            rows[-1].seq,
+            people,
+            tag_links,
+            removed_people,
+            [i for (entity, i), op in latest.items() if entity == "tag" and op == CHANGE_UPSERT],
+            [i for (entity, i), op in latest.items() if entity == "tag" and op == CHANGE_DELETE],
+        )
+
+    #---------- 検索 ----------
+    def search(self, selected, tags=(), tag_mode="any", person_ids=None, limit=FACET_IDS_LIMIT):
+        """
+        selected: {field: {値, ...}}（同じ field 内は OR、field 同士は AND）、tags は tag_mode で結ぶ。
+        person_ids を渡すとその人物だけに絞る（名前検索の結果など）。
+        戻り値は (件数, id 昇順の先頭 limit 件, {field: {値: 件数}})。件数は
+        「その field 以外の条件はそのままで、その値を選んだら何人か」（tag_mode=all のタグは追加で絞った数）
+        """
+        with self._lock:
+            bits, all_bits = self._bits, self._all
+            base = all_bits
+            if person_ids is not None:
+                base &= _slots_bitset(self._slot_of[i] for i in person_ids if i in self._slot_of)
+
+            masks = {}
+            for field in FACET_FIELDS:
+                values = selected.get(field)
+                if values:
+                    mask = 0
+                    for value in values:
+                        mask |= bits.get((field, value), 0)
+                    masks[field] = mask
+            if tags:
+                tag_bits = [bits.get(("tag", tag_id), 0) for tag_id in tags]
+                masks["tags"] = functools.reduce(
+                    (lambda a, b: a & b) if tag_mode == "all" else (lambda a, b: a | b), tag_bits
+                )
+
+            def matching(skip=None):
+                result = base
+                for name, mask in masks.items():
+                    if name != skip:
+                        result &= mask
+                return result
+
+            total_bits = matching()
+            counts = {field: {} for field in (*FACET_FIELDS, "tags")}
+            others = {field: matching(field) for field in FACET_FIELDS}
+            others["tags"] = total_bits if tag_mode == "all" else matching("tags")
+            for (field, value), value_bits in bits.items():
+                if field == "tag":
+                    counts["tags"][value] = _popcount(others["tags"] & value_bits)
+                else:
+                    counts[field][value] = _popcount(others[field] & value_bits)
+
+            slots = _bitset_slots(total_bits)
+            if self._id_array is None:
+                self._id_array = np.array([-1 if i is None else i for i in self._ids], dtype=np.int64)
+            ids = self._id_array[slots]
+            if limit < len(ids):
+                ids = np.partition(ids, limit)[:limit] if limit else ids[:0]
+            return len(slots), sorted(ids.tolist()), counts
+
+
+facet_index = FacetIndex()
+
+
+#============================================
+#一括インポート / エクスポート（CSV / JSONL）
+#============================================
+#行はジェネレーターで 1 行ずつ読み、IMPORT_BATCH_SIZE 行ごとに executemany で
+#まとめて INSERT して commit する（途中で失敗しても済んだバッチは残る）。
+#JSONL は {"type": "tag" | "person" | "relation", ...} の混在ストリーム（エクスポートと同じ形）。
+#CSV は 1 ファイル 1 種類（kind=people / relations）。タグは "|" 区切りのタグ名。
+#relation の source / target は、同じストリームで読んだ person の "id" があれば
+#その人物（新しい id に読み替え）、なければ既存の人物 id として扱う。
+#グラフのレイアウトはここでは計算せず、新しい人物と関係の両端をレイアウトジョブに積む
+#（座標が付くまでは load_layout が返さず、クライアントの物理演算が配置する）。
+IMPORT_BATCH_SIZE = _env_int("IMPORT_BATCH_SIZE", 1000)
+IMPORT_MAX_ERRORS = 100       #進捗 1 回あたりに返すエラーの最大件数
+EXPORT_BATCH_SIZE = 1000
+TRANSFER_FORMATS = ("jsonl", "csv")
+TRANSFER_KINDS = ("people", "relations")
+PERSON_IMPORT_FIELDS = ("name", "reading", "birth", "blood_type", "mbti", "love_type", "phrase", "image_path")
+PEOPLE_CSV_FIELDS = ("id",) + PERSON_IMPORT_FIELDS + ("tags",)
+RELATION_CSV_FIELDS = ("id", "source", "target", "relation_type", "strength")
+CSV_TAG_SEPARATOR = "|"
+
+
+def read_import_records(stream, fmt, kind="people"):
+    """バイナリストリームを 1 行ずつ読み、(行番号, レコード) を返す（壊れた行はレコード None）"""
+    text_stream = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    if fmt == "jsonl":
+        for line_no, line in enumerate(text_stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield line_no, record if isinstance(record, dict) else None
+        return
+
+    record_type = "person" if kind == "people" else "relation"
+    #1 行目はヘッダーなのでデータは 2 行目から
+    for line_no, row in enumerate(csv.DictReader(text_stream), 2):
+        record = {key: value for key, value in row.items() if key is not None}
+        record["type"] = record_type
+        if record_type == "person":
+            record["tags"] = [t for t in (record.get("tags") or "").split(CSV_TAG_SEPARATOR) if t]
+        yield line_no, record
+
+
+def resolve_tag_ids(session, names):
+    """タグ名 → id。無いタグはまとめて作る（commit は呼び出し側）。戻り値は ({名前: id}, 作ったタグの id)"""
+    names = {name for name in names if name}
+    if not names:
+        return {}, []
+    found = dict(
+        session.query(GroupTag.name, GroupTag.id).filter(GroupTag.name.in_(names)).all()
+    )
+    missing = sorted(names - found.keys())
+    if missing:
+        new_ids = session.scalars(
+            insert(GroupTag).returning(GroupTag.id, sort_by_parameter_order=True),
+            [{"name": name} for name in missing],
+        ).all()
+        found.update(zip(missing, new_ids))
+        return found, new_ids
+    return found, []
+
+
+def _import_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def import_records(records, batch_size=IMPORT_BATCH_SIZE):
+    """
+    (行番号, レコード) を batch_size 件ずつ取り込み、バッチごとに進捗 dict を返すジェネレーター。
+    最後は "done": True 付きの合計を返す。
+    """
+    id_map = {}       #ストリーム内の person "id" → 登録された id
+    totals = {"rows": 0, "people": 0, "tags": 0, "relations": 0, "error_count": 0}
+
+    batch = []
+    for item in records:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield _import_batch(batch, id_map, totals)
+            batch = []
+    if batch:
+        yield _import_batch(batch, id_map, totals)
+    yield dict(totals, done=True)
+
+
+def _import_batch(batch, id_map, totals):
+    """1 バッチ分を 1 トランザクションで取り込み、進捗 dict を返す"""
+    errors = []
+    tags, people, relations = [], [], []
+    for line_no, record in batch:
+        record_type = record.get("type") if record else None
+        if record_type == "tag" and record.get("name"):
+            tags.append(str(record["name"]))
+        elif record_type == "person" and str(record.get("name") or "").strip():
+            people.append((line_no, record))
+        elif record_type == "relation":
+            relations.append((line_no, record))
+        else:
+            errors.append({"line": line_no, "error": "invalid record"})
+
+    batch_map, pairs, existing, inserts = {}, {}, {}, []
+    new_ids, new_relation_ids, created_tags = [], [], []
+    session = Session()
+    try:
+        tag_ids, created_tags = resolve_tag_ids(
+            session, tags + [str(t) for _, r in people for t in (r.get("tags") or [])]
+        )
+
+        #人物: executemany + RETURNING で id を受け取り、タグ行もまとめて入れる
+        person_rows = [
+            {
+                field: str(record[field]) if record.get(field) is not None else ""
+                for field in PERSON_IMPORT_FIELDS
+            }
+            for _, record in people
+        ]
+        for row in person_rows:
+            row["image_path"] = row["image_path"] or None
+            row.update(birth_columns(row["birth"]))
+        new_ids = session.scalars(
+            insert(Person).returning(Person.id, sort_by_parameter_order=True), person_rows
+        ).all() if person_rows else []
+
+        tag_rows = []
+        for (_, record), person_id in zip(people, new_ids):
+            if record.get("id") is not None:
+                batch_map[_import_int(record["id"])] = person_id
+            for tag_id in {tag_ids[str(t)] for t in (record.get("tags") or []) if str(t) in tag_ids}:
+                tag_rows.append({"person_id": person_id, "tag_id": tag_id})
+        if tag_rows:
+            session.execute(insert(PersonTag), tag_rows)
+        bump_stat_counters_many(session, [(None, stat_values_from_row(row)) for row in person_rows])
+
+        #関係: ストリーム内 id を読み替え、既存の組み合わせは UPDATE、新しい組み合わせは INSERT
+        unresolved = set()
+        for line_no, record in relations:
+            source, target = _import_int(record.get("source")), _import_int(record.get("target"))
+            strength = _import_int(record.get("strength"))
+            if source is None or target is None or strength is None or not record.get("relation_type"):
+                errors.append({"line": line_no, "error": "invalid relation"})
+                continue
+            source = batch_map.get(source) or id_map.get(source) or source
+            target = batch_map.get(target) or id_map.get(target) or target
+            if source == target:
+                errors.append({"line": line_no, "error": "self relation"})
+                continue
+            pair = tuple(sorted((source, target)))
+            pairs[pair] = (line_no, str(record["relation_type"]), strength)
+            unresolved.update(pair)
+
+        if pairs:
+            known = set(new_ids) | {
+                row[0] for row in session.query(Person.id).filter(Person.id.in_(unresolved - set(new_ids)))
+            }
+            for pair in [p for p in pairs if not set(p) <= known]:
+                errors.append({"line": pairs.pop(pair)[0], "error": "unknown person"})
+
+        existing = {
+            (source, target): relation_id
+            for relation_id, source, target in session.query(
+                Relationship.id, Relationship.source_id, Relationship.target_id
+            ).filter(tuple_(Relationship.source_id, Relationship.target_id).in_(list(pairs)))
+        } if pairs else {}
+        updates = [
+            {"id": existing[pair], "relation_type": relation_type, "strength": strength}
+            for pair, (_, relation_type, strength) in pairs.items()
+            if pair in existing
+        ]
+        inserts = [
+            {"source_id": pair[0], "target_id": pair[1], "relation_type": relation_type, "strength": strength}
+            for pair, (_, relation_type, strength) in pairs.items()
+            if pair not in existing
+        ]
+        if updates:
+            session.execute(update(Relationship), updates)
+        new_relation_ids = session.scalars(
+            insert(Relationship).returning(Relationship.id, sort_by_parameter_order=True), inserts
+        ).all() if inserts else []
+
+        scopes = []
+        if new_ids:
+            scopes.append("people")
+        if created_tags or tag_rows:
+            scopes.append("tags")
+        if pairs:
+            scopes.append("relations")
+        if scopes:
+            bump_data_versions(session, *scopes)
+        record_changes(session, "person", new_ids)
+        record_changes(session, "tag", created_tags)
+        record_changes(session, "relation", [existing[pair] for pair in pairs if pair in existing] + new_relation_ids)
+        if new_ids or pairs:
+            enqueue_layout_job(session, list(new_ids) + [i for pair in pairs for i in pair])
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        print("[Import ERROR]", e)
+        first_line, last_line = batch[0][0], batch[-1][0]
+        errors.append({"line": first_line, "error": f"batch {first_line}-{last_line} failed: {type(e).__name__}"})
+        batch_map, pairs, existing, inserts = {}, {}, {}, []
+        new_ids, new_relation_ids, created_tags = [], [], []
+    finally:
+        session.close()
+
+    #commit できたものだけインデックスに反映する
+    id_map.update(batch_map)
+    for (_, record), person_id in zip(people, new_ids):
+        search_index.upsert(person_id, str(record["name"]), str(record.get("reading") or ""))
+    relation_ids = {pair: existing[pair] for pair in pairs if pair in existing}
+    relation_ids.update(zip([(i["source_id"], i["target_id"]) for i in inserts], new_relation_ids))
+    for pair, relation_id in relation_ids.items():
+        _, relation_type, strength = pairs[pair]
+        relation_graph.upsert_edge(relation_id, pair[0], pair[1], relation_type, strength)
+
+    totals["rows"] += len(batch)
+    totals["people"] += len(new_ids)
+    totals["tags"] += len(created_tags)
+    totals["relations"] += len(relation_ids)
+    totals["error_count"] += len(errors)
+    return dict(totals, errors=errors[:IMPORT_MAX_ERRORS])
+
+
+def _export_people_batches(session):
+    """人物を id 順に EXPORT_BATCH_SIZE 件ずつ（タグ名付きで）返す"""
+    last_id = 0
+    while True:
+        rows = session.execute(
+            select(Person.id, *[getattr(Person, field) for field in PERSON_IMPORT_FIELDS])
+            .where(Person.id > last_id)
+            .order_by(Person.id)
+            .limit(EXPORT_BATCH_SIZE)
+        ).all()
+        if not rows:
+            return
+        last_id = rows[-1].id
+
+        tag_names = {}
+        for person_id, tag_name in session.execute(
+            select(PersonTag.person_id, GroupTag.name)
+            .join(GroupTag, GroupTag.id == PersonTag.tag_id)
+            .where(PersonTag.person_id.in_([row.id for row in rows]))
+            .order_by(GroupTag.name)
+        ):
+            tag_names.setdefault(person_id, []).append(tag_name)
+
+        yield [
+            dict(row._mapping, tags=tag_names.get(row.id, []))
+            for row in rows
+        ]
+
+
+def _export_relation_batches(session):
+    """関係を id 順に EXPORT_BATCH_SIZE 件ずつ返す"""
+    last_id = 0
+    while True:
+        rows = session.execute(
+            select(
+                Relationship.id,
+                Relationship.source_id.label("source"),
+                Relationship.target_id.label("target"),
+                Relationship.relation_type,
+                Relationship.strength,
+            )
+            .where(Relationship.id > last_id)
+            .order_by(Relationship.id)
+            .limit(EXPORT_BATCH_SIZE)
+        ).all()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        yield [dict(row._mapping) for row in rows]
+
+
+def export_jsonl(kind=None):
+    """JSONL を少しずつ返すジェネレーター（kind=None ならタグ・人物・関係すべて）"""
+    session = Session()
+    try:
+        if kind is None:
+            for (name,) in session.query(GroupTag.name).order_by(GroupTag.id):
+                yield json.dumps({"type": "tag", "name": name}, ensure_ascii=False) + "\n"
+        if kind in (None, "people"):
+            for rows in _export_people_batches(session):
+                yield "".join(
+                    json.dumps({"type": "person", **row}, ensure_ascii=False) + "\n" for row in rows
+                )
+        if kind in (None, "relations"):
+            for rows in _export_relation_batches(session):
+                yield "".join(
+                    json.dumps({"type": "relation", **row}, ensure_ascii=False) + "\n" for row in rows
+                )
+    finally:
+        session.close()
+
+
+def export_csv(kind):
+    """CSV を少しずつ返すジェネレーター（kind は people / relations）"""
+    fields = PEOPLE_CSV_FIELDS if kind == "people" else RELATION_CSV_FIELDS
+    batches = _export_people_batches if kind == "people" else _export_relation_batches
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+
+    session = Session()
+    try:
+        for rows in batches(session):
+            for row in rows:
+                if kind == "people":
+                    row["tags"] = CSV_TAG_SEPARATOR.join(row["tags"])
+                writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+    finally:
+        session.close()
+
+
+#============================================
+#計測（リクエストごとの SQL・レイテンシ、/metrics）
+#============================================
+#SQLAlchemy のカーソルイベントと Flask のリクエストフックで、ルートごとに
+#レイテンシ・クエリ数・DB 時間・ORM で組み立てた行数を集計する。
+#同じ SQL が 1 リクエストで N_PLUS_ONE_THRESHOLD 回以上流れたら N+1 として警告し、
+#SLOW_REQUEST_SECONDS を超えたリクエストは遅い SQL と一緒にログに出す。
+#集計はワーカープロセスごと（/metrics はそのプロセスの値を返す）
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", "0.5"))
+N_PLUS_ONE_THRESHOLD = _env_int("N_PLUS_ONE_THRESHOLD", 5)
+SLOW_LOG_STATEMENTS = 3     #遅いリクエストのログに出す SQL の件数
+SLOW_LOG_SQL_LENGTH = 300
+
+_request_stats = threading.local()
+
+
+class RequestStats:
+    """1 リクエスト分の計測値"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.statements = Counter()
+        self.slowest = []   #(秒, SQL) の最小ヒープ（遅い順に SLOW_LOG_STATEMENTS 件だけ残す）
+
+    def record_query(self, statement, elapsed):
+        self.queries += 1
+        self.db_time += elapsed
+        self.statements[statement] += 1
+        heapq.heappush(self.slowest, (elapsed, statement))
+        if len(self.slowest) > SLOW_LOG_STATEMENTS:
+            heapq.heappop(self.slowest)
+
+    def repeated_statements(self):
+        """N+1 っぽい（同じ SQL が何度も流れた）もの"""
+        return [(stmt, n) for stmt, n in self.statements.most_common() if n >= N_PLUS_ONE_THRESHOLD]
+
+
+def current_request_stats():
+    """今のスレッドで計測中のリクエスト（リクエスト外・ワーカースレッドでは None）"""
+    return getattr(_request_stats, "stats", None)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _metrics_before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_started = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _metrics_after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_request_stats()
+    started = getattr(context, "_metrics_started", None)
+    if stats is not None and started is not None:
+        stats.record_query(statement, time.perf_counter() - started)
+
+
+@event.listens_for(Base, "load", propagate=True)
+def _metrics_count_hydrated(target, context):
+    stats = current_request_stats()
+    if stats is not None:
+        stats.rows += 1
+
+
+def _metric_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsRegistry:
+    """ルートごとの集計（プロセス内）。render() で Prometheus のテキスト形式にする"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.requests = Counter()       #(endpoint, method, status) → 件数
+        self.latency = {}               #(endpoint, method) → [バケットごとの件数..., 合計秒, 件数]
+        self.db_queries = Counter()     #endpoint → クエリ数
+        self.db_seconds = Counter()     #endpoint → DB 時間
+        self.rows_hydrated = Counter()  #endpoint → ORM で組み立てた行数
+        self.n_plus_one = Counter()     #endpoint → N+1 を検出したリクエスト数
+
+    def observe(self, endpoint, method, status, elapsed, stats):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            hist = self.latency.setdefault((endpoint, method), [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if elapsed <= bound:
+                    hist[i] += 1
+            hist[-2] += elapsed
+            hist[-1] += 1
+            self.db_queries[endpoint] += stats.queries
+            self.db_seconds[endpoint] += stats.db_time
+            self.rows_hydrated[endpoint] += stats.rows
+            if stats.repeated_statements():
+                self.n_plus_one[endpoint] += 1
+
+    def render(self):
+        lines = []
+        with self._lock:
+            lines += [
+                "# HELP mawarizukan_http_requests_total HTTP requests by route and status.",
+                "# TYPE mawarizukan_http_requests_total counter",
+            ]
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(
+                    f'mawarizukan_http_requests_total{{endpoint="{_metric_label(endpoint)}",'
+                    f'method="{method}",status="{status}"}} {count}'
+                )
+
+            lines += [
+                "# HELP mawarizukan_http_request_duration_seconds Request latency by route.",
+                "# TYPE mawarizukan_http_request_duration_seconds histogram",
+            ]
+            for (endpoint, method), hist in sorted(self.latency.items()):
+                labels = f'endpoint="{_metric_label(endpoint)}",method="{method}"'
+                for bound, count in zip(self.buckets, hist):
+                    lines.append(
+                        f'mawarizukan_http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}'
+                    )
+                lines.append(f'mawarizukan_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {hist[-1]}')
+                lines.append(f"mawarizukan_http_request_duration_seconds_sum{{{labels}}} {hist[-2]:.6f}")
+                lines.append(f"mawarizukan_http_request_duration_seconds_count{{{labels}}} {hist[-1]}")
+
+            for name, help_text, values in (
+                ("mawarizukan_db_queries_total", "SQL statements executed by route.", self.db_queries),
+                ("mawarizukan_db_seconds_total", "Time spent in SQL by route.", self.db_seconds),
+                ("mawarizukan_rows_hydrated_total", "ORM instances loaded by route.", self.rows_hydrated),
+                ("mawarizukan_n_plus_one_requests_total", "Requests with repeated identical SQL.", self.n_plus_one),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                for endpoint, value in sorted(values.items()):
+                    formatted = f"{value:.6f}" if isinstance(value, float) else value
+                    lines.append(f'{name}{{endpoint="{_metric_label(endpoint)}"}} {formatted}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry(METRICS_LATENCY_BUCKETS)
+
+
+def _compact_sql(statement):
+    return " ".join(statement.split())[:SLOW_LOG_SQL_LENGTH]
+
+
+@app.before_request
+def start_request_metrics():
+    _request_stats.stats = RequestStats()
+
+
+@app.after_request
+def finish_request_metrics(response):
+    stats = current_request_stats()
+    if stats is None:
+        return response
+    elapsed = time.perf_counter() - stats.started
+    endpoint = request.endpoint or "unmatched"
+    metrics.observe(endpoint, request.method, response.status_code, elapsed, stats)
+
+    for statement, count in stats.repeated_statements():
+        print(f"[N+1 WARNING] {endpoint}: {count}x {_compact_sql(statement)}")
+    if elapsed >= SLOW_REQUEST_SECONDS:
+        print(
+            f"[SLOW REQUEST] {request.method} {request.full_path.rstrip('?')} "
+            f"{elapsed * 1000:.0f}ms queries={stats.queries} db={stats.db_time * 1000:.0f}ms rows={stats.rows}"
+        )
+        for query_time, statement in sorted(stats.slowest, reverse=True):
+            print(f"    {query_time * 1000:.1f}ms {_compact_sql(statement)}")
+    return response
+
+
+@app.teardown_request
+def clear_request_metrics(exc):
+    _request_stats.stats = None
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus のテキスト形式で計測値を返す"""
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+#============================================
+#ページ系ルート
+#============================================
+
+@app.before_request
+def ensure_image_workers():
+    #ワーカースレッドはフォーク後（最初のリクエスト時）に起動する
+    start_image_workers()
+
+
+@app.route("/")
+@conditional_response("people", "tags")
+def index():
+    """トップページ：図鑑表示（最初の 1 ページだけサーバー側で描画、続きは /api/people）"""
+    session = Session()
+    try:
+        change_seq = latest_change_seq(session)   #データより先に読む（この後の変更はポーリングで拾う）
+        #id だけページングし、中身は人物キャッシュから取る
+        person_ids, next_cursor = paginate_people(session.query(Person.id), "id", INDEX_PAGE_SIZE)
+
+        tags = session.query(GroupTag).all()
+
+        payloads = person_payloads(person_ids)
+        people_json = [json.loads(payloads[i]) for i in person_ids if i in payloads]
+
+        return render_template(
+            "index.html",
+            title="図鑑",
+            people=people_json,
+            next_cursor=next_cursor,
+            change_seq=change_seq,
+            page_size=INDEX_PAGE_SIZE,
+            tags=tags,
+            MBTI_LABELS=MBTI_LABELS,
+            LOVE_LABELS=LOVE_LABELS,
+            active="index"
+        )
+    finally:
+        session.close()
+
+
+@app.route("/register", methods=["GET", "POST"])
+def register():
+    """登録画面（GET）＋ 登録処理（POST）"""
+    session = Session()
+    try:
+        tags = session.query(GroupTag).all()
+
+        if request.method == "POST":
+            name = request.form["name"]
+            reading = request.form.get("reading", "")
+            birth = request.form.get("birth", "")
+            blood_type = request.form.get("blood_type", "")
+            mbti = request.form.get("mbti", "")
+            love_type = request.form.get("love_type", "")
+            phrase = request.form.get("phrase", "")
+
+            image_file = request.files.get("image")
+            image_url, image_status = upload_image(image_file, session)
+
+            person = Person(
+                name=name,
+                reading=reading,
                 birth=birth,
                 blood_type=blood_type,
                 mbti=mbti,
                 love_type=love_type,
                 phrase=phrase,
                 image_path=image_url,
+                image_status=image_status,
             )
             session.add(person)
-            session.commit()
+            bump_stat_counters(session, new=stat_values(person))
+            session.flush()  #id だけ先に採番し、タグと一緒に 1 回で commit する
 
             #タグ登録
-            selected_tags = request.form.getlist("tags")
-            for tag_id in selected_tags:
-                session.add(PersonTag(person_id=person.id, tag_id=int(tag_id)))
+            selected_tag_ids = {int(tag_id) for tag_id in request.form.getlist("tags")}
+            sync_person_tags(session, {person.id: selected_tag_ids}, current={})
+            bump_data_versions(session, "people", f"person:{person.id}")
+            record_changes(session, "person", [person.id])
+            enqueue_layout_job(session, [person.id])
             session.commit()
+            search_index.upsert(person.id, person.name, person.reading)
+            notify_image_workers()
 
             return redirect(url_for("index"))
 
@@ -396,6 +3833,8 @@ def edit_person(person_id):
         ]
 
         if request.method == "POST":
+            old_stats = stat_values(person)
+
             #基本情報の更新
             person.name = request.form["name"]
             person.reading = request.form.get("reading", "")
@@ -405,19 +3844,30 @@ def edit_person(person_id):
             person.love_type = request.form.get("love_type", "")
             person.phrase = request.form.get("phrase", "")
 
-            #新しい画像がアップロードされた場合だけ Cloudinary に再アップロード
+            #新しい画像がアップロードされた場合だけ保存ジョブを積む
             image_file = request.files.get("image")
-            new_image_url = upload_image(image_file)
+            new_image_url, image_status = upload_image(image_file, session)
             if new_image_url:
+                old_image_url = person.image_path
                 person.image_path = new_image_url
+                person.image_status = image_status
+                #差し替え前の画像は、他の人物も使っていなければ削除ジョブを積む
+                if old_image_url != new_image_url:
+                    session.flush()
+                    delete_images(session, unreferenced_images(session, [old_image_url]))
+
+            #タグ更新（変わったリンクだけ追加・削除）
+            selected_tag_ids = {int(tid) for tid in request.form.getlist("tags")}
+            sync_person_tags(
+                session, {person_id: selected_tag_ids}, current={person_id: set(current_tag_ids)}
+            )
 
-            #タグ更新（全部削除して追加し直す）
-            session.query(PersonTag).filter_by(person_id=person_id).delete()
-            selected_tag_ids = [int(tid) for tid in request.form.getlist("tags")]
-            for tag_id in selected_tag_ids:
-                session.add(PersonTag(person_id=person_id, tag_id=tag_id))
-
+            bump_stat_counters(session, old=old_stats, new=stat_values(person))
+            bump_data_versions(session, "people", f"person:{person_id}")
+            record_changes(session, "person", [person_id])
             session.commit()
+            search_index.upsert(person.id, person.name, person.reading)
+            notify_image_workers()
             return redirect(url_for("index"))
 
         #GET 表示用データ
@@ -435,27 +3885,59 @@ def edit_person(person_id):
         session.close()
 
 
+def delete_people(session, person_ids):
+    """
+    人物をまとめて削除し、実際に消した id の一覧を返す（commit は呼び出し側）。
+    タグ・関係・座標の行は外部キーの ON DELETE CASCADE で消えるので、DELETE は people への 1 回だけ。
+    誰にも使われなくなった画像は削除ジョブにまとめて積む
+    """
+    rows = session.execute(
+        select(Person.id, Person.mbti, Person.love_type, Person.blood_type, Person.image_path)
+        .where(Person.id.in_(set(person_ids)))
+    ).all()
+    deleted_ids = sorted(row.id for row in rows)
+    if not deleted_ids:
+        return []
+
+    #カスケードで消える関係は変更フィード用に、その相手はレイアウトの緩和用に控えておく
+    relations = session.execute(
+        select(Relationship.id, Relationship.source_id, Relationship.target_id).where(or_(
+            Relationship.source_id.in_(deleted_ids), Relationship.target_id.in_(deleted_ids)
+        ))
+    ).all()
+    record_changes(session, "relation", [r.id for r in relations], CHANGE_DELETE)
+    neighbors = {i for r in relations for i in (r.source_id, r.target_id)} - set(deleted_ids)
+    if neighbors:
+        enqueue_layout_job(session, neighbors)
+    record_changes(session, "person", deleted_ids, CHANGE_DELETE)
+    bump_stat_counters_many(session, [(stat_values(row), None) for row in rows])
+    bump_data_versions(session, "people", "relations", *[f"person:{i}" for i in deleted_ids])
+
+    session.execute(
+        delete(Person).where(Person.id.in_(deleted_ids)).execution_options(synchronize_session="fetch")
+    )
+    #同じ画像を残った人物が使っていれば残す
+    delete_images(session, unreferenced_images(session, [row.image_path for row in rows]))
+    return deleted_ids
+
+
+def after_people_deleted(deleted_ids):
+    """削除を commit したあとに、プロセス内の索引を追いつかせ、画像・レイアウトのジョブを起こす"""
+    for person_id in deleted_ids:
+        search_index.remove(person_id)
+        relation_graph.remove_node(person_id)
+    if deleted_ids:
+        notify_image_workers()
+
+
 @app.route("/delete/<int:person_id>", methods=["POST"])
 def delete_person(person_id):
     """人物削除"""
     session = Session()
     try:
-        person = session.query(Person).filter_by(id=person_id).first()
-
-        if person:
-            #関連するタグ・関係データも削除
-            session.query(PersonTag).filter_by(person_id=person_id).delete(synchronize_session=False)
-            session.query(Relationship).filter(
-                (Relationship.source_id == person_id) | (Relationship.target_id == person_id)
-            ).delete(synchronize_session=False)
-
-            #Cloudinary の画像削除（ある場合）
-            if person.image_path:
-                delete_cloudinary_image_by_url(person.image_path)
-
-            #DB から人物削除（PersonTag 側は外部キー設定に依存、なければ手動削除も検討）
-            session.delete(person)
-            session.commit()
+        deleted_ids = delete_people(session, [person_id])
+        session.commit()
+        after_people_deleted(deleted_ids)
 
         return redirect(url_for("index"))
     finally:
@@ -471,7 +3953,11 @@ def settings():
         if request.method == "POST":
             new_tag = request.form.get("tag_name")
             if new_tag and not session.query(GroupTag).filter_by(name=new_tag).first():
-                session.add(GroupTag(name=new_tag))
+                tag = GroupTag(name=new_tag)
+                session.add(tag)
+                session.flush()
+                bump_data_versions(session, "tags")
+                record_changes(session, "tag", [tag.id])
                 session.commit()
 
         #タグ削除（GET パラメータ delete）
@@ -480,8 +3966,16 @@ def settings():
             delete_id_int = int(delete_id)
             tag = session.query(GroupTag).filter_by(id=delete_id_int).first()
             if tag:
-                #PersonTag → GroupTag の順に削除
+                #タグが外れる人物の tags も変わる
+                tagged_ids = [
+                    person_id for (person_id,) in
+                    session.query(PersonTag.person_id).filter_by(tag_id=delete_id_int)
+                ]
+                #PersonTag の行は外部キーの ON DELETE CASCADE で消える
                 session.delete(tag)
+                bump_data_versions(session, "tags")
+                record_changes(session, "tag", [delete_id_int], CHANGE_DELETE)
+                record_changes(session, "person", tagged_ids)
                 session.commit()
 
         tags = session.query(GroupTag).all()
@@ -501,102 +3995,428 @@ def compatibility_page():
 #API 系ルート
 #============================================
 
-@app.route("/person/<int:person_id>")
-def get_person(person_id):
-    """人物詳細（JSON）"""
+@app.route("/person/<int:person_id>")
+@conditional_response("person:{person_id}", "tags")
+def get_person(person_id):
+    """人物詳細（JSON）。キャッシュが温まっていれば ORM には触らない"""
+    payload = person_payloads([person_id], g.data_versions).get(person_id)
+    if payload is None:
+        return jsonify({"error": "not found"}), 404
+    return app.response_class(payload, mimetype="application/json")
+
+
+@app.route("/filter", methods=["POST"])
+@conditional_response("people", "tags")
+def filter_people():
+    """
+    人物フィルター（JSON 返却）。
+    タグ条件は EXISTS で SQL 側に寄せ、タグは selectinload でまとめて読む。
+    tag_mode: "any"（いずれかのタグ）/ "all"（全タグ）
+    sort / limit / cursor: /api/people と同じキーセットページング
+    """
+    data = request.get_json() or {}
+    name = data.get("name", "").strip()
+    blood_type = data.get("blood_type", "")
+    mbti = data.get("mbti", "")
+    love_type = data.get("love_type", "")
+    tag_mode = data.get("tag_mode", "any")
+    cursor = data.get("cursor")
+
+    try:
+        tags = [int(t) for t in data.get("tags", [])]
+        limit, sort = parse_page_args(data.get("limit"), data.get("sort", "id"))
+    except (TypeError, ValueError):
+        return jsonify({"error": "invalid parameters"}), 400
+
+    if tag_mode not in ("any", "all"):
+        return jsonify({"error": "tag_mode must be 'any' or 'all'"}), 400
+
+    session = Session()
+    try:
+        query = session.query(Person.id)
+
+        if name:
+            #正規化済みインデックスで name / reading の部分一致を引く
+            search_index.ensure_fresh()
+            matched_ids = search_index.match_ids(name)
+            if matched_ids is not None and len(matched_ids) <= SEARCH_FILTER_MAX_IDS:
+                query = query.filter(Person.id.in_(matched_ids))
+            else:
+                query = query.filter(
+                    Person.name.contains(name) | Person.reading.contains(name)
+                )
+        if blood_type:
+            query = query.filter(Person.blood_type == blood_type)
+        if mbti:
+            query = query.filter(Person.mbti == mbti)
+        if love_type:
+            query = query.filter(Person.love_type == love_type)
+        if tags:
+            query = query.filter(tag_filter_clause(tags, tag_mode))
+
+        try:
+            person_ids, next_cursor = paginate_people(query, sort, limit, cursor)
+        except ValueError:
+            return jsonify({"error": "invalid cursor"}), 400
+
+        return people_json_response(person_ids, next_cursor)
+    finally:
+        session.close()
+
+
+@app.route("/api/facets", methods=["POST"])
+@conditional_response("people", "tags")
+def api_facets():
+    """
+    ファセット検索。本文は /filter と同じ形（mbti / blood_type / love_type は値か値のリスト）。
+    {"total": 件数, "ids": id 昇順の先頭 limit 件, "counts": {field: {値: 件数}}} を返す。
+    counts は「その field 以外の条件はそのままで、その値を選んだら何人か」
+    """
+    data = request.get_json(silent=True) or {}
+    name = str(data.get("name") or "").strip()
+    tag_mode = data.get("tag_mode", "any")
+    try:
+        tags = [int(t) for t in data.get("tags") or []]
+        limit = int(data.get("limit", 100))
+    except (TypeError, ValueError):
+        return jsonify({"error": "invalid parameters"}), 400
+    if tag_mode not in ("any", "all"):
+        return jsonify({"error": "tag_mode must be 'any' or 'all'"}), 400
+    if not 0 <= limit <= FACET_IDS_LIMIT:
+        return jsonify({"error": f"limit must be 0..{FACET_IDS_LIMIT}"}), 400
+
+    selected = {}
+    for field in FACET_FIELDS:
+        values = data.get(field)
+        values = values if isinstance(values, list) else [values]
+        selected[field] = {str(v) for v in values if v}
+
+    person_ids = None
+    if name:
+        search_index.ensure_fresh()
+        person_ids = search_index.match_ids(name)
+
+    facet_index.ensure_fresh()
+    total, ids, counts = facet_index.search(selected, tags, tag_mode, person_ids, limit)
+    return jsonify({"total": total, "ids": ids, "counts": counts})
+
+
+@app.route("/api/people")
+@conditional_response("people", "tags")
+def api_people():
+    """
+    人物一覧（JSON）。キーセットページングで少しずつ返す。
+    ?sort=id|reading|name|birth|age|birthday&limit=N&cursor=<前ページの next_cursor>
+    """
+    try:
+        limit, sort = parse_page_args(
+            request.args.get("limit"), request.args.get("sort", "id")
+        )
+    except ValueError:
+        return jsonify({"error": "invalid parameters"}), 400
+
+    session = Session()
+    try:
+        try:
+            person_ids, next_cursor = paginate_people(
+                session.query(Person.id), sort, limit, request.args.get("cursor")
+            )
+        except ValueError:
+            return jsonify({"error": "invalid cursor"}), 400
+
+        return people_json_response(person_ids, next_cursor)
+    finally:
+        session.close()
+
+
+@app.route("/api/birthdays/upcoming")
+def api_upcoming_birthdays():
+    """
+    これから N 日以内に誕生日が来る人（近い順）。
+    ?days=N（既定 30・最大 366）&limit=N&from=YYYY-MM-DD（省略時は今日）
+    birth_md の範囲検索で引き、年をまたぐときは「start 以降」と「end 以前」の 2 区間に分ける
+    """
+    try:
+        days = int(request.args.get("days") or UPCOMING_BIRTHDAYS_DEFAULT_DAYS)
+        limit, _ = parse_page_args(request.args.get("limit"))
+        start = date.fromisoformat(request.args["from"]) if request.args.get("from") else local_today()
+    except ValueError:
+        return jsonify({"error": "invalid parameters"}), 400
+    if not 0 <= days <= UPCOMING_BIRTHDAYS_MAX_DAYS:
+        return jsonify({"error": f"days must be between 0 and {UPCOMING_BIRTHDAYS_MAX_DAYS}"}), 400
+
+    end = start + timedelta(days=days)
+    start_md, end_md = start.month * 100 + start.day, end.month * 100 + end.day
+    if days >= 365:
+        ranges = [(start_md, 1231), (101, start_md - 1)]
+    elif start_md <= end_md:
+        ranges = [(start_md, end_md)]
+    else:
+        ranges = [(start_md, 1231), (101, end_md)]
+    #うるう年以外の 2/29 生まれは 3/1 に祝うので、3/1 が範囲に入るなら 2/29 も拾う（要るかは後で判定）
+    if any(low <= 301 <= high for low, high in ranges) and not any(low <= 229 <= high for low, high in ranges):
+        ranges.append((229, 229))
+
+    session = Session()
+    try:
+        rows = []
+        for low, high in ranges:
+            rows += session.execute(
+                select(Person.id, Person.name, Person.birth, Person.birth_date, Person.birth_md)
+                .where(Person.birth_md.between(low, high))
+                .order_by(Person.birth_md, Person.id)
+                .limit(limit)
+            ).all()
+    finally:
+        session.close()
+
+    people = {}
+    for person_id, name, birth, birth_date, birth_md in rows:
+        birthday = next_birthday(birth_md, start)
+        if birthday > end or person_id in people:
+            continue
+        people[person_id] = {
+            "id": person_id,
+            "name": name,
+            "birth": birth,
+            "birthday": birthday.isoformat(),
+            "days_until": (birthday - start).days,
+            "age": birthday.year - birth_date.year if birth_date else None,
+        }
+    result = sorted(people.values(), key=lambda p: (p["days_until"], p["id"]))[:limit]
+    return jsonify({"from": start.isoformat(), "days": days, "people": result})
+
+
+#1 回の /api/people/bulk で受け付ける最大件数
+BULK_UPSERT_MAX = 1000
+BULK_PERSON_FIELDS = ("name", "reading", "birth", "blood_type", "mbti", "love_type", "phrase")
+
+
+@app.route("/api/people/bulk", methods=["POST"])
+def api_people_bulk():
+    """
+    人物をまとめて登録・更新する（1 トランザクション・flush 1 回）。
+    本文: {"people": [{"id": 更新なら id, "name": ..., "tags": ["タグ名", ...]}, ...]}
+    id 付きは送ったフィールドだけ更新し、tags を省略したらタグはそのまま。
+    1 件でも不正なら何も書き込まずに 400 を返す。
+    """
+    data = request.get_json(silent=True) or {}
+    records = data.get("people")
+    if not isinstance(records, list) or not records:
+        return jsonify({"error": "people must be a non-empty list"}), 400
+    if len(records) > BULK_UPSERT_MAX:
+        return jsonify({"error": f"too many people (max {BULK_UPSERT_MAX})"}), 400
+
+    for i, record in enumerate(records):
+        if not isinstance(record, dict):
+            return jsonify({"error": f"people[{i}] must be an object"}), 400
+        if record.get("id") is None and not str(record.get("name") or "").strip():
+            return jsonify({"error": f"people[{i}]: name is required"}), 400
+        if "tags" in record and not (
+            isinstance(record["tags"], list)
+            and all(isinstance(t, str) and t.strip() for t in record["tags"])
+        ):
+            return jsonify({"error": f"people[{i}]: tags must be a list of non-empty strings"}), 400
+        if record.get("id") is not None and _import_int(record["id"]) is None:
+            return jsonify({"error": f"people[{i}]: invalid id"}), 400
+
+    person_ids = {int(r["id"]) for r in records if r.get("id") is not None}
+
+    session = Session()
+    try:
+        existing = {
+            p.id: p for p in session.query(Person).filter(Person.id.in_(person_ids))
+        } if person_ids else {}
+        unknown = sorted(person_ids - existing.keys())
+        if unknown:
+            return jsonify({"error": "unknown person ids", "ids": unknown}), 400
+
+        old_stats = {person_id: stat_values(p) for person_id, p in existing.items()}
+        tag_ids, created_tags = resolve_tag_ids(
+            session, [t for r in records for t in r.get("tags") or []]
+        )
+
+        touched, created = [], []
+        for record in records:
+            person = existing.get(_import_int(record.get("id")))
+            if person is None:
+                person = Person(**{field: "" for field in BULK_PERSON_FIELDS})
+                session.add(person)
+                created.append(person)
+            for field in BULK_PERSON_FIELDS:
+                if field in record:
+                    setattr(person, field, "" if record[field] is None else str(record[field]))
+            touched.append((record, person))
+
+        session.flush()
+
+        tags_added, tags_removed = sync_person_tags(session, {
+            person.id: {tag_ids[t] for t in record["tags"]}
+            for record, person in touched
+            if "tags" in record
+        })
+        people = {person.id: person for _, person in touched}
+        bump_stat_counters_many(session, [
+            (old_stats.get(person_id), stat_values(person)) for person_id, person in people.items()
+        ])
+        scopes = ["people", *[f"person:{person_id}" for person_id in people]]
+        if created_tags or tags_added or tags_removed:
+            scopes.append("tags")
+        bump_data_versions(session, *scopes)
+        record_changes(session, "person", people)
+        record_changes(session, "tag", created_tags)
+        if created:
+            enqueue_layout_job(session, [p.id for p in created])
+        session.commit()
+
+        for person in people.values():
+            search_index.upsert(person.id, person.name, person.reading)
+        if created:
+            notify_image_workers()
+
+        created_ids = [p.id for p in created]
+        return jsonify({
+            "created": created_ids,
+            "updated": sorted(set(people) - set(created_ids)),
+            "tags_added": tags_added,
+            "tags_removed": tags_removed,
+        })
+    finally:
+        session.close()
+
+
+@app.route("/api/people/bulk", methods=["DELETE"])
+def api_people_bulk_delete():
+    """
+    人物をまとめて削除する（1 トランザクション・people への DELETE 1 回）。
+    本文: {"ids": [1, 2, ...]}。見つからなかった id は missing に入れて返す
+    """
+    data = request.get_json(silent=True) or {}
+    ids = data.get("ids")
+    if not isinstance(ids, list) or not ids:
+        return jsonify({"error": "ids must be a non-empty list"}), 400
+    if len(ids) > BULK_UPSERT_MAX:
+        return jsonify({"error": f"too many ids (max {BULK_UPSERT_MAX})"}), 400
+    person_ids = {_import_int(person_id) for person_id in ids}
+    if None in person_ids:
+        return jsonify({"error": "invalid id"}), 400
+
     session = Session()
     try:
-        person = session.query(Person).filter_by(id=person_id).first()
-        if not person:
-            return jsonify({"error": "not found"}), 404
+        deleted_ids = delete_people(session, person_ids)
+        session.commit()
+        after_people_deleted(deleted_ids)
 
-        tag_names = get_tag_names_for_person(session, person_id)
-        return jsonify(person_to_dict(person, tags=tag_names))
+        return jsonify({"deleted": deleted_ids, "missing": sorted(person_ids - set(deleted_ids))})
     finally:
         session.close()
 
 
-@app.route("/filter", methods=["POST"])
-def filter_people():
-    """人物フィルター（JSON 返却）"""
-    data = request.get_json() or {}
-    name = data.get("name", "").strip()
-    blood_type = data.get("blood_type", "")
-    mbti = data.get("mbti", "")
-    love_type = data.get("love_type", "")
-    tags = data.get("tags", [])
-
+@app.route("/api/images/gc", methods=["GET", "POST"])
+def api_image_gc():
+    """
+    孤立画像の GC。POST でジョブを積み（実行中なら何もしない・失敗していたら続きから）、
+    GET で進み具合（status / scanned / deleted）を返す
+    """
     session = Session()
     try:
-        query = session.query(Person)
+        if request.method == "POST":
+            job = start_image_gc(session)
+            session.commit()
+            notify_image_workers()
+        else:
+            job = session.query(ImageJob).filter_by(idempotency_key=IMAGE_GC_KEY).first()
+            if job is None:
+                return jsonify({"status": None})
+
+        progress = json.loads(job.payload)
+        return jsonify({
+            "job_id": job.id,
+            "status": job.status,
+            "scanned": progress["scanned"],
+            "deleted": progress["deleted"],
+            "last_error": job.last_error,
+        }), 202 if request.method == "POST" else 200
+    finally:
+        session.close()
 
-        if name:
-            query = query.filter(Person.name.contains(name))
-        if blood_type:
-            query = query.filter(Person.blood_type == blood_type)
-        if mbti:
-            query = query.filter(Person.mbti == mbti)
-        if love_type:
-            query = query.filter(Person.love_type == love_type)
 
-        results = query.all()
+@app.route("/api/import", methods=["POST"])
+def api_import():
+    """
+    一括インポート。本文（またはフォームの file）を流し読みし、バッチごとの進捗を JSONL で返す。
+    ?format=jsonl|csv&kind=people|relations（kind は CSV のときだけ使う）
+    """
+    fmt = request.args.get("format", "jsonl")
+    kind = request.args.get("kind", "people")
+    if fmt not in TRANSFER_FORMATS or kind not in TRANSFER_KINDS:
+        return jsonify({"error": "invalid format or kind"}), 400
+
+    upload = request.files.get("file")
+    records = read_import_records(upload.stream if upload else request.stream, fmt, kind)
 
-        #タグ指定がある場合は Python 側で絞り込み
-        if tags:
-            tag_ids_filter = set(tags)
-            filtered = []
-            for person in results:
-                person_tag_ids = [
-                    pt.tag_id
-                    for pt in session.query(PersonTag).filter_by(person_id=person.id).all()
-                ]
-                if any(tag_id in person_tag_ids for tag_id in tag_ids_filter):
-                    filtered.append(person)
-            results = filtered
+    def generate():
+        for progress in import_records(records):
+            yield json.dumps(progress, ensure_ascii=False) + "\n"
 
-        response = []
-        for p in results:
-            tag_names = get_tag_names_for_person(session, p.id)
-            response.append(person_to_dict(p, tags=tag_names))
+    return app.response_class(stream_with_context(generate()), mimetype="application/x-ndjson")
 
-        return jsonify(response)
-    finally:
-        session.close()
+
+@app.route("/api/export")
+def api_export():
+    """
+    一括エクスポート（テーブル全体をメモリに載せず、少しずつ返す）。
+    ?format=jsonl|csv&kind=people|relations（JSONL で kind 省略時はタグ・人物・関係すべて）
+    """
+    fmt = request.args.get("format", "jsonl")
+    kind = request.args.get("kind") or (None if fmt == "jsonl" else "people")
+    if fmt not in TRANSFER_FORMATS or (kind is not None and kind not in TRANSFER_KINDS):
+        return jsonify({"error": "invalid format or kind"}), 400
+
+    if fmt == "csv":
+        response = app.response_class(export_csv(kind), mimetype="text/csv")
+    else:
+        response = app.response_class(export_jsonl(kind), mimetype="application/x-ndjson")
+    response.headers["Content-Disposition"] = (
+        f'attachment; filename="mawarizukan_{kind or "all"}.{fmt}"'
+    )
+    return response
+
+
+@app.route("/api/search")
+def api_search():
+    """
+    名前・読みのタイプアヘッド検索（インデックスだけで返す）。
+    ほかのワーカーの書き込みの確認は SEARCH_FRESH_MS に 1 回なので、ほとんどの打鍵は DB に触らない
+    """
+    query = request.args.get("q", "")
+    try:
+        limit = min(max(int(request.args.get("limit", 10)), 1), 50)
+    except ValueError:
+        return jsonify({"error": "invalid limit"}), 400
+
+    search_index.ensure_fresh(max_age=SEARCH_FRESH_MS / 1000)
+    results = search_index.search(query, limit)
+    return jsonify([
+        {"id": person_id, "name": name, "reading": reading, "score": round(score, 3)}
+        for person_id, name, reading, score in results
+    ])
 
 
 @app.route("/stats")
+@conditional_response("people", "tags")
 def stats():
     """統計ダッシュボード用ページ"""
     session = Session()
     try:
-        people = session.query(Person).all()
-
-        #各分布（空文字や None は除外）
-        mbti_counts = Counter(
-            [p.mbti for p in people if getattr(p, "mbti", None)]
-        )
-        love_counts = Counter(
-            [p.love_type for p in people if getattr(p, "love_type", None)]
-        )
-        blood_counts = Counter(
-            [p.blood_type for p in people if getattr(p, "blood_type", None)]
-        )
-
-        #グループタグ分布（JOIN で集計）
-        tag_rows = (
-            session.query(GroupTag.name, func.count(PersonTag.id))
-            .join(PersonTag, GroupTag.id == PersonTag.tag_id)
-            .group_by(GroupTag.id, GroupTag.name)
-            .all()
-        )
-        tag_counts = {name: cnt for name, cnt in tag_rows}
+        counts = load_stat_counts(session)
 
         return render_template(
             "stats.html",
-            mbti_counts=dict(mbti_counts),
-            love_counts=dict(love_counts),
-            blood_counts=dict(blood_counts),
-            tag_counts=dict(tag_counts),
+            mbti_counts=counts["mbti"],
+            love_counts=counts["love"],
+            blood_counts=counts["blood"],
+            tag_counts=counts["tags"],
             MBTI_LABELS=MBTI_LABELS,
             LOVE_LABELS=LOVE_LABELS,
             active="stats"
@@ -605,45 +4425,95 @@ def stats():
         session.close()
 
 
+@app.route("/api/stats")
+@conditional_response("people", "tags")
+def api_stats():
+    """統計の JSON 版（ダッシュボードのポーリング用）"""
+    session = Session()
+    try:
+        return jsonify(load_stat_counts(session))
+    finally:
+        session.close()
+
+
 @app.route("/stats_members")
+@conditional_response("people", "tags")
 def stats_members():
     """統計グラフからクリックされたとき、該当メンバーを返す API"""
     category = request.args.get("type")
     value = request.args.get("value")
 
+    stmt = stats_members_statement(category, value)
+    if stmt is None:
+        return jsonify([])
+
     session = Session()
     try:
-        query = session.query(Person)
-
-        if category == "mbti":
-            people = query.filter_by(mbti=value).all()
-        elif category == "love":
-            people = query.filter_by(love_type=value).all()
-        elif category == "blood":
-            people = query.filter_by(blood_type=value).all()
-        elif category == "tag":
-            people = query.join(Person.tags).filter(GroupTag.name == value).all()
-        else:
-            people = []
-
-        return jsonify([{"id": p.id, "name": p.name} for p in people])
+        return jsonify([{"id": person_id, "name": name} for person_id, name in session.execute(stmt)])
     finally:
         session.close()
 
 
+def stats_members_statement(category, value):
+    """カテゴリ・値に当てはまる人の (id, name) だけを読む select（ORM の Person は作らない）。不明なカテゴリは None"""
+    stmt = select(Person.id, Person.name)
+    if category in STAT_COLUMNS:
+        return stmt.where(STAT_COLUMNS[category] == value)
+    if category == "tag":
+        return (
+            stmt.join(PersonTag, PersonTag.person_id == Person.id)
+            .join(GroupTag, GroupTag.id == PersonTag.tag_id)
+            .where(GroupTag.name == value)
+        )
+    return None
+
+
+#------- 読み取り用の軽量な行（ORM オブジェクトを作らない）-------
+#関係性ページと /api/relations は表示に使う列だけを Core の select() で読み、
+#namedtuple に詰めて渡す（identity map に載らず、テンプレートから遅延ロードも起きない）
+PersonRow = namedtuple("PersonRow", "id name image_path image_status")
+RelationRow = namedtuple(
+    "RelationRow", "id source_id target_id source_name target_name relation_type strength"
+)
+
+
+def person_rows(session):
+    """全員の (id, name, image_path, image_status)"""
+    stmt = select(Person.id, Person.name, Person.image_path, Person.image_status).order_by(Person.id)
+    return [PersonRow._make(row) for row in session.execute(stmt)]
+
+
+def relation_rows(session):
+    """全関係を両端の名前付きで 1 クエリ（people を 2 回 JOIN）で読む"""
+    source = Person.__table__.alias("source_person")
+    target = Person.__table__.alias("target_person")
+    stmt = (
+        select(
+            Relationship.id,
+            Relationship.source_id,
+            Relationship.target_id,
+            source.c.name,
+            target.c.name,
+            Relationship.relation_type,
+            Relationship.strength,
+        )
+        .outerjoin(source, source.c.id == Relationship.source_id)
+        .outerjoin(target, target.c.id == Relationship.target_id)
+        .order_by(Relationship.id)
+    )
+    return [RelationRow._make(row) for row in session.execute(stmt)]
+
+
 #------- ページ表示 -------
 @app.route("/relations")
 def relations_page():
     session = Session()
     try:
-        people = session.query(Person).all()
-        relations = session.query(Relationship).all()
-
         return render_template(
             "relations.html",
             title="関係性",
-            people=people,
-            relations=relations,
+            people=person_rows(session),
+            relations=relation_rows(session),
             RELATION_TYPES=RELATION_TYPES,
             RELATION_TYPE_LABELS=RELATION_TYPE_LABELS,
             active="relations"
@@ -678,17 +4548,26 @@ def add_relation():
         if existing:
             existing.relation_type = relation_type
             existing.strength = strength
+            relation = existing
         else:
-            session.add(
-                Relationship(
-                    source_id=normalized_source,
-                    target_id=normalized_target,
-                    relation_type=relation_type,
-                    strength=strength,
-                )
+            relation = Relationship(
+                source_id=normalized_source,
+                target_id=normalized_target,
+                relation_type=relation_type,
+                strength=strength,
             )
+            session.add(relation)
+            session.flush()
 
+        bump_data_versions(session, "relations")
+        record_changes(session, "relation", [relation.id])
+        #変わった 2 人の周辺だけ、あとでワーカーがレイアウトを緩和し直す
+        enqueue_layout_job(session, [normalized_source, normalized_target])
         session.commit()
+        relation_graph.upsert_edge(
+            relation.id, normalized_source, normalized_target, relation_type, strength
+        )
+        notify_image_workers()
         return redirect("/relations")
     finally:
         session.close()
@@ -701,8 +4580,14 @@ def delete_relation(relation_id):
     try:
         r = session.query(Relationship).filter_by(id=relation_id).first()
         if r:
+            endpoints = [r.source_id, r.target_id]
             session.delete(r)
+            bump_data_versions(session, "relations")
+            record_changes(session, "relation", [relation_id], CHANGE_DELETE)
+            enqueue_layout_job(session, endpoints)
             session.commit()
+            relation_graph.remove_edge(relation_id)
+            notify_image_workers()
         return redirect("/relations")
     finally:
         session.close()
@@ -715,22 +4600,189 @@ def delete_relation(relation_id):
 #💞 相性診断 API
 #============================================
 
+#================================
+#🔷 MBTI ランキング
+#================================
+MBTI_RANKINGS = {
+    "INTJ": ["ESFJ", "ISFP", "ENTP", "INFJ", "ENFJ", "ESTJ", "INTJ", "INTP", "INFP", "ISTP", "ISFJ", "ISTJ", "ESTP", "ENFP", "ENTJ", "ESFP"],
+    "INTP": ["ESFP", "ISFJ", "ENTJ", "ISTP", "ESTP", "ENFP", "INTP", "INTJ", "ISTJ", "INFJ", "ISFP", "INFP", "ENFJ", "ESTJ", "ENTP", "ESFJ"],
+    "ENTJ": ["ISFJ", "ESFP", "INTP", "ENFJ", "INFJ", "ISTJ", "ENTJ", "ENTP", "ESTP", "ENFP", "ESFJ", "ESTJ", "ISTP", "INFP", "INTJ", "ISFP"],
+    "ENTP": ["ISFP", "ESFJ", "INTJ", "ESTP", "ISTP", "INFP", "ENTP", "ENTJ", "ENFJ", "ESTJ", "ESFP", "ENFP", "INFJ", "ISTJ", "INTP", "ISFJ"],
+    "INFJ": ["ESTJ", "ISTP", "ENFP", "INTJ", "ENTJ", "ESFJ", "INFJ", "INFP", "INTP", "ISFP", "ISTJ", "ISFJ", "ESFP", "ENTP", "ENFJ", "ESTP"],
+    "ENFJ": ["ISTJ", "ESTP", "INFP", "ENTJ", "INTJ", "ISFJ", "ENFJ", "ENFP", "ESFP", "ENTP", "ESTJ", "ESFJ", "ISFP", "INTP", "INFJ", "ISTP"],
+    "INFP": ["ESTP", "ISTJ", "ENFJ", "ISFP", "ESFP", "ENTP", "INFP", "INFJ", "ISFJ", "INTJ", "ISTP", "INTP", "ENTJ", "ESFJ", "ENFP", "ESTJ"],
+    "ENFP": ["ISTP", "ESTJ", "INFJ", "ESFP", "ISFP", "INTP", "ENFP", "ENFJ", "ENTJ", "ESFJ", "ESTP", "ENTP", "INTJ", "ISFJ", "INFP", "ISTJ"],
+    "ISTJ": ["ENFJ", "INFP", "ESTP", "ISFJ", "ESFJ", "ENTJ", "ISTJ", "ISTP", "ISFP", "INTP", "INFJ", "INTJ", "ENTP", "ESFP", "ESTJ", "ENFP"],
+    "ISFJ": ["ENTJ", "INTP", "ESFP", "ISTJ", "ESTJ", "ENFJ", "ISFJ", "ISFP", "ISTP", "INFP", "INTJ", "INFJ", "ENFP", "ESTP", "ESFJ", "ENTP"],
+    "ESTJ": ["INFJ", "ENFP", "ISTP", "ESFJ", "ISFJ", "INTJ", "ESTJ", "ESTP", "ENTP", "ESFP", "ENFJ", "ENTJ", "INTP", "ISFP", "ISTJ", "INFP"],
+    "ESFJ": ["INTJ", "ENTP", "ISFP", "ESTJ", "ISTJ", "INFJ", "ESFJ", "ESFP", "ENFP", "ESTP", "ENTJ", "ENFJ", "INFP", "ISTP", "ISFJ", "INTP"],
+    "ESTP": ["INFP", "ENFJ", "ISTJ", "ENTP", "INTP", "ISFP", "ESTP", "ESTJ", "ESFJ", "ENTJ", "ENFP", "ESFP", "ISFJ", "INTJ", "ISTP", "INFJ"],
+    "ISTP": ["ENFP", "INFJ", "ESTJ", "INTP", "ENTP", "ESFP", "ISTP", "ISTJ", "INTJ", "ISFJ", "INFP", "ISFP", "ESFJ", "ENTJ", "ESTP", "ENFJ"],
+    "ISFP": ["ENTP", "INTJ", "ESFJ", "INFP", "ENFP", "ESTP", "ISFP", "ISFJ", "INFJ", "ISTJ", "INTP", "ISTP", "ESTJ", "ENFJ", "ESFP", "ENTJ"],
+    "ESFP": ["INTP", "ENTJ", "ISFJ", "ENFP", "INFP", "ISTP", "ESFP", "ESFJ", "ESTJ", "ENFJ", "ENTP", "ESTP", "ISTJ", "INFJ", "ISFP", "INTJ"],
+}
+
+#================================
+#🔷 MBTI コメント
+#================================
+MBTI_RANK_COMMENTS = {
+    1: "💘 運命レベルの相性！自然に惹かれ合う最強ペア。",
+    2: "💗 とても相性が良く、お互いを深く理解し合える関係。",
+    3: "✨ 相性は高め。尊敬し合える素敵なコンビ。",
+    4: "😊 仲良くなりやすく、成長し合える心地よい関係。",
+    5: "😀 気が合うことが多い、安心できる相性。",
+    6: "🙂 相性は良い方。自然体でいられる組み合わせ。",
+    7: "😌 普通の相性。お互いの距離感を保てば快適。",
+    8: "😐 可もなく不可もなく。理解し合うには工夫が必要。",
+    9: "😅 少し価値観のズレがあるけど、乗り越えられる範囲。",
+    10: "⚖️ 合う部分もあるが調整が必要。",
+    11: "🌀 やや波がありやすい相性。歩み寄りが大事。",
+    12: "💦 理解し合うには時間がかかる可能性あり。",
+    13: "🔥 衝突しやすい組み合わせ。でも刺激は多い。",
+    14: "⚠️ 価値観が大きく異なりやすい。理解が鍵。",
+    15: "💣 相性は低め。工夫しないとすれ違いやすい。",
+    16: "🧊 最低レベルの相性。努力しないと距離が縮みにくい。",
+}
+MBTI_NO_DATA_COMMENT = "相性データがありません。"
+
+#================================
+#🔷 血液型ランキング（性別なし）
+#================================
+BLOOD_RANKINGS = {
+    "A": ["O", "A", "AB", "B"],
+    "B": ["O", "B", "AB", "A"],
+    "O": ["A", "O", "B", "AB"],
+    "AB": ["B", "A", "O", "AB"],
+}
+BLOOD_SCORE_TABLE = [95, 80, 60, 40]  #上位ほどスコア高い
+
+
+#================================
+#⚙️ コンパイル済みスコア表（import 時に 1 回だけ構築）
+#================================
+#コード → 配列インデックス。未登録・空欄は末尾の「不明」インデックスに落とす
+MBTI_CODES = tuple(MBTI_LABELS.keys())
+MBTI_INDEX = {code: i for i, code in enumerate(MBTI_CODES)}
+MBTI_UNKNOWN = len(MBTI_CODES)
+
+BLOOD_CODES = tuple(BLOOD_RANKINGS.keys())
+BLOOD_INDEX = {code: i for i, code in enumerate(BLOOD_CODES)}
+BLOOD_UNKNOWN = len(BLOOD_CODES)
+
+
+def _compile_rank_table(rankings, codes, index):
+    """ランキング辞書を (N+1)×(N+1) の順位表に変換（不明側は None）"""
+    size = len(codes) + 1
+    table = [[None] * size for _ in range(size)]
+    for code, ranking in rankings.items():
+        row = table[index[code]]
+        for pos, other in enumerate(ranking):
+            row[index[other]] = pos + 1
+    return tuple(tuple(row) for row in table)
+
+
+MBTI_RANK_TABLE = _compile_rank_table(MBTI_RANKINGS, MBTI_CODES, MBTI_INDEX)
+MBTI_SCORE_TABLE = tuple(
+    tuple(100 - (rank - 1) * 5 if rank else None for rank in row)
+    for row in MBTI_RANK_TABLE
+)
+
+BLOOD_RANK_TABLE = _compile_rank_table(BLOOD_RANKINGS, BLOOD_CODES, BLOOD_INDEX)
+BLOOD_SCORE_MATRIX = tuple(
+    tuple(BLOOD_SCORE_TABLE[rank - 1] if rank else None for rank in row)
+    for row in BLOOD_RANK_TABLE
+)
+
+#================================
+#💗 恋愛タイプ（LOVE_LABELS の 4 文字コード）
+#================================
+#L/F（リード・フォロー）と C/A（甘えたい・受け止めたい）は違う方が補い合えて高く、
+#R/P（現実・情熱）と O/E（楽観・真面目）は同じ方が価値観が合って高い。40〜100 点
+LOVE_CODES = tuple(LOVE_LABELS.keys())
+LOVE_INDEX = {code: i for i, code in enumerate(LOVE_CODES)}
+LOVE_UNKNOWN = len(LOVE_CODES)
+LOVE_BASE_SCORE = 40
+LOVE_AXIS_SCORE = 15
+
+
+def _love_score(code1, code2):
+    complementary = (code1[0] != code2[0]) + (code1[1] != code2[1])
+    shared = (code1[2] == code2[2]) + (code1[3] == code2[3])
+    return LOVE_BASE_SCORE + LOVE_AXIS_SCORE * (complementary + shared)
+
+
+LOVE_SCORE_MATRIX = tuple(
+    tuple(
+        _love_score(LOVE_CODES[i], LOVE_CODES[j]) if i < LOVE_UNKNOWN and j < LOVE_UNKNOWN else None
+        for j in range(LOVE_UNKNOWN + 1)
+    )
+    for i in range(LOVE_UNKNOWN + 1)
+)
+
+#総合スコアの重み。未入力の項目は中間点として数える（空欄の多い人が上位に来ないように）
+COMPATIBILITY_WEIGHTS = {"mbti": 0.4, "love": 0.4, "blood": 0.2}
+COMPATIBILITY_UNKNOWN_SCORE = 50
+#/compatibility/top で返す最大人数
+COMPATIBILITY_TOP_MAX = 100
+
+#バッチ相性 API で一度に受け付ける最大人数
+COMPATIBILITY_MATRIX_MAX = 1000
+
+
+def mbti_index(code):
+    """MBTI コード → スコア表インデックス"""
+    return MBTI_INDEX.get(code, MBTI_UNKNOWN)
+
+
+def blood_index(code):
+    """血液型 → スコア表インデックス"""
+    return BLOOD_INDEX.get(code, BLOOD_UNKNOWN)
+
+
+def love_index(code):
+    """恋愛タイプ → スコア表インデックス"""
+    return LOVE_INDEX.get(code, LOVE_UNKNOWN)
+
+
+def total_compatibility(mbti_score, blood_score, love_score):
+    """3 項目の重み付き平均（全部不明なら None）"""
+    parts = [
+        (COMPATIBILITY_WEIGHTS["mbti"], mbti_score),
+        (COMPATIBILITY_WEIGHTS["blood"], blood_score),
+        (COMPATIBILITY_WEIGHTS["love"], love_score),
+    ]
+    if all(score is None for _, score in parts):
+        return None
+    return round(sum(
+        w * (COMPATIBILITY_UNKNOWN_SCORE if score is None else score) for w, score in parts
+    ) / sum(w for w, _ in parts), 1)
+
+
 @app.route("/compatibility_api", methods=["POST"])
 def compatibility_api():
     """2人の ID を受け取り、MBTI / 血液型相性を返す API"""
     data = request.get_json() or {}
-    id1 = data.get("id1")
-    id2 = data.get("id2")
+    #"3" のような文字列の id も受け付ける（取得結果の辞書は int で引くので先にそろえる）
+    try:
+        id1 = int(data.get("id1"))
+        id2 = int(data.get("id2"))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid person IDs"}), 400
 
     session = Session()
     try:
-        p1 = session.query(Person).filter_by(id=id1).first()
-        p2 = session.query(Person).filter_by(id=id2).first()
+        #2人まとめて 1 クエリで取得
+        found = {
+            p.id: p
+            for p in session.query(Person).filter(Person.id.in_([id1, id2])).all()
+        }
+        p1 = found.get(id1)
+        p2 = found.get(id2)
 
         result = calculate_compatibility(p1, p2) if p1 and p2 else None
         if result and p1 and p2:
-            result["p1_image"] = p1.image_path
-            result["p2_image"] = p2.image_path
+            result["p1_image"] = image_variants(shown_image_path(p1.image_path, p1.image_status))["node"]
+            result["p2_image"] = image_variants(shown_image_path(p2.image_path, p2.image_status))["node"]
     finally:
         session.close()
 
@@ -740,6 +4792,158 @@ def compatibility_api():
     return jsonify(result)
 
 
+@app.route("/compatibility_matrix", methods=["POST"])
+def compatibility_matrix():
+    """
+    複数人の ID（または tag_id）を受け取り、全ペアの相性スコア行列を返す API。
+    人物は 1 クエリで取得し、スコアはコンパイル済みの表から引くだけ。
+    """
+    data = request.get_json() or {}
+    ids = data.get("ids")
+    tag_id = data.get("tag_id")
+
+    if ids is None and tag_id is None:
+        return jsonify({"error": "ids or tag_id is required"}), 400
+
+    session = Session()
+    try:
+        query = session.query(
+            Person.id, Person.name, Person.mbti, Person.blood_type, Person.love_type
+        )
+        if ids is not None:
+            try:
+                ids = [int(i) for i in ids]
+            except (TypeError, ValueError):
+                return jsonify({"error": "ids must be a list of integers"}), 400
+            query = query.filter(Person.id.in_(ids))
+        if tag_id is not None:
+            try:
+                tag_id = int(tag_id)
+            except (TypeError, ValueError):
+                return jsonify({"error": "tag_id must be an integer"}), 400
+            query = query.join(PersonTag, PersonTag.person_id == Person.id).filter(
+                PersonTag.tag_id == tag_id
+            )
+
+        rows = query.order_by(Person.id).limit(COMPATIBILITY_MATRIX_MAX + 1).all()
+    finally:
+        session.close()
+
+    if len(rows) > COMPATIBILITY_MATRIX_MAX:
+        return jsonify({"error": f"too many people (max {COMPATIBILITY_MATRIX_MAX})"}), 400
+
+    result = calculate_compatibility_matrix(rows)
+    result["people"] = [
+        {"id": r.id, "name": r.name, "mbti": r.mbti, "blood_type": r.blood_type, "love_type": r.love_type}
+        for r in rows
+    ]
+    return jsonify(result)
+
+
+@app.route("/compatibility/top")
+@conditional_response("people", "tags")
+def compatibility_top():
+    """
+    1 人に対して図鑑全体から相性の良い上位 k 人を返す。
+    候補は (mbti, blood_type, love_type) の組で GROUP BY して、組ごとに 1 回だけ
+    スコア表を引き、上位に入る組の人だけを読み出す。
+    ?person_id=1&k=10&tags=1,2&tag_mode=any（tags で候補をタグに絞れる）
+    """
+    try:
+        person_id = int(request.args["person_id"])
+        k = min(max(int(request.args.get("k", 10)), 1), COMPATIBILITY_TOP_MAX)
+        tag_ids = [int(t) for t in request.args.get("tags", "").split(",") if t]
+    except (KeyError, ValueError):
+        return jsonify({"error": "person_id is required"}), 400
+    tag_mode = request.args.get("tag_mode", "any")
+    if tag_mode not in ("any", "all"):
+        return jsonify({"error": "tag_mode must be 'any' or 'all'"}), 400
+
+    session = Session()
+    try:
+        me = session.get(Person, person_id)
+        if me is None:
+            return jsonify({"error": "not found"}), 404
+
+        type_columns = (Person.mbti, Person.blood_type, Person.love_type)
+        candidates = [Person.id != person_id]
+        if tag_ids:
+            candidates.append(tag_filter_clause(tag_ids, tag_mode))
+
+        #組ごとの人数（最大 17×5×17 行。不明・空欄もそれぞれ 1 組）
+        buckets = session.query(*type_columns, func.count(Person.id)).filter(*candidates).group_by(*type_columns).all()
+
+        mi, bi, li = mbti_index(me.mbti), blood_index(me.blood_type), love_index(me.love_type)
+        scored = []
+        for mbti, blood, love, count in buckets:
+            scores = (
+                MBTI_SCORE_TABLE[mi][mbti_index(mbti)],
+                BLOOD_SCORE_MATRIX[bi][blood_index(blood)],
+                LOVE_SCORE_MATRIX[li][love_index(love)],
+            )
+            total = total_compatibility(*scores)
+            if total is not None:
+                scored.append((total, (mbti, blood, love), scores, count))
+        scored.sort(key=lambda b: b[0], reverse=True)
+
+        #k 人目が入る組の点数を境界にする。境界より上の組は全員、
+        #境界と同点の組は id の小さい順に残り人数だけ読む（同点は id 順）
+        taken, cutoff = 0, None
+        for total, _, _, count in scored:
+            taken += count
+            if taken >= k:
+                cutoff = total
+                break
+        above = [key for total, key, _, _ in scored if cutoff is None or total > cutoff]
+        boundary = [key for total, key, _, _ in scored if total == cutoff]
+
+        def bucket_clause(keys):
+            return or_(*[
+                and_(*[
+                    column.is_(None) if value is None else column == value
+                    for column, value in zip(type_columns, key)
+                ])
+                for key in keys
+            ])
+
+        columns = (Person.id, Person.name, Person.image_path, Person.image_status, *type_columns)
+        people = session.query(*columns).filter(*candidates, bucket_clause(above)).all() if above else []
+        if boundary:
+            people += (
+                session.query(*columns)
+                .filter(*candidates, bucket_clause(boundary))
+                .order_by(Person.id)
+                .limit(k - len(people))
+                .all()
+            )
+    finally:
+        session.close()
+
+    bucket_scores = {key: (total, scores) for total, key, scores, _ in scored}
+    results = []
+    for p in people:
+        total, (mbti_score, blood_score, love_score) = bucket_scores[(p.mbti, p.blood_type, p.love_type)]
+        results.append({
+            "id": p.id,
+            "name": p.name,
+            "image": image_variants(shown_image_path(p.image_path, p.image_status))["node"],
+            "mbti": p.mbti,
+            "blood_type": p.blood_type,
+            "love_type": p.love_type,
+            "score": total,
+            "mbti_score": mbti_score,
+            "blood_score": blood_score,
+            "love_score": love_score,
+        })
+    results.sort(key=lambda r: (-r["score"], r["id"]))
+
+    return jsonify({
+        "person": {"id": me.id, "name": me.name},
+        "results": results[:k],
+        "buckets": len(buckets),
+    })
+
+
 def calculate_compatibility(p1: Person, p2: Person):
     """MBTI・血液型の相性スコア＆コメントをまとめて返す"""
 
@@ -748,143 +4952,444 @@ def calculate_compatibility(p1: Person, p2: Person):
         "p2": p2.name,
     }
 
-    #================================
-    #🔷 MBTI ランキング
-    #================================
-    mbti_rankings = {
-        "INTJ": ["ESFJ", "ISFP", "ENTP", "INFJ", "ENFJ", "ESTJ", "INTJ", "INTP", "INFP", "ISTP", "ISFJ", "ISTJ", "ESTP", "ENFP", "ENTJ", "ESFP"],
-        "INTP": ["ESFP", "ISFJ", "ENTJ", "ISTP", "ESTP", "ENFP", "INTP", "INTJ", "ISTJ", "INFJ", "ISFP", "INFP", "ENFJ", "ESTJ", "ENTP", "ESFJ"],
-        "ENTJ": ["ISFJ", "ESFP", "INTP", "ENFJ", "INFJ", "ISTJ", "ENTJ", "ENTP", "ESTP", "ENFP", "ESFJ", "ESTJ", "ISTP", "INFP", "INTJ", "ISFP"],
-        "ENTP": ["ISFP", "ESFJ", "INTJ", "ESTP", "ISTP", "INFP", "ENTP", "ENTJ", "ENFJ", "ESTJ", "ESFP", "ENFP", "INFJ", "ISTJ", "INTP", "ISFJ"],
-        "INFJ": ["ESTJ", "ISTP", "ENFP", "INTJ", "ENTJ", "ESFJ", "INFJ", "INFP", "INTP", "ISFP", "ISTJ", "ISFJ", "ESFP", "ENTP", "ENFJ", "ESTP"],
-        "ENFJ": ["ISTJ", "ESTP", "INFP", "ENTJ", "INTJ", "ISFJ", "ENFJ", "ENFP", "ESFP", "ENTP", "ESTJ", "ESFJ", "ISFP", "INTP", "INFJ", "ISTP"],
-        "INFP": ["ESTP", "ISTJ", "ENFJ", "ISFP", "ESFP", "ENTP", "INFP", "INFJ", "ISFJ", "INTJ", "ISTP", "INTP", "ENTJ", "ESFJ", "ENFP", "ESTJ"],
-        "ENFP": ["ISTP", "ESTJ", "INFJ", "ESFP", "ISFP", "INTP", "ENFP", "ENFJ", "ENTJ", "ESFJ", "ESTP", "ENTP", "INTJ", "ISFJ", "INFP", "ISTJ"],
-        "ISTJ": ["ENFJ", "INFP", "ESTP", "ISFJ", "ESFJ", "ENTJ", "ISTJ", "ISTP", "ISFP", "INTP", "INFJ", "INTJ", "ENTP", "ESFP", "ESTJ", "ENFP"],
-        "ISFJ": ["ENTJ", "INTP", "ESFP", "ISTJ", "ESTJ", "ENFJ", "ISFJ", "ISFP", "ISTP", "INFP", "INTJ", "INFJ", "ENFP", "ESTP", "ESFJ", "ENTP"],
-        "ESTJ": ["INFJ", "ENFP", "ISTP", "ESFJ", "ISFJ", "INTJ", "ESTJ", "ESTP", "ENTP", "ESFP", "ENFJ", "ENTJ", "INTP", "ISFP", "ISTJ", "INFP"],
-        "ESFJ": ["INTJ", "ENTP", "ISFP", "ESTJ", "ISTJ", "INFJ", "ESFJ", "ESFP", "ENFP", "ESTP", "ENTJ", "ENFJ", "INFP", "ISTP", "ISFJ", "INTP"],
-        "ESTP": ["INFP", "ENFJ", "ISTJ", "ENTP", "INTP", "ISFP", "ESTP", "ESTJ", "ESFJ", "ENTJ", "ENFP", "ESFP", "ISFJ", "INTJ", "ISTP", "INFJ"],
-        "ISTP": ["ENFP", "INFJ", "ESTJ", "INTP", "ENTP", "ESFP", "ISTP", "ISTJ", "INTJ", "ISFJ", "INFP", "ISFP", "ESFJ", "ENTJ", "ESTP", "ENFJ"],
-        "ISFP": ["ENTP", "INTJ", "ESFJ", "INFP", "ENFP", "ESTP", "ISFP", "ISFJ", "INFJ", "ISTJ", "INTP", "ISTP", "ESTJ", "ENFJ", "ESFP", "ENTJ"],
-        "ESFP": ["INTP", "ENTJ", "ISFJ", "ENFP", "INFP", "ISTP", "ESFP", "ESFJ", "ESTJ", "ENFJ", "ENTP", "ESTP", "ISTJ", "INFJ", "ISFP", "INTJ"],
-    }
-
-    #================================
-    #🔷 MBTI コメント
-    #================================
-    rank_comments = {
-        1: "💘 運命レベルの相性！自然に惹かれ合う最強ペア。",
-        2: "💗 とても相性が良く、お互いを深く理解し合える関係。",
-        3: "✨ 相性は高め。尊敬し合える素敵なコンビ。",
-        4: "😊 仲良くなりやすく、成長し合える心地よい関係。",
-        5: "😀 気が合うことが多い、安心できる相性。",
-        6: "🙂 相性は良い方。自然体でいられる組み合わせ。",
-        7: "😌 普通の相性。お互いの距離感を保てば快適。",
-        8: "😐 可もなく不可もなく。理解し合うには工夫が必要。",
-        9: "😅 少し価値観のズレがあるけど、乗り越えられる範囲。",
-        10: "⚖️ 合う部分もあるが調整が必要。",
-        11: "🌀 やや波がありやすい相性。歩み寄りが大事。",
-        12: "💦 理解し合うには時間がかかる可能性あり。",
-        13: "🔥 衝突しやすい組み合わせ。でも刺激は多い。",
-        14: "⚠️ 価値観が大きく異なりやすい。理解が鍵。",
-        15: "💣 相性は低め。工夫しないとすれ違いやすい。",
-        16: "🧊 最低レベルの相性。努力しないと距離が縮みにくい。",
-    }
-
-    #================================
-    #🔷 血液型ランキング（性別なし）
-    #================================
-    blood_rankings = {
-        "A": ["O", "A", "AB", "B"],
-        "B": ["O", "B", "AB", "A"],
-        "O": ["A", "O", "B", "AB"],
-        "AB": ["B", "A", "O", "AB"],
-    }
-    blood_score_table = [95, 80, 60, 40]  #上位ほどスコア高い
-
     #================================
     #⭐ MBTI スコア計算
     #================================
     mbti1, mbti2 = p1.mbti, p2.mbti
-    rank = None
-
-    if mbti1 in mbti_rankings and mbti2 in mbti_rankings[mbti1]:
-        rank = mbti_rankings[mbti1].index(mbti2) + 1
-
-    mbti_score = 100 - (rank - 1) * 5 if rank else None
-    mbti_comment = rank_comments.get(rank, "相性データがありません。")
+    rank = MBTI_RANK_TABLE[mbti_index(mbti1)][mbti_index(mbti2)]
 
     result["mbti1"] = mbti1
     result["mbti2"] = mbti2
     result["mbti_rank"] = rank
-    result["mbti_score"] = mbti_score
-    result["mbti_comment"] = mbti_comment
+    result["mbti_score"] = MBTI_SCORE_TABLE[mbti_index(mbti1)][mbti_index(mbti2)]
+    result["mbti_comment"] = MBTI_RANK_COMMENTS.get(rank, MBTI_NO_DATA_COMMENT)
 
     #================================
     #⭐ 血液型スコア計算
     #================================
     b1, b2 = p1.blood_type, p2.blood_type
-    blood_score = None
-    blood_rank = None
-
-    if b1 and b2 and (b1 in blood_rankings):
-        if b2 in blood_rankings[b1]:
-            b_index = blood_rankings[b1].index(b2)
-            blood_score = blood_score_table[b_index]
-            blood_rank = b_index + 1
+    bi1, bi2 = blood_index(b1), blood_index(b2)
 
     result["blood1"] = b1
     result["blood2"] = b2
-    result["blood_score"] = blood_score
-    result["blood_rank"] = blood_rank
+    result["blood_score"] = BLOOD_SCORE_MATRIX[bi1][bi2]
+    result["blood_rank"] = BLOOD_RANK_TABLE[bi1][bi2]
 
+    #================================
+    #⭐ 恋愛タイプスコア計算
+    #================================
+    result["love1"] = p1.love_type
+    result["love2"] = p2.love_type
+    result["love_score"] = LOVE_SCORE_MATRIX[love_index(p1.love_type)][love_index(p2.love_type)]
+
+    result["total_score"] = total_compatibility(
+        result["mbti_score"], result["blood_score"], result["love_score"]
+    )
     return result
 
 
+def _score_arrays(table):
+    """スコア表の numpy 版: (不明を None のまま返す object 配列, 不明を nan にした計算用 float 配列)"""
+    values = np.array([[np.nan if v is None else v for v in row] for row in table], dtype=float)
+    return np.array(table, dtype=object), values
+
+
+#行列計算用の numpy 版スコア表
+MBTI_SCORE_ARRAY, MBTI_SCORE_VALUES = _score_arrays(MBTI_SCORE_TABLE)
+BLOOD_SCORE_ARRAY, BLOOD_SCORE_VALUES = _score_arrays(BLOOD_SCORE_MATRIX)
+LOVE_SCORE_ARRAY, LOVE_SCORE_VALUES = _score_arrays(LOVE_SCORE_MATRIX)
+
+
+def calculate_compatibility_matrix(people):
+    """
+    mbti / blood_type / love_type を持つ行の列から N×N のスコア行列を作る。
+    各人の表インデックスを 1 回だけ引き、np.ix_ で表から N×N をまとめて切り出す
+    （Python のループは人数ぶんだけ）。total_scores は calculate_compatibility の total_score と同じ値。
+    """
+    mbti_idx = np.array([mbti_index(p.mbti) for p in people], dtype=np.intp)
+    blood_idx = np.array([blood_index(p.blood_type) for p in people], dtype=np.intp)
+    love_idx = np.array([love_index(p.love_type) for p in people], dtype=np.intp)
+
+    mbti_pairs = np.ix_(mbti_idx, mbti_idx)
+    blood_pairs = np.ix_(blood_idx, blood_idx)
+    love_pairs = np.ix_(love_idx, love_idx)
+
+    #total_compatibility と同じ順・同じ重みで足す（不明は中間点、全部不明なら None）
+    parts = [
+        (COMPATIBILITY_WEIGHTS["mbti"], MBTI_SCORE_VALUES[mbti_pairs]),
+        (COMPATIBILITY_WEIGHTS["blood"], BLOOD_SCORE_VALUES[blood_pairs]),
+        (COMPATIBILITY_WEIGHTS["love"], LOVE_SCORE_VALUES[love_pairs]),
+    ]
+    total = sum(w * np.nan_to_num(values, nan=COMPATIBILITY_UNKNOWN_SCORE) for w, values in parts)
+    total = np.round(total / sum(w for w, _ in parts), 1).astype(object)
+    total[np.logical_and.reduce([np.isnan(values) for _, values in parts])] = None
+
+    return {
+        "mbti_scores": MBTI_SCORE_ARRAY[mbti_pairs].tolist(),
+        "blood_scores": BLOOD_SCORE_ARRAY[blood_pairs].tolist(),
+        "love_scores": LOVE_SCORE_ARRAY[love_pairs].tolist(),
+        "total_scores": total.tolist(),
+    }
+
+
 #============================================================
 #関係性を JSON で返すAPI（vis-network用）
 #============================================================
 @app.route("/api/relations")
+@conditional_response("people", "relations", "layout")
 def api_relations():
     session = Session()
     try:
-        people = session.query(Person).all()
-        relations = session.query(Relationship).all()
+        #データより先に読むので、この後の変更は /api/changes?since=change_seq で必ず拾える
+        change_seq = latest_change_seq(session)
+        layout_version, positions = load_layout(session)
+        relations = session.execute(
+            select(
+                Relationship.id,
+                Relationship.source_id,
+                Relationship.target_id,
+                Relationship.relation_type,
+                Relationship.strength,
+            ).order_by(Relationship.id)
+        )
 
-        people_data = [
-            {
+        #x / y はサーバー側で計算済みの座標（クライアントは物理演算なしで描画できる）
+        no_position = (None, None)
+        people_data = []
+        for p in person_rows(session):
+            x, y = positions.get(p.id, no_position)
+            people_data.append({
                 "id": p.id,
                 "name": p.name,
-                "image": p.image_path
-            }
-            for p in people
-        ]
+                "image": image_variants(shown_image_path(p.image_path, p.image_status))["node"],
+                "x": x,
+                "y": y,
+            })
 
         relations_data = []
-        for r in relations:
-            source, target = sorted([r.source_id, r.target_id])
+        for relation_id, source_id, target_id, relation_type, strength in relations:
+            source, target = sorted([source_id, target_id])
             relations_data.append(
                 {
-                    "id": r.id,
+                    "id": relation_id,
                     "source": source,
                     "target": target,
-                    "type": r.relation_type,
-                    "strength": r.strength,
+                    "type": relation_type,
+                    "strength": strength,
                 }
             )
 
-        return jsonify({"people": people_data, "relations": relations_data})
+        return jsonify({
+            "people": people_data,
+            "relations": relations_data,
+            "layout_version": layout_version,
+            "change_seq": change_seq,
+        })
+    finally:
+        session.close()
+
+
+@app.route("/api/changes")
+def api_changes():
+    """?since=<seq> より後の変更（reset: true なら全体を取り直す。has_more なら last_seq で続きを読む）"""
+    since = request.args.get("since", type=int)
+    if since is None or since < 0:
+        return jsonify({"error": "since is required"}), 400
+    body, _, _ = change_feed(since)
+    return app.response_class(body, mimetype="application/json")
+
+
+@app.route("/api/changes/stream")
+def api_changes_stream():
+    """
+    変更を Server-Sent Events で送る（event: changes、data は /api/changes と同じ JSON、id は last_seq）。
+    再接続時は EventSource が付ける Last-Event-ID から続きを送る。
+    CHANGE_STREAM_ENABLED=1 のときだけ使え、同時接続が上限なら 503（/api/changes のポーリングを使ってもらう）
+    """
+    if not CHANGE_STREAM_ENABLED:
+        return jsonify({"error": "change stream is disabled; poll /api/changes"}), 404
+    since = request.headers.get("Last-Event-ID", type=int)
+    if since is None:
+        since = request.args.get("since", type=int)
+    if since is None or since < 0:
+        return jsonify({"error": "since is required"}), 400
+    if not _change_stream_slots.acquire(blocking=False):
+        response = jsonify({"error": "too many change streams; poll /api/changes"})
+        response.status_code = 503
+        response.headers["Retry-After"] = str(CHANGE_STREAM_MAX_SECONDS)
+        return response
+
+    def generate(since):
+        started = last_sent = time.time()
+        yield "retry: 3000\n\n"
+        while time.time() - started < CHANGE_STREAM_MAX_SECONDS:
+            body, last_seq, has_more = change_feed(since)
+            if last_seq != since:   #reset のときも last_seq は since と違う
+                yield f"id: {last_seq}\nevent: changes\ndata: {body.decode('utf-8')}\n\n"
+                since, last_sent = last_seq, time.time()
+                if has_more:
+                    continue
+            elif time.time() - last_sent >= CHANGE_STREAM_HEARTBEAT:
+                yield ": ping\n\n"
+                last_sent = time.time()
+            time.sleep(CHANGE_STREAM_POLL_INTERVAL)
+
+    response = app.response_class(stream_with_context(generate(since)), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"   #プロキシにバッファさせない
+    response.call_on_close(_change_stream_slots.release)   #切断・打ち切りのどちらでも枠を返す
+    return response
+
+
+
+#============================================================
+#関係性グラフの探索 API（必要な近傍だけ返す）
+#============================================================
+def graph_filter_args():
+    """?type=friend,lover&min_strength=2 を辺の述語にする"""
+    types = request.args.get("type")
+    min_strength = request.args.get("min_strength")
+    return RelationGraph.edge_filter(
+        [t for t in types.split(",") if t] if types else None,
+        int(min_strength) if min_strength else None,
+    )
+
+
+def graph_payload(session, node_ids, edge_ids):
+    """ノード id・辺 id の集合を /api/relations と同じ形の JSON にする"""
+    people = (
+        session.query(Person.id, Person.name, Person.image_path, Person.image_status)
+        .filter(Person.id.in_(node_ids))
+        .all()
+        if node_ids else []
+    )
+    relations_data = []
+    for relation_id in sorted(edge_ids):
+        edge = relation_graph.edge(relation_id)
+        if edge:
+            relations_data.append({
+                "id": relation_id,
+                "source": edge[0],
+                "target": edge[1],
+                "type": edge[2],
+                "strength": edge[3],
+            })
+    layout_version, positions = load_layout(session, [p.id for p in people])
+    return {
+        "people": [
+            {
+                "id": p.id,
+                "name": p.name,
+                "image": image_variants(shown_image_path(p.image_path, p.image_status))["node"],
+                "x": positions.get(p.id, (None, None))[0],
+                "y": positions.get(p.id, (None, None))[1],
+            }
+            for p in people
+        ],
+        "relations": relations_data,
+        "layout_version": layout_version,
+    }
+
+
+@app.route("/api/relations/ego/<int:person_id>")
+def api_relations_ego(person_id):
+    """person_id から depth ホップ以内のエゴネットワーク"""
+    try:
+        depth = min(max(int(request.args.get("depth", 1)), 1), GRAPH_MAX_DEPTH)
+        accept = graph_filter_args()
+    except ValueError:
+        return jsonify({"error": "invalid parameters"}), 400
+
+    relation_graph.ensure_fresh()
+    nodes, edge_ids = relation_graph.ego(person_id, depth, accept)
+
+    session = Session()
+    try:
+        return jsonify(graph_payload(session, nodes, edge_ids))
+    finally:
+        session.close()
+
+
+@app.route("/api/relations/path")
+def api_relations_path():
+    """2人をつなぐ最短経路（ホップ数）"""
+    try:
+        start = int(request.args["from"])
+        goal = int(request.args["to"])
+        accept = graph_filter_args()
+    except (KeyError, ValueError):
+        return jsonify({"error": "from and to are required"}), 400
+
+    relation_graph.ensure_fresh()
+    path = relation_graph.shortest_path(start, goal, accept)
+    if path is None:
+        return jsonify({"path": None, "people": [], "relations": []}), 404
+
+    session = Session()
+    try:
+        payload = graph_payload(session, set(path), relation_graph.path_edges(path))
+        payload["path"] = path
+        return jsonify(payload)
+    finally:
+        session.close()
+
+
+@app.route("/api/relations/components")
+def api_relations_components():
+    """連結成分の一覧（大きい順）"""
+    try:
+        accept = graph_filter_args()
+    except ValueError:
+        return jsonify({"error": "invalid parameters"}), 400
+
+    relation_graph.ensure_fresh()
+    components = relation_graph.components(accept)
+    return jsonify([{"size": len(c), "people": c} for c in components])
+
+
+@app.route("/api/relations/degrees")
+def api_relations_degrees():
+    """つながりの多い人ランキング"""
+    try:
+        limit = min(max(int(request.args.get("limit", 20)), 1), 500)
+        accept = graph_filter_args()
+    except ValueError:
+        return jsonify({"error": "invalid parameters"}), 400
+
+    relation_graph.ensure_fresh()
+    ranking = relation_graph.degrees(accept, limit)
+
+    session = Session()
+    try:
+        names = dict(
+            session.query(Person.id, Person.name)
+            .filter(Person.id.in_([person_id for person_id, _, _ in ranking]))
+            .all()
+        ) if ranking else {}
+    finally:
+        session.close()
+
+    return jsonify([
+        {"id": person_id, "name": names.get(person_id), "degree": degree, "strength_sum": strength_sum}
+        for person_id, degree, strength_sum in ranking
+    ])
+
+
+@app.route("/api/relations/subgraph")
+def api_relations_subgraph():
+    """relation_type / 最小 strength で絞った部分グラフ"""
+    try:
+        accept = graph_filter_args()
+    except ValueError:
+        return jsonify({"error": "invalid parameters"}), 400
+
+    relation_graph.ensure_fresh()
+    nodes, edge_ids = relation_graph.subgraph(accept)
+
+    session = Session()
+    try:
+        return jsonify(graph_payload(session, nodes, edge_ids))
     finally:
         session.close()
 
 
 
+#============================================
+#アプリファクトリ（gunicorn / テスト用）
+#============================================
+#import しただけでは DB にも Cloudinary にも触らない。エンジン・スキーマ確認・Cloudinary 設定は
+#最初に使うときに行う。ルートはモジュールの app に登録済みなので、create_app は設定を反映して
+#その app を返す（Blueprint に分けるほどの規模ではないので 1 プロセス 1 アプリ）
+def create_app(config=None):
+    """
+    config（DATABASE_URL / AUTO_MIGRATE など app.config に入れる値）を反映したアプリを返す。
+    DATABASE_URL が変わったらエンジンと、前の DB の中身を持っているプロセス内の
+    キャッシュ・索引（人物キャッシュ・検索・関係グラフ・ファセット・静的マニフェスト）を作り直す。
+    """
+    global person_cache, search_index, relation_graph, facet_index, _static_manifest, _change_log_writes
+    config = dict(config or {})
+    if "DATABASE_URL" in config and config["DATABASE_URL"].startswith("postgres://"):
+        config["DATABASE_URL"] = config["DATABASE_URL"].replace("postgres://", "postgresql://", 1)
+    url_changed = config.get("DATABASE_URL", app.config["DATABASE_URL"]) != app.config["DATABASE_URL"]
+    app.config.update(config)
+    if url_changed:
+        dispose_engine()
+        person_cache = make_person_cache()
+        search_index = SearchIndex()
+        relation_graph = RelationGraph()
+        facet_index = FacetIndex()
+        _static_manifest = None
+        _change_log_writes = 0
+    return app
+
+
+def warm_up():
+    """
+    フォーク前（gunicorn の preload_app）に 1 回だけやっておく初期化。
+    スキーマ確認・マイグレーションと静的ファイルの圧縮、ファセット索引の構築をマスターで済ませ、
+    ワーカーはそれをコピーオンライトで引き継ぐ（索引はその後 change_log の差分だけ反映する）。
+    """
+    get_engine()
+    static_manifest()
+    facet_index.ensure_fresh()
+
+
+def _reset_after_fork():
+    #親の接続プールは親のもの：子では閉じずに手放し、新しいプールで接続し直す
+    #（エンジン自体とスキーマ確認済みの状態はそのまま引き継ぐ）。
+    #画像ワーカースレッドはフォークで引き継がれないので、最初のリクエストで起動し直す
+    global _engine_lock, _image_workers_lock
+    if _engine is not None:
+        _engine.dispose(close=False)
+    _engine_lock = threading.Lock()
+    _image_workers.clear()
+    _image_workers_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
 #============================================
 #メイン
 #============================================
 if __name__ == "__main__":
-    app.run(debug=True)
+    #python app.py worker → 画像ジョブ専用プロセスとして動かす
+    if sys.argv[1:] == ["worker"]:
+        _image_worker_loop()
+    #python app.py migrate → テーブル作成と未適用マイグレーションだけ流す（AUTO_MIGRATE=0 で運用するとき用）
+    elif sys.argv[1:] == ["migrate"]:
+        prepare_database(make_engine(app.config["DATABASE_URL"]))
+    #python app.py check-plans → ホットなクエリがインデックスを使っているか確認（NG があれば終了コード 1）
+    elif sys.argv[1:] == ["check-plans"]:
+        plan_results = check_query_plans()
+        for plan_name, plan_ok, plan_text in plan_results:
+            print(f"[{'OK' if plan_ok else 'NG'}] {plan_name}")
+            if not plan_ok:
+                print(plan_text)
+        sys.exit(0 if all(ok for _, ok, _ in plan_results) else 1)
+    #python app.py layout → 関係性グラフのレイアウトをこのプロセスで全体計算し直す
+    elif sys.argv[1:] == ["layout"]:
+        with Session() as layout_session:
+            print(f"[INFO] layout version {compute_layout(layout_session)}")
+    #python app.py gc-images → 孤立画像の GC をこのプロセスで最後まで流す（前回の途中から再開する）
+    elif sys.argv[1:] == ["gc-images"]:
+        with Session() as gc_session:
+            start_image_gc(gc_session)
+            gc_session.commit()
+        process_image_jobs()
+    #python app.py import <ファイル> [people|relations] → 一括インポート（.csv / .jsonl）
+    elif sys.argv[1:2] == ["import"] and len(sys.argv) >= 3:
+        import_path = sys.argv[2]
+        import_format = "csv" if import_path.endswith(".csv") else "jsonl"
+        import_kind = sys.argv[3] if len(sys.argv) >= 4 else "people"
+        with open(import_path, "rb") as import_file:
+            for import_progress in import_records(read_import_records(import_file, import_format, import_kind)):
+                for import_error in import_progress.pop("errors", []):
+                    print(f"[Import ERROR] line {import_error['line']}: {import_error['error']}")
+                print("[Import]", json.dumps(import_progress, ensure_ascii=False))
+    else:
+        app.run(debug=True)
 
 
 #============================================
@@ -44,8 +44,8 @@ async function showDetail(id) {
     detailBody.innerHTML = `
       <div class="detail-header">
         <div class="detail-icon-area">
-          ${data.image_path
-            ? `<img src="${data.image_path}" class="detail-image">`
+          ${data.images && data.images.modal
+            ? `<img src="${data.images.modal}" class="detail-image">`
             : `<div class="person-placeholder detail-image"></div>`}
         </div>
 
@@ -6,6 +6,12 @@ let selectedIds = [];
 let diagnoseBtn = null;
 let currentPeople = [];
 
+//ページング状態（filterBody が null なら全件一覧、それ以外はフィルター結果）
+let currentSort = "id";
+let filterBody = null;
+let nextCursor = null;
+let pageLoading = false;
+
 /* ============================================================
    ユーティリティ / 初期データ読み込み
 ============================================================ */
@@ -19,6 +25,65 @@ function loadInitialPeople() {
   }
 }
 
+function loadInitialCursor() {
+  const grid = document.getElementById("people-grid");
+  return (grid && grid.dataset.nextCursor) || null;
+}
+
+function loadInitialChangeSeq() {
+  const grid = document.getElementById("people-grid");
+  const seq = grid ? parseInt(grid.dataset.changeSeq, 10) : NaN;
+  return Number.isNaN(seq) ? null : seq;
+}
+
+/* ============================================================
+   ページ取得（/api/people or /filter をキーセットで順に読む）
+============================================================ */
+async function fetchPeoplePage(cursor) {
+  if (filterBody) {
+    const res = await fetch("/filter", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ ...filterBody, sort: currentSort, cursor })
+    });
+    return res.json();
+  }
+
+  const params = new URLSearchParams({ sort: currentSort });
+  if (cursor) params.set("cursor", cursor);
+  const res = await fetch(`/api/people?${params.toString()}`);
+  return res.json();
+}
+
+async function reloadPeople() {
+  const data = await fetchPeoplePage(null);
+  nextCursor = data.next_cursor;
+  renderPeople(data.people);
+}
+
+async function loadNextPage() {
+  if (pageLoading || !nextCursor) return;
+
+  pageLoading = true;
+  try {
+    const data = await fetchPeoplePage(nextCursor);
+    nextCursor = data.next_cursor;
+    appendPeople(data.people);
+  } finally {
+    pageLoading = false;
+  }
+}
+
+function setupInfiniteScroll() {
+  const sentinel = document.getElementById("people-sentinel");
+  if (!sentinel) return;
+
+  const observer = new IntersectionObserver(entries => {
+    if (entries.some(e => e.isIntersecting)) loadNextPage();
+  }, { rootMargin: "600px" });
+  observer.observe(sentinel);
+}
+
 /* ============================================================
    相性診断モード
 ============================================================ */
@@ -241,28 +306,100 @@ async function handleCardClick(e) {
 /* ============================================================
    フィルター機能
 ============================================================ */
-async function applyFilter() {
+function readFilterForm() {
   const formData = new FormData(document.getElementById("filterForm"));
-  const selectedTags = [...formData.getAll("tags")].map(Number);
 
-  const body = {
+  return {
     name: formData.get("name") || "",
     blood_type: formData.get("blood_type") || "",
     mbti: formData.get("mbti") || "",
     love_type: formData.get("love_type") || "",
-    tags: selectedTags
+    tags: [...formData.getAll("tags")].map(Number),
+    tag_mode: formData.get("tag_mode") || "any"
   };
+}
+
+async function applyFilter() {
+  filterBody = readFilterForm();
+
+  await reloadPeople();
+
+  document.getElementById("filterModal").style.display = "none";
+}
+
+/* ============================================================
+   絞り込み件数（/api/facets）
+   - 条件を変えるたびに「この選択肢を選んだら何人か」を各選択肢に出す
+============================================================ */
+let facetTimer = null;
+
+function scheduleFacetCounts() {
+  clearTimeout(facetTimer);
+  facetTimer = setTimeout(refreshFacetCounts, 150);
+}
 
-  const res = await fetch("/filter", {
+async function refreshFacetCounts() {
+  const form = document.getElementById("filterForm");
+  const res = await fetch("/api/facets", {
     method: "POST",
     headers: { "Content-Type": "application/json" },
-    body: JSON.stringify(body)
+    body: JSON.stringify({ ...readFilterForm(), limit: 0 })
   });
+  if (!res.ok) return;
+  const data = await res.json();
 
-  const people = await res.json();
-  renderPeople(people);
+  //元のラベルは data-label に控えておき、件数だけ付け替える
+  for (const field of ["blood_type", "mbti", "love_type"]) {
+    form.querySelectorAll(`select[name="${field}"] option`).forEach(option => {
+      if (!option.value) return;
+      option.dataset.label = option.dataset.label || option.textContent;
+      option.textContent = `${option.dataset.label}（${data.counts[field][option.value] || 0}）`;
+    });
+  }
 
-  document.getElementById("filterModal").style.display = "none";
+  form.querySelectorAll('input[name="tags"]').forEach(input => {
+    const label = input.closest("label");
+    let count = label.querySelector(".facet-count");
+    if (!count) {
+      count = document.createElement("span");
+      count.className = "facet-count";
+      label.appendChild(count);
+    }
+    count.textContent = `（${data.counts.tags[input.value] || 0}）`;
+  });
+
+  document.getElementById("applyFilterBtn").textContent = `検索（${data.total}件）`;
+}
+
+/* ============================================================
+   名前のタイプアヘッド候補（/api/search）
+============================================================ */
+function setupNameSuggest() {
+  const input = document.querySelector('#filterForm input[name="name"]');
+  const list = document.getElementById("nameSuggestions");
+  if (!input || !list) return;
+
+  let timer = null;
+  input.addEventListener("input", () => {
+    clearTimeout(timer);
+    const q = input.value.trim();
+    if (!q) {
+      list.innerHTML = "";
+      return;
+    }
+
+    timer = setTimeout(async () => {
+      const res = await fetch(`/api/search?${new URLSearchParams({ q, limit: 8 })}`);
+      const hits = await res.json();
+      //名前はユーザー入力なので innerHTML に埋め込まず、要素を作って値として入れる
+      list.replaceChildren(...hits.map(h => {
+        const option = document.createElement("option");
+        option.value = h.name;
+        option.textContent = h.reading || "";
+        return option;
+      }));
+    }, 150);
+  });
 }
 
 function setupFilterModal() {
@@ -271,6 +408,7 @@ function setupFilterModal() {
 
   document.getElementById("openFilterBtn").onclick = () => {
     filterModal.style.display = "flex";
+    refreshFacetCounts();
   };
   if (closeFilterBtnTop) {
     closeFilterBtnTop.onclick = () => {
@@ -278,6 +416,9 @@ function setupFilterModal() {
     };
   }
   document.getElementById("applyFilterBtn").onclick = applyFilter;
+  document.getElementById("filterForm").addEventListener("change", scheduleFacetCounts);
+  document.getElementById("filterForm").addEventListener("input", scheduleFacetCounts);
+  setupNameSuggest();
 }
 
 /* ============================================================
@@ -299,28 +440,10 @@ function setupSortModal() {
     };
   }
 
-  sortApplyBtn.onclick = () => {
-    const key = document.getElementById("sortSelect").value;
-    let sorted = [...currentPeople];
-
-    if (key === "reading") {
-      sorted.sort((a, b) => (a.reading || "").localeCompare(b.reading || ""));
-    }
-
-    if (key === "birth") {
-      sorted.sort((a, b) => {
-        const da = a.birth || "9999-12-31";
-        const db = b.birth || "9999-12-31";
-        return da.localeCompare(db);
-      });
-    }
-
-    if (key === "id") {
-      sorted.sort((a, b) => a.id - b.id);
-    }
-
-    currentPeople = sorted;
-    renderPeople(sorted);
+  //ページングしているので並び替えはサーバー側で行い、1 ページ目から読み直す
+  sortApplyBtn.onclick = async () => {
+    currentSort = document.getElementById("sortSelect").value;
+    await reloadPeople();
     sortModal.style.display = "none";
   };
 }
@@ -328,6 +451,17 @@ function setupSortModal() {
 /* ============================================================
    図鑑一覧表示
 ============================================================ */
+function personCardHtml(p) {
+  return `
+    <div class="person-card" data-id="${p.id}">
+      ${p.images && p.images.card
+        ? `<img src="${p.images.card}" class="person-img" loading="lazy">`
+        : `<div class="person-placeholder">No Image</div>`}
+      <p class="person-name"><b>${p.name}</b></p>
+    </div>
+  `;
+}
+
 function renderPeople(people) {
   currentPeople = people;
 
@@ -339,16 +473,108 @@ function renderPeople(people) {
     return;
   }
 
-  people.forEach(p => {
-    grid.innerHTML += `
-      <div class="person-card" data-id="${p.id}">
-        ${p.image_path
-          ? `<img src="${p.image_path}" class="person-img">`
-          : `<div class="person-placeholder">No Image</div>`}
-        <p class="person-name"><b>${p.name}</b></p>
-      </div>
-    `;
+  grid.innerHTML = people.map(personCardHtml).join("");
+}
+
+function appendPeople(people) {
+  currentPeople = currentPeople.concat(people);
+
+  const grid = document.getElementById("people-grid");
+  grid.insertAdjacentHTML("beforeend", people.map(personCardHtml).join(""));
+}
+
+/* ============================================================
+   変更フィード（/api/changes）をポーリングして表示中のカードだけ差し替え
+   - タブが見えているときだけ。取り直しが必要（reset）なら 1 ページ目から読み直す
+   - 表示中の人物は中身を差し替え、削除された人物はカードを外す
+   - 新しい人物は、全件一覧の id 順で最後のページまで読み終えているときだけ末尾に足す
+     （それ以外は並び・絞り込みの位置が分からないので、続きのページや読み直しで出てくる）
+============================================================ */
+const CHANGE_POLL_INTERVAL = 10000;
+
+function applyPeopleDelta(delta) {
+  const grid = document.getElementById("people-grid");
+  const shown = new Map(currentPeople.map((p, i) => [p.id, i]));
+  const added = [];
+
+  delta.people.forEach(p => {
+    if (shown.has(p.id)) {
+      currentPeople[shown.get(p.id)] = p;
+      const card = grid.querySelector(`.person-card[data-id="${p.id}"]`);
+      if (card) {
+        const border = card.style.border;   //相性診断モードの選択表示は残す
+        card.outerHTML = personCardHtml(p);
+        grid.querySelector(`.person-card[data-id="${p.id}"]`).style.border = border;
+      }
+    } else if (!filterBody && currentSort === "id" && !nextCursor) {
+      added.push(p);
+    }
+  });
+
+  const deleted = new Set(delta.deleted_people);
+  if (deleted.size) {
+    currentPeople = currentPeople.filter(p => !deleted.has(p.id));
+    deleted.forEach(id => {
+      const card = grid.querySelector(`.person-card[data-id="${id}"]`);
+      if (card) card.remove();
+    });
+    selectedIds = selectedIds.filter(id => !deleted.has(id));
+    if (compatMode && selectedIds.length < 2) hideDiagnoseButton();
+  }
+
+  if (added.length) {
+    if (!grid.querySelector(".person-card")) grid.innerHTML = "";
+    appendPeople(added.sort((a, b) => a.id - b.id));
+  }
+}
+
+function setupChangePolling() {
+  let since = loadInitialChangeSeq();
+  if (since === null) return;
+  let timer = null;
+  let polling = false;
+
+  const poll = async () => {
+    timer = null;
+    polling = true;
+    try {
+      const res = await fetch(`/api/changes?since=${since}`);
+      if (res.ok) {
+        const delta = await res.json();
+        if (delta.reset) {
+          await reloadPeople();
+        } else {
+          applyPeopleDelta(delta);
+        }
+        since = delta.last_seq;
+        //続きがあればすぐ読む
+        if (delta.has_more) {
+          poll();
+          return;
+        }
+      }
+    } catch (e) {
+      console.error("変更フィードの取得に失敗:", e);
+    }
+    polling = false;
+    schedule();
+  };
+
+  const schedule = () => {
+    if (timer === null && !polling && document.visibilityState === "visible") {
+      timer = setTimeout(poll, CHANGE_POLL_INTERVAL);
+    }
+  };
+
+  document.addEventListener("visibilitychange", () => {
+    if (document.visibilityState === "visible") {
+      schedule();
+    } else if (timer !== null) {
+      clearTimeout(timer);
+      timer = null;
+    }
   });
+  schedule();
 }
 
 /* ============================================================
@@ -356,10 +582,13 @@ function renderPeople(people) {
 ============================================================ */
 function init() {
   currentPeople = loadInitialPeople();
+  nextCursor = loadInitialCursor();
 
   setupCompatibilityMode();
   setupFilterModal();
   setupSortModal();
+  setupInfiniteScroll();
+  setupChangePolling();
 
   document.getElementById("people-grid")
     .addEventListener("click", handleCardClick);
@@ -8,8 +8,15 @@ document.addEventListener("DOMContentLoaded", async () => {
 
   /* ------------------------------
      1. API からデータ取得
+     - ?focus=<id>&depth=<n> なら、その人の周辺だけ取得
   ------------------------------ */
-  const res = await fetch("/api/relations");
+  const params = new URLSearchParams(location.search);
+  const focusId = params.get("focus");
+  const apiUrl = focusId
+    ? `/api/relations/ego/${encodeURIComponent(focusId)}?depth=${encodeURIComponent(params.get("depth") || 2)}`
+    : "/api/relations";
+
+  const res = await fetch(apiUrl);
   const data = await res.json();
 
   const people = data.people;
@@ -18,14 +25,25 @@ document.addEventListener("DOMContentLoaded", async () => {
   /* ------------------------------
      2. ノード生成（人物）
   ------------------------------ */
-  const nodes = people.map(p => ({
+  //サーバー側で座標が計算済みなら、その位置に固定して物理演算を省く。
+  //一部だけ（レイアウトジョブが追いつく前の新しい人物がいる）なら、計算済みの人は固定して残りだけ物理演算で置く
+  const placedCount = people.filter(p => p.x !== null && p.y !== null).length;
+  const hasLayout = people.length > 0 && placedCount === people.length;
+  const partialLayout = placedCount > 0 && !hasLayout;
+
+  const toNode = (p, image) => ({
     id: p.id,
     label: p.name,
     shape: "circularImage",
-    image: p.image || "/static/default_icon.png",
+    image: image || "/static/default_icon.png",
     size: 40,
     font: { size: 14 }
-  }));
+  });
+
+  const nodes = new vis.DataSet(people.map(p => ({
+    ...toNode(p, p.image),
+    ...(p.x !== null && p.y !== null ? { x: p.x, y: p.y, fixed: partialLayout } : {})
+  })));
 
   /* ------------------------------
      3. 関係タイプごとの線色
@@ -46,7 +64,7 @@ document.addEventListener("DOMContentLoaded", async () => {
      - 太さ：strength（1〜5）
      - 色：relation_type に応じて
   ------------------------------ */
-  const edges = relations.map(r => {
+  const toEdge = r => {
     const edgeColor = REL_COLORS[r.type] || DEFAULT_REL_COLOR;
 
     return {
@@ -59,7 +77,9 @@ document.addEventListener("DOMContentLoaded", async () => {
         highlight: edgeColor
       }
     };
-  });
+  };
+
+  const edges = new vis.DataSet(relations.map(toEdge));
 
   /* ------------------------------
      5. ネットワーク描画
@@ -68,10 +88,9 @@ document.addEventListener("DOMContentLoaded", async () => {
     container,
     { nodes, edges },
     {
-      physics: {
-        enabled: true,
-        stabilization: true
-      },
+      physics: hasLayout
+        ? { enabled: false }
+        : { enabled: true, stabilization: true },
       interaction: {
         hover: true
       },
@@ -81,6 +100,14 @@ document.addEventListener("DOMContentLoaded", async () => {
     }
   );
 
+  //残りを置き終えたら物理演算を止め、固定を外してドラッグできるようにする
+  if (partialLayout) {
+    network.once("stabilizationIterationsDone", () => {
+      network.setOptions({ physics: { enabled: false } });
+      nodes.update(nodes.getIds().map(id => ({ id, fixed: false })));
+    });
+  }
+
   /* ------------------------------
      6. ノードクリック → 詳細モーダル
   ------------------------------ */
@@ -90,4 +117,72 @@ document.addEventListener("DOMContentLoaded", async () => {
       showDetail(id); // 既存の詳細モーダルを利用
     }
   });
+
+  /* ------------------------------
+     7. ノードダブルクリック → その人の周辺だけ表示
+  ------------------------------ */
+  network.on("doubleClick", params => {
+    if (params.nodes.length > 0) {
+      location.search = `?focus=${params.nodes[0]}&depth=2`;
+    }
+  });
+
+  /* ------------------------------
+     8. 変更フィードをポーリングして差分だけ反映
+     - 全体表示で、タブが見えているときだけ。取り直しが必要（reset）ならページを読み直す
+     - 接続を張りっぱなしにしない（サーバーのスレッドをふさがない）よう、短い GET を間隔をあけて投げる
+     - 既存ノードの位置は動かさない（新しい人物だけ vis が配置する）
+  ------------------------------ */
+  const CHANGE_POLL_INTERVAL = 10000;
+
+  if (!focusId && data.change_seq !== undefined) {
+    let since = data.change_seq;
+    let timer = null;
+    let polling = false;
+
+    const poll = async () => {
+      timer = null;
+      polling = true;
+      try {
+        const res = await fetch(`/api/changes?since=${since}`);
+        if (res.ok) {
+          const delta = await res.json();
+          if (delta.reset) {
+            location.reload();
+            return;
+          }
+          nodes.update(delta.people.map(p => toNode(p, p.images && p.images.node)));
+          nodes.remove(delta.deleted_people);
+          edges.update(delta.relations.map(toEdge));
+          edges.remove(delta.deleted_relations);
+          since = delta.last_seq;
+          //続きがあればすぐ読む
+          if (delta.has_more) {
+            poll();
+            return;
+          }
+        }
+      } catch (e) {
+        console.error("変更フィードの取得に失敗:", e);
+      }
+      polling = false;
+      schedule();
+    };
+
+    const schedule = () => {
+      if (timer === null && !polling && document.visibilityState === "visible") {
+        timer = setTimeout(poll, CHANGE_POLL_INTERVAL);
+      }
+    };
+
+    document.addEventListener("visibilitychange", () => {
+      if (document.visibilityState === "visible") {
+        schedule();
+      } else if (timer !== null) {
+        clearTimeout(timer);
+        timer = null;
+      }
+    });
+    schedule();
+  }
 });
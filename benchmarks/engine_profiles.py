@@ -0,0 +1,102 @@
+"""
+エンジンプロファイル（default / tuned）のスループット比較。
+
+gunicorn の複数ワーカーを真似て、複数プロセスから読み 9 : 書き 1 の負荷をかける。
+
+    python benchmarks/engine_profiles.py                  #SQLite
+    BENCH_POSTGRES_URL=postgresql://... python benchmarks/engine_profiles.py
+"""
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+sys.path.insert(0, BACKEND_DIR)
+#app の import 時に作られる既定エンジンは使わないので一時 DB に向けておく
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "import.db"))
+os.environ.setdefault("IMAGE_JOB_WORKERS", "0")
+
+import app as zukan  # noqa: E402
+from sqlalchemy import select  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+WORKERS = int(os.environ.get("BENCH_WORKERS", "4"))
+DURATION = float(os.environ.get("BENCH_DURATION", "5"))
+SEED_PEOPLE = int(os.environ.get("BENCH_PEOPLE", "5000"))
+WRITE_RATIO = 0.1
+MBTI = list(zukan.MBTI_LABELS)
+
+
+def seed(url):
+    engine = zukan.make_engine(url, profile="tuned", echo=False)
+    zukan.Base.metadata.drop_all(engine)
+    zukan.Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(
+            zukan.Person.__table__.insert(),
+            [{"name": f"person{i}", "mbti": random.choice(MBTI)} for i in range(SEED_PEOPLE)],
+        )
+    engine.dispose()
+
+
+def worker(url, profile, deadline, results):
+    engine = zukan.make_engine(url, profile=profile, echo=False)
+    Session = sessionmaker(bind=engine)
+    ops = errors = 0
+    while time.time() < deadline:
+        session = Session()
+        try:
+            if random.random() < WRITE_RATIO:
+                session.add(zukan.Person(name="bench", mbti=random.choice(MBTI)))
+                session.commit()
+            else:
+                session.execute(
+                    select(zukan.Person.id, zukan.Person.name)
+                    .where(zukan.Person.mbti == random.choice(MBTI))
+                    .limit(50)
+                ).all()
+            ops += 1
+        except Exception:
+            session.rollback()
+            errors += 1
+        finally:
+            session.close()
+    engine.dispose()
+    results.put((ops, errors))
+
+
+def run(url, profile):
+    seed(url)
+    results = multiprocessing.Queue()
+    deadline = time.time() + DURATION
+    procs = [
+        multiprocessing.Process(target=worker, args=(url, profile, deadline, results))
+        for _ in range(WORKERS)
+    ]
+    for p in procs:
+        p.start()
+    totals = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+    ops = sum(o for o, _ in totals)
+    errors = sum(e for _, e in totals)
+    return ops / DURATION, errors
+
+
+def main():
+    targets = [("sqlite", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))]
+    if os.environ.get("BENCH_POSTGRES_URL"):
+        targets.append(("postgresql", os.environ["BENCH_POSTGRES_URL"]))
+
+    print(f"workers={WORKERS} duration={DURATION}s people={SEED_PEOPLE} write_ratio={WRITE_RATIO}")
+    for name, url in targets:
+        for profile in ("default", "tuned"):
+            throughput, errors = run(url, profile)
+            print(f"{name:<10} {profile:<8} {throughput:10.1f} ops/s  errors={errors}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+関係性グラフのレイアウト計算のベンチマーク（合成データ）。
+
+    python benchmarks/layout_bench.py            #1k
+    python benchmarks/layout_bench.py 1k 10k
+
+synthetic_zukan は座標を乱数で入れるので、ここでは座標とレイアウトの版数を消した
+「未計算」の状態から、レイアウトジョブ / python app.py layout と同じ compute_layout を呼んで
+- cold: 全体の計算（LAYOUT_ITERATIONS 回・人数が多いと LAYOUT_FULL_BUDGET に収まる回数の反復と、書き込み・commit まで）
+- incremental: 関係 1 本ぶん（2 人とその隣人）の緩和
+の所要時間を測る。
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+from sqlalchemy.orm import Session
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+import synthetic_zukan  # noqa: E402
+
+INCREMENTAL_RUNS = int(os.environ.get("BENCH_LAYOUT_RUNS", "5"))
+
+
+def measure(fn):
+    started = time.perf_counter()
+    fn()
+    return time.perf_counter() - started
+
+
+def bench_size(zukan, size):
+    engine = zukan.make_engine("sqlite:///" + os.path.join(tempfile.mkdtemp(), f"layout_{size}.db"))
+    zukan.prepare_database(engine)
+    counts = synthetic_zukan.generate(zukan, engine, size)
+    with engine.begin() as conn:
+        conn.execute(zukan.NodePosition.__table__.delete())
+        conn.execute(zukan.GraphLayoutState.__table__.delete())
+
+    session = Session(engine)
+    try:
+        cold = measure(lambda: zukan.compute_layout(session))
+        rng = random.Random(0)
+        pairs = session.query(zukan.Relationship.source_id, zukan.Relationship.target_id).all()
+        incremental = sorted(
+            measure(lambda: zukan.compute_layout(session, dirty_ids=list(rng.choice(pairs))))
+            for _ in range(INCREMENTAL_RUNS)
+        )
+    finally:
+        session.close()
+        engine.dispose()
+
+    print(f"== {size} people / {counts['relations']} relations")
+    print(f"cold layout         {cold * 1000:9.1f}ms")
+    print(f"incremental (p50)   {incremental[len(incremental) // 2] * 1000:9.1f}ms")
+
+
+def main():
+    sizes = [synthetic_zukan.parse_size(arg) for arg in sys.argv[1:]] or [synthetic_zukan.SIZES["1k"]]
+    os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "import.db"))
+    os.environ.setdefault("IMAGE_JOB_WORKERS", "0")
+    import app as zukan
+
+    for size in sizes:
+        bench_size(zukan, size)
+
+
+if __name__ == "__main__":
+    main()
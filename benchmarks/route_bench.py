@@ -0,0 +1,177 @@
+"""
+主要ルートのベンチマーク（合成データ + Flask テストクライアント）。
+
+    python benchmarks/route_bench.py                     #1k で計測してベースラインと比較
+    python benchmarks/route_bench.py 1k 10k              #サイズを指定
+    python benchmarks/route_bench.py 1k --update-baseline
+
+ルートごとにレイテンシの p50 / p95 / p99、1 リクエストあたりの最大クエリ数、
+ピークメモリ（tracemalloc）を測り、benchmarks/baseline.json と比べて
+悪化していれば終了コード 1 で終わる。クエリ数は決定的なので 1 本でも増えたら NG、
+レイテンシとメモリはマシン差があるので許容幅（BENCH_LATENCY_TOLERANCE など）を超えたら NG。
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy import event
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+import synthetic_zukan  # noqa: E402
+
+BASELINE_PATH = os.path.join(BENCH_DIR, "baseline.json")
+ITERATIONS = int(os.environ.get("BENCH_ITERATIONS", "30"))
+WARMUP = 3
+MEMORY_ITERATIONS = 3
+LATENCY_TOLERANCE = float(os.environ.get("BENCH_LATENCY_TOLERANCE", "0.5"))   #p95 が +50% まで
+MEMORY_TOLERANCE = float(os.environ.get("BENCH_MEMORY_TOLERANCE", "0.25"))    #ピークが +25% まで
+
+
+def route_requests(zukan, rng, person_ids):
+    """(ルート名, テストクライアントを受け取ってリクエストを 1 回投げる関数) の一覧"""
+    mbti = list(zukan.MBTI_LABELS)
+    blood = list(synthetic_zukan.BLOOD_WEIGHTS)
+
+    def filter_body():
+        body = {"mbti": rng.choice(mbti + [""]), "blood_type": rng.choice(blood + [""])}
+        if rng.random() < 0.3:
+            body["tags"] = [rng.randint(1, 5)]
+        return body
+
+    return [
+        ("index", lambda c: c.get("/")),
+        ("filter_people", lambda c: c.post("/filter", json=filter_body())),
+        ("stats", lambda c: c.get("/stats")),
+        ("stats_members", lambda c: c.get(f"/stats_members?type=mbti&value={rng.choice(mbti)}")),
+        ("api_relations", lambda c: c.get("/api/relations")),
+        ("compatibility_api", lambda c: c.post(
+            "/compatibility_api", json={"id1": rng.choice(person_ids), "id2": rng.choice(person_ids)}
+        )),
+        ("relations_page", lambda c: c.get("/relations")),
+    ]
+
+
+def percentile(sorted_values, p):
+    index = min(int(round(p / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def bench_size(size):
+    """1 サイズ分を別プロセスで計測する（app はインポート時の DATABASE_URL に縛られるため）"""
+    path = os.path.join(tempfile.mkdtemp(), "zukan.db")
+    os.environ["DATABASE_URL"] = "sqlite:///" + path
+    os.environ.setdefault("IMAGE_JOB_WORKERS", "0")
+    os.environ.setdefault("SLOW_REQUEST_SECONDS", "3600")
+    import app as zukan
+
+    synthetic_zukan.generate(zukan, zukan.get_engine(), size)
+    with zukan.Session() as session:
+        person_ids = [row[0] for row in session.query(zukan.Person.id)]
+    client = zukan.app.test_client()
+
+    query_count = [0]
+    event.listen(zukan.get_engine(), "after_cursor_execute", lambda *args: query_count.__setitem__(0, query_count[0] + 1))
+
+    results = {}
+    for name, send in route_requests(zukan, random.Random(0), person_ids):
+        for _ in range(WARMUP):
+            send(client)
+
+        latencies, max_queries = [], 0
+        for _ in range(ITERATIONS):
+            query_count[0] = 0
+            started = time.perf_counter()
+            response = send(client)
+            latencies.append(time.perf_counter() - started)
+            max_queries = max(max_queries, query_count[0])
+            if response.status_code != 200:
+                raise RuntimeError(f"{name}: HTTP {response.status_code}")
+
+        tracemalloc.start()
+        for _ in range(MEMORY_ITERATIONS):
+            send(client)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        latencies.sort()
+        results[name] = {
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "queries": max_queries,
+            "peak_kb": round(peak / 1024),
+        }
+    return results
+
+
+def compare(label, current, baseline):
+    """ベースラインより悪化した項目のメッセージ一覧"""
+    problems = []
+    for name, now in current.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        if now["queries"] > before["queries"]:
+            problems.append(f"{label} {name}: queries {before['queries']} -> {now['queries']}")
+        if now["p95_ms"] > before["p95_ms"] * (1 + LATENCY_TOLERANCE):
+            problems.append(f"{label} {name}: p95 {before['p95_ms']}ms -> {now['p95_ms']}ms")
+        if now["peak_kb"] > before["peak_kb"] * (1 + MEMORY_TOLERANCE):
+            problems.append(f"{label} {name}: peak {before['peak_kb']}KB -> {now['peak_kb']}KB")
+    return problems
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    update = "--update-baseline" in sys.argv
+
+    #サイズごとに子プロセスで測る（python route_bench.py --child <size> が JSON を出力する）
+    if sys.argv[1:2] == ["--child"]:
+        print(json.dumps(bench_size(synthetic_zukan.parse_size(sys.argv[2]))))
+        return
+
+    import subprocess
+
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    problems = []
+    for label in args or ["1k"]:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", label],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        current = json.loads(output.strip().splitlines()[-1])
+
+        print(f"== {label}")
+        print(f"{'route':<20}{'p50':>10}{'p95':>10}{'p99':>10}{'queries':>9}{'peak':>10}")
+        for name, r in current.items():
+            print(f"{name:<20}{r['p50_ms']:>8.1f}ms{r['p95_ms']:>8.1f}ms{r['p99_ms']:>8.1f}ms"
+                  f"{r['queries']:>9}{r['peak_kb']:>8}KB")
+
+        if update:
+            baseline[label] = current
+        else:
+            problems += compare(label, current, baseline.get(label, {}))
+
+    if update:
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"baseline updated: {BASELINE_PATH}")
+    elif problems:
+        print("\nREGRESSIONS:")
+        for problem in problems:
+            print("  " + problem)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
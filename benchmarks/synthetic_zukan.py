@@ -0,0 +1,161 @@
+"""
+ベンチマーク用の合成図鑑データを作る。
+
+    python benchmarks/synthetic_zukan.py 10k /tmp/zukan_10k.db
+
+人数は 1k / 10k / 100k（または任意の整数）。同じ seed なら同じデータになる。
+- MBTI・血液型は日本の人口比に近い分布、恋愛タイプはやや偏った分布（一部は未入力）
+- タグは人気に偏りのある（Zipf 風の）付き方で、1 人 0〜4 個
+- 関係は優先的選択（Barabási–Albert）で作るべき乗則のグラフ
+- 座標は乱数で入れておく（力学レイアウトの計算は benchmarks/layout_bench.py で測る）
+"""
+from datetime import date
+import os
+import random
+import sys
+import tempfile
+import time
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+sys.path.insert(0, BACKEND_DIR)
+
+SIZES = {"1k": 1_000, "10k": 10_000, "100k": 100_000}
+BATCH = 5_000
+
+#MBTI の人口比（%）。よく引用される推計値
+MBTI_WEIGHTS = {
+    "ISFJ": 13.8, "ESFJ": 12.0, "ISTJ": 11.6, "ISFP": 8.8, "ESTJ": 8.7, "ESFP": 8.5,
+    "ENFP": 8.1, "ISTP": 5.4, "INFP": 4.4, "ESTP": 4.3, "INTP": 3.3, "ENTP": 3.2,
+    "ENFJ": 2.5, "INTJ": 2.1, "ENTJ": 1.8, "INFJ": 1.5,
+}
+#日本の血液型の比率（%）
+BLOOD_WEIGHTS = {"A": 40, "O": 30, "B": 20, "AB": 10}
+BLANK_RATE = {"mbti": 0.10, "blood_type": 0.05, "love_type": 0.15}
+MAX_TAGS_PER_PERSON = 4
+RELATED_RATE = 0.6        #関係を持つ人の割合
+EDGES_PER_NODE = 2        #BA モデルの m
+KANA = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわ"
+
+
+def parse_size(text):
+    return SIZES.get(text) or int(text)
+
+
+def _weighted(rng, weights, blank_rate):
+    if rng.random() < blank_rate:
+        return ""
+    return rng.choices(list(weights), weights=list(weights.values()))[0]
+
+
+def _reading(rng):
+    return "".join(rng.choice(KANA) for _ in range(rng.randint(2, 6)))
+
+
+def _people_rows(rng, n, love_weights):
+    for i in range(n):
+        reading = _reading(rng)
+        born = date(rng.randint(1970, 2010), rng.randint(1, 12), rng.randint(1, 28))
+        yield {
+            "name": f"{reading}{i}",
+            "reading": reading,
+            "birth": born.isoformat(),
+            "birth_date": born,
+            "birth_md": born.month * 100 + born.day,
+            "blood_type": _weighted(rng, BLOOD_WEIGHTS, BLANK_RATE["blood_type"]),
+            "mbti": _weighted(rng, MBTI_WEIGHTS, BLANK_RATE["mbti"]),
+            "love_type": _weighted(rng, love_weights, BLANK_RATE["love_type"]),
+            "phrase": "",
+        }
+
+
+def _power_law_edges(rng, node_ids):
+    """優先的選択で辺を作る（次数の多い人ほど新しい関係を持ちやすい）"""
+    if len(node_ids) <= EDGES_PER_NODE:
+        return set()
+    edges = set()
+    endpoints = list(node_ids[:EDGES_PER_NODE])   #次数ぶん重複して入る「くじ」
+    for node in node_ids[EDGES_PER_NODE:]:
+        targets = set()
+        while len(targets) < EDGES_PER_NODE:
+            targets.add(rng.choice(endpoints))
+        for target in targets:
+            edges.add(tuple(sorted((node, target))))
+            endpoints.extend((node, target))
+    return edges
+
+
+def _insert(conn, table, rows):
+    rows = list(rows)
+    for start in range(0, len(rows), BATCH):
+        conn.execute(table.insert(), rows[start:start + BATCH])
+
+
+def generate(zukan, engine, size, seed=0):
+    """engine の DB（スキーマ作成済み・空）に size 人ぶんのデータを入れる"""
+    rng = random.Random(seed)
+    love_codes = list(zukan.LOVE_LABELS)
+    love_weights = {code: 1.0 / (i % 4 + 1) for i, code in enumerate(love_codes)}
+    relation_types = [code for code, _ in zukan.RELATION_TYPES]
+
+    with engine.begin() as conn:
+        _insert(conn, zukan.Person.__table__, _people_rows(rng, size, love_weights))
+        person_ids = [row[0] for row in conn.execute(select(zukan.Person.id).order_by(zukan.Person.id))]
+
+        tag_count = min(max(size // 50, 5), 200)
+        _insert(conn, zukan.GroupTag.__table__, [{"name": f"タグ{i}"} for i in range(tag_count)])
+        tag_ids = [row[0] for row in conn.execute(select(zukan.GroupTag.id).order_by(zukan.GroupTag.id))]
+        tag_weights = [1.0 / (rank + 1) for rank in range(len(tag_ids))]
+        tag_rows = []
+        for person_id in person_ids:
+            k = rng.randint(0, MAX_TAGS_PER_PERSON)
+            for tag_id in set(rng.choices(tag_ids, weights=tag_weights, k=k)):
+                tag_rows.append({"person_id": person_id, "tag_id": tag_id})
+        _insert(conn, zukan.PersonTag.__table__, tag_rows)
+
+        related = rng.sample(person_ids, int(len(person_ids) * RELATED_RATE))
+        edges = _power_law_edges(rng, related)
+        _insert(conn, zukan.Relationship.__table__, [
+            {
+                "source_id": source,
+                "target_id": target,
+                "relation_type": rng.choice(relation_types),
+                "strength": rng.randint(1, 5),
+            }
+            for source, target in sorted(edges)
+        ])
+
+        spread = zukan.LAYOUT_NODE_SPACING * (size ** 0.5)
+        _insert(conn, zukan.NodePosition.__table__, [
+            {"person_id": person_id, "x": rng.uniform(-spread, spread), "y": rng.uniform(-spread, spread)}
+            for person_id in person_ids
+        ])
+        conn.execute(zukan.GraphLayoutState.__table__.insert(), {"id": 1, "version": 1, "updated_at": time.time()})
+
+    with Session(engine) as session:
+        zukan.rebuild_stat_counters(session)
+    return {"people": len(person_ids), "tags": len(tag_ids), "person_tags": len(tag_rows), "relations": len(edges)}
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(2)
+    size = parse_size(sys.argv[1])
+    path = sys.argv[2] if len(sys.argv) >= 3 else os.path.join(tempfile.mkdtemp(), f"zukan_{size}.db")
+    if os.path.exists(path):
+        sys.exit(f"{path} already exists")
+    #最初に get_engine() を呼んだときにこの DB へスキーマが作られる
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.abspath(path)
+    os.environ.setdefault("IMAGE_JOB_WORKERS", "0")
+    import app as zukan
+
+    started = time.time()
+    counts = generate(zukan, zukan.get_engine(), size)
+    print(f"{path}: {counts} ({time.time() - started:.1f}s)")
+
+
+if __name__ == "__main__":
+    main()
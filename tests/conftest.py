@@ -0,0 +1,54 @@
+"""
+テスト共通の準備。テストごとに一時ディレクトリの SQLite で create_app し直す
+（画像ジョブのワーカースレッドは起動せず、ジョブは process_image_jobs() で明示的に流す）。
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+sys.path.insert(0, BACKEND_DIR)
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "zukan.db"))
+os.environ["IMAGE_JOB_WORKERS"] = "0"
+os.environ.setdefault("SLOW_REQUEST_SECONDS", "3600")
+
+import app as zukan  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.setattr(zukan.image_storage, "folder", str(tmp_path / "uploads"), raising=False)
+    flask_app = zukan.create_app({"DATABASE_URL": f"sqlite:///{tmp_path / 'zukan.db'}", "TESTING": True})
+    yield flask_app
+    zukan.dispose_engine()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def session(app):
+    db = zukan.Session()
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def make_person(session):
+    """Person を 1 人登録して返す（統計カウンターも登録ルートと同じように増やす）"""
+
+    def make(**fields):
+        fields.setdefault("name", f"person{session.query(zukan.Person).count() + 1}")
+        person = zukan.Person(**fields)
+        session.add(person)
+        session.flush()
+        zukan.bump_stat_counters(session, new=zukan.stat_values(person))
+        zukan.record_changes(session, "person", [person.id])
+        session.commit()
+        return person
+
+    return make
@@ -0,0 +1,26 @@
+import app as zukan
+
+
+def test_create_app_switches_database_and_resets_indexes(tmp_path, client, make_person):
+    make_person(name="さくら", reading="さくら")
+    assert [r["name"] for r in client.get("/api/search?q=さく").get_json()] == ["さくら"]
+    zukan.facet_index.ensure_fresh()
+    assert zukan.facet_index.search({})[0] == 1
+
+    other = zukan.create_app({"DATABASE_URL": f"sqlite:///{tmp_path / 'other.db'}"})
+    other_client = other.test_client()
+
+    assert other_client.get("/api/search?q=さく").get_json() == []
+    zukan.facet_index.ensure_fresh()
+    assert zukan.facet_index.search({})[0] == 0
+    assert other_client.get("/api/people").get_json()["people"] == []
+
+
+def test_create_app_normalizes_postgres_scheme(app):
+    url = app.config["DATABASE_URL"]
+    try:
+        zukan.app.config["AUTO_MIGRATE"] = False
+        zukan.create_app({"DATABASE_URL": "postgres://user@localhost/zukan"})
+        assert zukan.app.config["DATABASE_URL"] == "postgresql://user@localhost/zukan"
+    finally:
+        zukan.create_app({"DATABASE_URL": url, "AUTO_MIGRATE": True})
@@ -0,0 +1,66 @@
+from datetime import date
+
+import pytest
+
+import app as zukan
+
+
+def upcoming(client, start, days):
+    body = client.get(f"/api/birthdays/upcoming?from={start}&days={days}").get_json()
+    return [(p["name"], p["birthday"], p["days_until"], p["age"]) for p in body["people"]]
+
+
+@pytest.fixture
+def leaplings(make_person):
+    make_person(name="うるう", birth="2000-02-29")
+    make_person(name="年なし", birth="2/29")
+    make_person(name="三月", birth="1990-03-01")
+
+
+def test_parse_feb_29():
+    assert zukan.parse_birth("2000/2/29") == ("2000-02-29", date(2000, 2, 29), 229)
+    assert zukan.parse_birth("2月29日") == ("02-29", None, 229)
+    #平年の 2/29 は日付にせず、入力をそのまま残す
+    assert zukan.parse_birth("2001-02-29") == ("2001-02-29", None, None)
+
+
+def test_parse_birth_rejects_year_zero():
+    assert zukan.parse_birth("0000-04-01") == ("0000-04-01", None, None)
+    assert zukan.parse_birth("00000229") == ("00000229", None, None)
+
+
+def test_feb_29_is_celebrated_on_mar_1_in_common_years(client, leaplings):
+    assert upcoming(client, "2025-02-28", 0) == []
+    assert upcoming(client, "2025-03-01", 0) == [
+        ("うるう", "2025-03-01", 0, 25),
+        ("年なし", "2025-03-01", 0, None),
+        ("三月", "2025-03-01", 0, 35),
+    ]
+
+
+def test_feb_29_in_leap_years(client, leaplings):
+    assert [p[:2] for p in upcoming(client, "2024-02-29", 0)] == [
+        ("うるう", "2024-02-29"), ("年なし", "2024-02-29"),
+    ]
+    #うるう年の 3/1 には、もう 2/29 は過ぎている
+    assert [p[0] for p in upcoming(client, "2024-03-01", 0)] == ["三月"]
+
+
+def test_feb_29_across_year_end(client, leaplings):
+    people = upcoming(client, "2025-12-31", 60)
+    assert [p[:3] for p in people] == [
+        ("うるう", "2026-03-01", 60), ("年なし", "2026-03-01", 60), ("三月", "2026-03-01", 60),
+    ]
+    assert [p[:2] for p in upcoming(client, "2027-12-31", 60)][:2] == [
+        ("うるう", "2028-02-29"), ("年なし", "2028-02-29"),
+    ]
+
+
+def test_birthday_sort_puts_feb_29_between_feb_28_and_mar_1(client, make_person):
+    make_person(name="三月", birth="1990-03-01")
+    make_person(name="不明", birth="そのうち")
+    make_person(name="うるう", birth="2000-02-29")
+    make_person(name="二月", birth="1995-02-28")
+
+    names = [p["name"] for p in client.get("/api/people?sort=birthday").get_json()["people"]]
+    assert names == ["二月", "うるう", "三月", "不明"]
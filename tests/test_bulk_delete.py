@@ -0,0 +1,77 @@
+import json
+
+from sqlalchemy import event
+
+import app as zukan
+
+
+def test_bulk_delete_cascades_in_one_statement(client, session, make_person):
+    shared, own = "/static/uploads/shared.webp", "/static/uploads/own.webp"
+    a = make_person(mbti="INTJ", image_path=shared)
+    b = make_person(mbti="INTJ", image_path=own)
+    c = make_person(mbti="ENFP", image_path=shared)
+    ids = {"a": a.id, "b": b.id, "c": c.id}
+    tag = zukan.GroupTag(name="友達")
+    session.add(tag)
+    session.flush()
+    session.add_all([zukan.PersonTag(person_id=i, tag_id=tag.id) for i in ids.values()])
+    session.add_all([
+        zukan.Relationship(source_id=ids["a"], target_id=ids["b"], relation_type="friend", strength=3),
+        zukan.Relationship(source_id=ids["b"], target_id=ids["c"], relation_type="friend", strength=3),
+    ])
+    session.add_all([zukan.NodePosition(person_id=i, x=0.0, y=0.0) for i in ids.values()])
+    session.commit()
+    zukan.load_stat_counts(session)
+
+    deletes = []
+    engine = zukan.get_engine()
+
+    def record(conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith("DELETE"):
+            deletes.append(statement.split()[2])
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        response = client.delete("/api/people/bulk", json={"ids": [ids["a"], ids["b"], 999]})
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+    assert response.get_json() == {"deleted": [ids["a"], ids["b"]], "missing": [999]}
+    #タグ・関係・座標は ON DELETE CASCADE に任せ、DELETE は people への 1 回だけ
+    assert deletes == ["people"]
+
+    session.expire_all()
+    assert [p.id for p in session.query(zukan.Person)] == [ids["c"]]
+    assert [t.person_id for t in session.query(zukan.PersonTag)] == [ids["c"]]
+    assert session.query(zukan.Relationship).count() == 0
+    assert [n.person_id for n in session.query(zukan.NodePosition)] == [ids["c"]]
+    assert zukan.load_stat_counts(session)["mbti"] == {"ENFP": 1}
+
+    #まだ使われている画像は残し、使われなくなった画像だけ削除ジョブに積む
+    jobs = session.query(zukan.ImageJob).all()
+    assert [json.loads(j.payload) for j in jobs if j.kind == zukan.JOB_DELETE] == [{"urls": [own]}]
+    #消えた人の隣人だけレイアウトを緩和し直す
+    assert [json.loads(j.payload) for j in jobs if j.kind == zukan.JOB_LAYOUT] == [{"dirty": [ids["c"]]}]
+
+    changes = session.query(zukan.ChangeLogEntry).filter_by(op=zukan.CHANGE_DELETE).all()
+    assert sorted((c.entity, c.entity_id) for c in changes if c.entity == "person") == [
+        ("person", ids["a"]), ("person", ids["b"]),
+    ]
+    assert len([c for c in changes if c.entity == "relation"]) == 2
+
+
+def test_bulk_delete_rejects_bad_input(client):
+    assert client.delete("/api/people/bulk", json={}).status_code == 400
+    assert client.delete("/api/people/bulk", json={"ids": ["x"]}).status_code == 400
+    assert client.delete("/api/people/bulk", json={"ids": list(range(zukan.BULK_UPSERT_MAX + 1))}).status_code == 400
+
+
+def test_bulk_delete_wakes_workers_once(client, make_person, monkeypatch):
+    wakeups = []
+    monkeypatch.setattr(zukan, "notify_image_workers", lambda: wakeups.append(1))
+    person = make_person()
+
+    client.delete("/api/people/bulk", json={"ids": [999]})
+    assert wakeups == []
+    client.delete("/api/people/bulk", json={"ids": [person.id]})
+    assert wakeups == [1]
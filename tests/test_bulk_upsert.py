@@ -0,0 +1,27 @@
+import pytest
+
+import app as zukan
+
+
+def test_bulk_upsert_creates_and_updates(client, session, make_person):
+    existing = make_person(name="さくら", mbti="INTJ")
+    body = client.post("/api/people/bulk", json={"people": [
+        {"id": existing.id, "mbti": "ENFP", "tags": ["友達"]},
+        {"name": "もみじ", "tags": ["友達", "同僚"]},
+    ]}).get_json()
+
+    assert body["updated"] == [existing.id] and len(body["created"]) == 1
+    session.expire_all()
+    assert session.get(zukan.Person, existing.id).mbti == "ENFP"
+    tags = {
+        (t.person_id, session.get(zukan.GroupTag, t.tag_id).name) for t in session.query(zukan.PersonTag)
+    }
+    assert tags == {(existing.id, "友達"), (body["created"][0], "友達"), (body["created"][0], "同僚")}
+
+
+@pytest.mark.parametrize("tags", [None, "友達", [""], ["  "], [None], [1]])
+def test_bulk_upsert_rejects_bad_tags(client, session, tags):
+    response = client.post("/api/people/bulk", json={"people": [{"name": "さくら", "tags": tags}]})
+    assert response.status_code == 400
+    assert session.query(zukan.Person).count() == 0
+    assert session.query(zukan.GroupTag).count() == 0
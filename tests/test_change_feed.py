@@ -0,0 +1,44 @@
+import re
+import threading
+
+import app as zukan
+
+
+def test_poll_changes(client, make_person):
+    since = client.get("/api/relations").get_json()["change_seq"]
+    person = make_person(name="さくら")
+
+    delta = client.get(f"/api/changes?since={since}").get_json()
+    assert [p["id"] for p in delta["people"]] == [person.id]
+    assert not delta["reset"] and not delta["has_more"]
+    assert client.get(f"/api/changes?since={delta['last_seq']}").get_json()["people"] == []
+    assert client.get("/api/changes").status_code == 400
+
+
+def test_change_stream_is_opt_in_and_bounded(client, monkeypatch):
+    assert client.get("/api/changes/stream?since=0").status_code == 404
+
+    monkeypatch.setattr(zukan, "CHANGE_STREAM_ENABLED", 1)
+    monkeypatch.setattr(zukan, "_change_stream_slots", threading.BoundedSemaphore(1))
+    first = client.get("/api/changes/stream?since=0", buffered=False)
+    assert first.status_code == 200
+    busy = client.get("/api/changes/stream?since=0", buffered=False)
+    assert busy.status_code == 503 and busy.headers["Retry-After"]
+
+    #切断したら枠が空く
+    first.close()
+    second = client.get("/api/changes/stream?since=0", buffered=False)
+    assert second.status_code == 200
+    second.close()
+
+
+def test_index_page_carries_change_seq_for_polling(client, make_person):
+    make_person(name="さくら")
+    html = client.get("/").get_data(as_text=True)
+    since = int(re.search(r'data-change-seq="(\d+)"', html).group(1))
+    assert client.get(f"/api/changes?since={since}").get_json()["people"] == []
+
+    person = make_person(name="もみじ")
+    delta = client.get(f"/api/changes?since={since}").get_json()
+    assert [p["id"] for p in delta["people"]] == [person.id]
+    assert "card" in delta["people"][0]["images"]
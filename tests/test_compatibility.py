@@ -0,0 +1,54 @@
+import itertools
+import random
+
+import app as zukan
+
+
+def test_matrix_matches_pair_scores(client, make_person):
+    rng = random.Random(0)
+    people = [
+        make_person(
+            mbti=rng.choice(list(zukan.MBTI_LABELS) + ["", None]),
+            blood_type=rng.choice(list(zukan.BLOOD_RANKINGS) + ["", None]),
+            love_type=rng.choice(list(zukan.LOVE_LABELS) + ["", None]),
+        )
+        for _ in range(40)
+    ]
+    ids = [p.id for p in people]
+
+    matrix = client.post("/compatibility_matrix", json={"ids": ids}).get_json()
+    assert [p["id"] for p in matrix["people"]] == ids
+
+    for (i, a), (j, b) in itertools.product(enumerate(people), repeat=2):
+        pair = zukan.calculate_compatibility(a, b)
+        assert matrix["mbti_scores"][i][j] == pair["mbti_score"]
+        assert matrix["blood_scores"][i][j] == pair["blood_score"]
+        assert matrix["love_scores"][i][j] == pair["love_score"]
+        assert matrix["total_scores"][i][j] == pair["total_score"]
+
+
+def test_matrix_by_tag_and_invalid_tag(client, session, make_person):
+    a, b, c = make_person(mbti="INTJ"), make_person(mbti="ENFP"), make_person(mbti="ISTJ")
+    tag = zukan.GroupTag(name="友達")
+    session.add(tag)
+    session.flush()
+    session.add_all([zukan.PersonTag(person_id=a.id, tag_id=tag.id), zukan.PersonTag(person_id=c.id, tag_id=tag.id)])
+    session.commit()
+
+    matrix = client.post("/compatibility_matrix", json={"tag_id": str(tag.id)}).get_json()
+    assert [p["id"] for p in matrix["people"]] == [a.id, c.id]
+
+    assert client.post("/compatibility_matrix", json={"tag_id": "abc"}).status_code == 400
+    assert client.post("/compatibility_matrix", json={"ids": ["x"]}).status_code == 400
+    assert client.post("/compatibility_matrix", json={}).status_code == 400
+
+
+def test_pair_accepts_string_ids(client, make_person):
+    a, b = make_person(name="A", mbti="INTJ", love_type="LCRO"), make_person(name="B", mbti="ENFP", love_type="FARE")
+
+    result = client.post("/compatibility_api", json={"id1": str(a.id), "id2": b.id}).get_json()
+    assert (result["p1"], result["p2"]) == ("A", "B")
+    assert result["love_score"] == zukan.LOVE_SCORE_MATRIX[zukan.love_index("LCRO")][zukan.love_index("FARE")]
+
+    assert client.post("/compatibility_api", json={"id1": "x", "id2": b.id}).status_code == 400
+    assert "error" in client.post("/compatibility_api", json={"id1": a.id, "id2": 9999}).get_json()
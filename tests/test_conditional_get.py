@@ -0,0 +1,42 @@
+import app as zukan
+
+
+def test_etag_round_trip(client, make_person):
+    person = make_person(name="さくら")
+
+    first = client.get("/api/people")
+    assert first.status_code == 200 and first.headers["ETag"]
+    assert first.headers["Cache-Control"] == "no-cache"
+
+    again = client.get("/api/people", headers={"If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304 and again.get_data() == b""
+
+    #書き込みで版数が上がれば取り直しになる
+    client.post(f"/delete/{person.id}")
+    changed = client.get("/api/people", headers={"If-None-Match": first.headers["ETag"]})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != first.headers["ETag"]
+    assert changed.get_json()["people"] == []
+
+
+def test_etag_depends_on_query(client, make_person):
+    make_person()
+    etag = client.get("/api/people?limit=1").headers["ETag"]
+    assert client.get("/api/people?limit=2", headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_bump_data_versions_upserts(session):
+    zukan.bump_data_versions(session, "people", "person:1")
+    session.commit()
+    #別セッションが「まだ行がない」状態から同じ scope を上げても主キーがぶつからない
+    other = zukan.Session()
+    try:
+        zukan.bump_data_versions(other, "people", "person:1", "person:2")
+        other.commit()
+    finally:
+        other.close()
+
+    versions = zukan.read_data_versions(["global", "people", "person:1", "person:2", "person:3"])
+    assert {scope: v for scope, (v, _) in versions.items()} == {
+        "global": 2, "people": 2, "person:1": 2, "person:2": 1, "person:3": 0,
+    }
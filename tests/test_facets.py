@@ -0,0 +1,98 @@
+import random
+
+import pytest
+
+import app as zukan
+
+MBTI = ["INTJ", "ENFP", "ISFJ"]
+BLOOD = ["A", "B", "O", ""]
+LOVE = ["LCRO", "FARE", None]
+
+
+@pytest.fixture
+def people(session, make_person):
+    rng = random.Random(7)
+    tags = [zukan.GroupTag(name=f"タグ{i}") for i in range(3)]
+    session.add_all(tags)
+    session.commit()
+    tag_ids = [t.id for t in tags]
+
+    people = []
+    for _ in range(40):
+        person = make_person(mbti=rng.choice(MBTI), blood_type=rng.choice(BLOOD), love_type=rng.choice(LOVE))
+        person_tags = set(rng.sample(tag_ids, rng.randint(0, 2)))
+        session.add_all([zukan.PersonTag(person_id=person.id, tag_id=t) for t in person_tags])
+        zukan.record_changes(session, "person", [person.id])
+        session.commit()
+        people.append({
+            "id": person.id, "mbti": person.mbti, "blood_type": person.blood_type,
+            "love_type": person.love_type, "tags": person_tags,
+        })
+    return people, tag_ids
+
+
+def expected_facets(people, selected, tags, tag_mode):
+    def matches(p, skip=None):
+        for field in zukan.FACET_FIELDS:
+            if field != skip and selected.get(field) and p[field] not in selected[field]:
+                return False
+        if tags and skip != "tags":
+            hit = set(tags) <= p["tags"] if tag_mode == "all" else bool(set(tags) & p["tags"])
+            if not hit:
+                return False
+        return True
+
+    counts = {field: {} for field in (*zukan.FACET_FIELDS, "tags")}
+    for field in zukan.FACET_FIELDS:
+        for p in people:
+            if p[field] and matches(p, field):
+                counts[field][p[field]] = counts[field].get(p[field], 0) + 1
+    return sorted(p["id"] for p in people if matches(p)), counts
+
+
+@pytest.mark.parametrize("selected, tag_mode", [
+    ({}, "any"),
+    ({"mbti": ["INTJ"]}, "any"),
+    ({"mbti": ["INTJ", "ENFP"], "blood_type": ["A"]}, "any"),
+    ({"love_type": ["LCRO"]}, "all"),
+])
+def test_facet_counts_match_brute_force(client, people, selected, tag_mode):
+    people, tag_ids = people
+    tags = tag_ids[:2]
+    body = client.post("/api/facets", json={**selected, "tags": tags, "tag_mode": tag_mode}).get_json()
+
+    ids, counts = expected_facets(people, selected, tags, tag_mode)
+    assert body["total"] == len(ids)
+    assert body["ids"] == ids[:100]
+    for field in zukan.FACET_FIELDS:
+        assert {k: v for k, v in body["counts"][field].items() if v} == counts[field]
+
+    #タグの件数: any はタグ以外の条件で、all は選んだタグも含めて絞った人のうち、そのタグを持つ人数
+    base_tags = tags if tag_mode == "all" else []
+    base = [p for p in people if expected_facets([p], selected, base_tags, "all")[0]]
+    for tag_id in tag_ids:
+        assert body["counts"]["tags"][str(tag_id)] == sum(tag_id in p["tags"] for p in base)
+
+
+def test_facets_follow_writes(client, session, people):
+    people, _ = people
+    before = client.post("/api/facets", json={"mbti": ["INTJ"]}).get_json()["total"]
+
+    #別ワーカーの編集・削除も change_log から反映される
+    target = next(p for p in people if p["mbti"] != "INTJ")
+    session.get(zukan.Person, target["id"]).mbti = "INTJ"
+    zukan.record_changes(session, "person", [target["id"]])
+    gone = next(p for p in people if p["mbti"] == "INTJ")
+    session.delete(session.get(zukan.Person, gone["id"]))
+    zukan.record_changes(session, "person", [gone["id"]], zukan.CHANGE_DELETE)
+    session.commit()
+
+    body = client.post("/api/facets", json={"mbti": ["INTJ"], "limit": 1000}).get_json()
+    assert body["total"] == before
+    assert target["id"] in body["ids"] and gone["id"] not in body["ids"]
+
+
+def test_facets_reject_bad_input(client):
+    assert client.post("/api/facets", json={"tags": ["x"]}).status_code == 400
+    assert client.post("/api/facets", json={"tag_mode": "some"}).status_code == 400
+    assert client.post("/api/facets", json={"limit": 10**6}).status_code == 400
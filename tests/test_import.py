@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+import app as zukan
+
+
+def run_import(client, lines, query="format=jsonl"):
+    body = "\n".join(line if isinstance(line, str) else json.dumps(line, ensure_ascii=False) for line in lines)
+    response = client.post(f"/api/import?{query}", data=body.encode("utf-8"))
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_import_reports_bad_lines(client, session):
+    progress = run_import(client, [
+        {"type": "person", "id": 1, "name": "さくら", "tags": ["友達"]},
+        "{broken",
+        {"type": "person", "name": " "},
+        {"type": "person", "id": 2, "name": "もみじ"},
+        {"type": "relation", "source": 1, "target": 2, "relation_type": "friend", "strength": 3},
+        {"type": "relation", "source": 1, "target": 1, "relation_type": "friend", "strength": 3},
+        {"type": "relation", "source": 1, "target": 999, "relation_type": "friend", "strength": 3},
+        {"type": "relation", "source": 1, "target": 2, "relation_type": "friend", "strength": "x"},
+    ])
+
+    done = progress[-1]
+    assert done["done"] and done["people"] == 2 and done["relations"] == 1 and done["tags"] == 1
+    assert done["error_count"] == 5
+    errors = {e["line"]: e["error"] for p in progress[:-1] for e in p.get("errors", [])}
+    assert errors == {
+        2: "invalid record",
+        3: "invalid record",
+        6: "self relation",
+        7: "unknown person",
+        8: "invalid relation",
+    }
+
+    names = {p.id: p.name for p in session.query(zukan.Person)}
+    assert sorted(names.values()) == ["さくら", "もみじ"]
+    relation = session.query(zukan.Relationship).one()
+    assert {names[relation.source_id], names[relation.target_id]} == {"さくら", "もみじ"}
+
+
+def test_failed_batch_is_reported_and_rolled_back(client, session, monkeypatch):
+    def broken(*args, **kwargs):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(zukan, "bump_stat_counters_many", broken)
+    progress = run_import(client, [{"type": "person", "name": "さくら"}, {"type": "person", "name": "もみじ"}])
+    assert progress[0]["errors"] == [{"line": 1, "error": "batch 1-2 failed: RuntimeError"}]
+    assert progress[-1]["people"] == 0
+    assert session.query(zukan.Person).count() == 0
+
+
+def test_csv_import_and_export_round_trip(client, session):
+    csv_body = "name,reading,mbti,tags\nさくら,さくら,INTJ,友達|同僚\nもみじ,,ENFP,\n"
+    response = client.post("/api/import?format=csv&kind=people", data=csv_body.encode("utf-8"))
+    assert json.loads(response.get_data(as_text=True).splitlines()[-1])["people"] == 2
+
+    exported = client.get("/api/export?format=jsonl&kind=people").get_data(as_text=True).splitlines()
+    people = {r["name"]: r for r in map(json.loads, exported)}
+    assert people["さくら"]["mbti"] == "INTJ"
+    assert set(people["さくら"]["tags"]) == {"友達", "同僚"}
+
+
+def test_import_counts_stats_without_orm_objects(client, session, monkeypatch):
+    monkeypatch.setattr(zukan, "stat_values", lambda person: pytest.fail("ORM object built for stats"))
+    run_import(client, [
+        {"type": "person", "name": "さくら", "mbti": "INTJ", "blood_type": "A"},
+        {"type": "person", "name": "もみじ", "mbti": "INTJ", "love_type": "LCRO"},
+    ])
+    counts = zukan.load_stat_counts(session)
+    assert counts["mbti"] == {"INTJ": 2}
+    assert counts["blood"] == {"A": 1}
+    assert counts["love"] == {"LCRO": 1}
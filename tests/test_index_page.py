@@ -0,0 +1,42 @@
+import app as zukan
+
+
+def test_cards_fall_back_to_placeholder_until_image_is_ready(client, make_person):
+    url = "/static/uploads/a.webp"
+    pending = make_person(image_path=url, image_status=zukan.IMAGE_STATUS_PENDING)
+    make_person(image_path=url, image_status=zukan.IMAGE_STATUS_READY)
+
+    html = client.get("/").get_data(as_text=True)
+    assert 'src="None"' not in html
+    assert html.count("No Image") == 1
+    assert html.count('class="person-img"') == 1
+
+    people = client.get("/api/people").get_json()["people"]
+    assert next(p for p in people if p["id"] == pending.id)["images"]["card"] is None
+
+
+def test_graph_and_compatibility_hide_images_until_ready(client, session, make_person):
+    url = "/static/uploads/a.webp"
+    node_url = zukan.image_variants(url)["node"]
+    ready = make_person(name="済", mbti="INTJ", image_path=url, image_status=zukan.IMAGE_STATUS_READY)
+    pending = make_person(name="中", mbti="INTJ", image_path=url, image_status=zukan.IMAGE_STATUS_PENDING)
+    failed = make_person(name="失", mbti="INTJ", image_path=url, image_status=zukan.IMAGE_STATUS_FAILED)
+    session.add_all([
+        zukan.Relationship(source_id=ready.id, target_id=pending.id, relation_type="friend", strength=3),
+        zukan.Relationship(source_id=ready.id, target_id=failed.id, relation_type="friend", strength=3),
+    ])
+    session.commit()
+    expected = {ready.id: node_url, pending.id: None, failed.id: None}
+
+    def images(people):
+        return {p["id"]: p["image"] for p in people}
+
+    assert images(client.get("/api/relations").get_json()["people"]) == expected
+    assert images(client.get(f"/api/relations/ego/{ready.id}").get_json()["people"]) == expected
+    top = client.get(f"/compatibility/top?person_id={ready.id}").get_json()["results"]
+    assert images(top) == {pending.id: None, failed.id: None}
+    pair = client.post("/compatibility_api", json={"id1": ready.id, "id2": pending.id}).get_json()
+    assert (pair["p1_image"], pair["p2_image"]) == (node_url, None)
+
+    edit = client.get(f"/edit/{pending.id}").get_data(as_text=True)
+    assert url not in edit and "保存処理中" in edit
@@ -0,0 +1,47 @@
+import json
+
+import app as zukan
+
+
+def layout_jobs(session):
+    session.expire_all()
+    return session.query(zukan.ImageJob).filter_by(kind=zukan.JOB_LAYOUT).all()
+
+
+def test_relations_get_does_not_compute_layout(client, session, make_person):
+    a, b = make_person(), make_person()
+
+    body = client.get("/api/relations").get_json()
+    assert {(p["x"], p["y"]) for p in body["people"]} == {(None, None)}
+    assert session.get(zukan.GraphLayoutState, 1) is None
+    assert session.query(zukan.NodePosition).count() == 0
+    assert client.get(f"/api/relations/ego/{a.id}").get_json()["layout_version"] == 0
+
+
+def test_relation_writes_queue_one_layout_job(client, session, make_person):
+    a, b, c = make_person(), make_person(), make_person()
+    for source, target in [(a, b), (b, c)]:
+        client.post("/relations/add", data={
+            "source_id": source.id, "target_id": target.id, "relation_type": "friend", "strength": 3,
+        })
+
+    #リクエストの中では計算せず、まだ始まっていないジョブに dirty をまとめる
+    assert session.query(zukan.NodePosition).count() == 0
+    jobs = layout_jobs(session)
+    assert len(jobs) == 1
+    assert json.loads(jobs[0].payload) == {"dirty": [a.id, b.id, c.id]}
+
+    zukan.process_image_jobs()
+    body = client.get("/api/relations").get_json()
+    assert body["layout_version"] == 1
+    assert all(p["x"] is not None for p in body["people"])
+
+    #取り消しは両端だけを緩和し直すジョブになり、済んだジョブの行は次の実行で片付く
+    relation_id = body["relations"][0]["id"]
+    client.post(f"/relations/delete/{relation_id}")
+    assert [json.loads(j.payload) for j in layout_jobs(session) if j.status == zukan.JOB_PENDING] == [
+        {"dirty": [a.id, b.id]}
+    ]
+    zukan.process_image_jobs()
+    assert [j.status for j in layout_jobs(session)] == [zukan.JOB_DONE]
+    assert client.get("/api/relations").get_json()["layout_version"] == 2
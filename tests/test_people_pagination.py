@@ -0,0 +1,58 @@
+import random
+
+import pytest
+
+import app as zukan
+
+
+def fetch_all(client, sort, limit):
+    """next_cursor を辿って全ページの id を集める"""
+    ids, cursor = [], None
+    while True:
+        url = f"/api/people?sort={sort}&limit={limit}" + (f"&cursor={cursor}" if cursor else "")
+        body = client.get(url).get_json()
+        assert len(body["people"]) <= limit
+        ids += [p["id"] for p in body["people"]]
+        cursor = body["next_cursor"]
+        if not cursor:
+            return ids
+
+
+@pytest.fixture
+def people(make_person):
+    rng = random.Random(3)
+    births = [None, "1990-01-01", "1985-04-01", "4/1", "2000-02-29", "1990-01-01"]
+    readings = [None, "", "あいだ", "かとう", "さとう", "あいだ"]
+    return [
+        make_person(reading=rng.choice(readings), birth=rng.choice(births))
+        for _ in range(37)
+    ]
+
+
+@pytest.mark.parametrize("sort", ["id", "reading", "name", "birth", "age", "birthday"])
+def test_cursor_pages_match_full_sort(client, people, sort):
+    def key(p):
+        if sort == "reading":
+            return (p.reading or "", p.id)
+        if sort == "name":
+            return (p.name or "", p.id)
+        if sort == "birth":
+            return (p.birth_date or zukan.date.max, p.id)
+        if sort == "birthday":
+            return (p.birth_md or 9999, p.id)
+        return (p.id,)
+
+    if sort == "age":
+        #生年月日の新しい順（同じなら id の大きい順）、不明は最後
+        expected = sorted(people, key=lambda p: (p.birth_date or zukan.date.min, p.id), reverse=True)
+    else:
+        expected = sorted(people, key=key)
+
+    assert fetch_all(client, sort, 5) == [p.id for p in expected]
+
+
+def test_invalid_cursor_is_rejected(client, people):
+    assert client.get("/api/people?cursor=not-a-cursor").status_code == 400
+    cursor = zukan.encode_cursor("not-a-date", 1)
+    assert client.get(f"/api/people?sort=birth&cursor={cursor}").status_code == 400
+    assert client.get("/api/people?sort=unknown").status_code == 400
@@ -0,0 +1,51 @@
+import pytest
+from sqlalchemy import text
+
+import app as zukan
+
+#ホットなクエリ → 実行計画に出てくるはずのインデックス
+EXPECTED_INDEXES = {
+    "filter: mbti + tags (EXISTS)": ["ix_people_types", "uq_person_tags_person_tag"],
+    "filter: blood_type": ["ix_people_blood_type"],
+    "stats_members: love_type": ["ix_people_love_type"],
+    "stats_members: tag": ["ix_person_tags_tag_person"],
+    "relations: edges of a person": ["uq_relationships_pair", "ix_relationships_target"],
+    "add_relation: pair lookup": ["uq_relationships_pair"],
+    "edit: tag lookup": ["uq_person_tags_person_tag"],
+    "images: referenced image_path": ["ix_people_image_path"],
+    "people page: sort=reading": ["ix_people_sort_reading"],
+    "people page: sort=name": ["ix_people_sort_name"],
+    "people page: sort=birth": ["ix_people_sort_birth"],
+    "people page: sort=age": ["ix_people_sort_age"],
+    "people page: sort=birthday": ["ix_people_sort_birthday"],
+}
+
+
+@pytest.fixture
+def plans(app):
+    return {name: (ok, plan) for name, ok, plan in zukan.check_query_plans()}
+
+
+def test_every_hot_query_is_covered(plans):
+    assert set(plans) == set(EXPECTED_INDEXES)
+
+
+@pytest.mark.parametrize("name", sorted(EXPECTED_INDEXES))
+def test_hot_query_uses_index(plans, name):
+    ok, plan = plans[name]
+    assert ok, plan
+    for index_name in EXPECTED_INDEXES[name]:
+        assert index_name in plan, plan
+    assert "TEMP B-TREE" not in plan, plan
+
+
+def test_migration_recreates_missing_index(app):
+    engine = zukan.get_engine()
+    with engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_people_sort_reading"))
+        conn.execute(text("DELETE FROM schema_migrations WHERE version = 6"))
+
+    assert zukan.run_migrations(engine) == [6]
+    ok, plan = {name: (ok, plan) for name, ok, plan in zukan.check_query_plans()}["people page: sort=reading"]
+    assert ok and "ix_people_sort_reading" in plan, plan
+    assert zukan.run_migrations(engine) == []
@@ -0,0 +1,70 @@
+import random
+
+import pytest
+
+import app as zukan
+
+
+@pytest.fixture
+def index(app):
+    index = zukan.SearchIndex()
+    index.ensure_fresh()
+    return index
+
+
+def test_short_queries_match_substrings(session, make_person, index):
+    rng = random.Random(5)
+    chars = "あいうえおかきくけこアイウ"
+    people = [
+        make_person(name="".join(rng.choice(chars) for _ in range(rng.randint(1, 5))), reading="")
+        for _ in range(60)
+    ]
+    index.ensure_fresh()
+
+    for query in ["あ", "い", "かき", "ウ", "あい", "ん"]:
+        key = zukan.normalize_kana(query)
+        expected = {p.id for p in people if key in zukan.normalize_kana(p.name)}
+        assert index.match_ids(query) == expected
+        found = index.search(query, limit=len(people))
+        assert {row[0] for row in found} == expected
+
+
+def test_other_writers_are_applied_from_change_log(session, make_person, index, monkeypatch):
+    kept = make_person(name="さくら", reading="さくら")
+    gone_id = make_person(name="もみじ", reading="もみじ").id
+    index.ensure_fresh()
+    assert index.match_ids("さく") == {kept.id}
+
+    #ここからは差分だけで追いつくこと（作り直さない）
+    monkeypatch.setattr(index, "rebuild", lambda *args, **kwargs: pytest.fail("rebuilt"))
+    #別ワーカーの書き込み（このプロセスの upsert / remove は呼ばれない）
+    kept.name = kept.reading = "つばき"
+    zukan.record_changes(session, "person", [kept.id])
+    session.delete(session.get(zukan.Person, gone_id))
+    zukan.record_changes(session, "person", [gone_id], zukan.CHANGE_DELETE)
+    session.commit()
+    added = make_person(name="さくらこ", reading="")
+
+    index.ensure_fresh()
+    assert index.match_ids("つば") == {kept.id}
+    assert index.match_ids("さく") == {added.id}
+    assert index.match_ids("もみじ") == set()
+    assert [row[0] for row in index.search("さくら")] == [added.id]
+
+
+def test_typeahead_checks_change_log_at_most_once_per_interval(client, session, make_person, monkeypatch):
+    make_person(name="さくら", reading="さくら")
+    assert [r["name"] for r in client.get("/api/search?q=さく").get_json()] == ["さくら"]
+
+    refreshes = []
+    refresh = zukan.search_index._refresh
+    monkeypatch.setattr(zukan.search_index, "_refresh", lambda: refreshes.append(1) or refresh())
+    #別ワーカーの書き込みは間隔が過ぎるまで見えない
+    make_person(name="さくらこ", reading="")
+    for _ in range(5):
+        assert len(client.get("/api/search?q=さく").get_json()) == 1
+    assert refreshes == []
+
+    monkeypatch.setattr(zukan, "SEARCH_FRESH_MS", 0)
+    assert len(client.get("/api/search?q=さく").get_json()) == 2
+    assert refreshes == [1]
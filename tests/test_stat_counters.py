@@ -0,0 +1,67 @@
+import warnings
+
+from sqlalchemy import delete
+from sqlalchemy.exc import SAWarning
+
+import app as zukan
+
+
+def test_rebuild_matches_group_by(session, make_person):
+    for mbti, blood in [("INTJ", "A"), ("INTJ", "O"), ("ENFP", ""), (None, "A")]:
+        make_person(mbti=mbti, blood_type=blood)
+    session.execute(delete(zukan.StatCounter))
+    session.commit()
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", SAWarning)
+        counts = zukan.load_stat_counts(session)
+        #読み込んだあとに作り直しても、同じセッションで古いインスタンスとぶつからない
+        zukan.rebuild_stat_counters(session)
+        assert zukan.load_stat_counts(session) == counts
+
+    assert counts["mbti"] == {"INTJ": 2, "ENFP": 1}
+    assert counts["blood"] == {"A": 2, "O": 1}
+
+
+def test_first_rebuild_race_and_new_values(app, make_person):
+    make_person(mbti="INTJ")
+    first, second = zukan.Session(), zukan.Session()
+    try:
+        first.execute(delete(zukan.StatCounter))
+        first.commit()
+        #2 つのワーカーが同時に「未初期化」を見て作り直しに来ても、後の方は何もしない
+        zukan.rebuild_stat_counters(first, only_if_missing=True)
+        zukan.bump_stat_counters(first, new={"mbti": "INTJ"})
+        first.commit()
+        zukan.rebuild_stat_counters(second, only_if_missing=True)
+        assert zukan.load_stat_counts(second)["mbti"] == {"INTJ": 2}
+
+        #まだ行のない値を別々のセッションで数えても主キーがぶつからない
+        zukan.bump_stat_counters(first, new={"love": "LCRO"})
+        first.commit()
+        zukan.bump_stat_counters(second, new={"love": "LCRO"})
+        second.commit()
+        assert zukan.load_stat_counts(first)["love"] == {"LCRO": 2}
+    finally:
+        first.close()
+        second.close()
+
+
+def test_stats_members(client, session, make_person):
+    a = make_person(name="あ", mbti="INTJ", love_type="LCRO", blood_type="A")
+    make_person(name="い", mbti="ENFP", blood_type="A")
+    tag = zukan.GroupTag(name="友達")
+    session.add(tag)
+    session.flush()
+    session.add(zukan.PersonTag(person_id=a.id, tag_id=tag.id))
+    session.commit()
+
+    def members(category, value):
+        body = client.get(f"/stats_members?type={category}&value={value}").get_json()
+        return sorted(p["name"] for p in body)
+
+    assert members("mbti", "INTJ") == ["あ"]
+    assert members("love", "LCRO") == ["あ"]
+    assert members("blood", "A") == ["あ", "い"]
+    assert members("tag", "友達") == ["あ"]
+    assert members("unknown", "x") == []